@@ -0,0 +1,95 @@
+# per pass wall time, node counts and rewrite counts of codegen (lower, full_graph_rewrite passes, linearize, render) as json
+# the corpus is the kernels dumped with RUN_PROCESS_REPLAY=1, or ResNet50 with hand coded optimizations if there's none
+# OUT=file.json saves the report, BASELINE=file.json compares against a saved one and fails if a pass got more than THRESHOLD slower
+import json, time, sys
+from typing import Dict, List, Tuple
+from tinygrad import Tensor
+from tinygrad.helpers import Context, ContextVar, getenv, diskcache_values
+from tinygrad.ops import UOp, UOps, PatternMatcher, graph_rewrite, toposort
+from tinygrad.codegen.kernel import Kernel
+from tinygrad.codegen.lowerer import ast_to_uop
+from tinygrad.codegen import uopgraph
+from tinygrad.codegen.uopgraph import graph_rewrite_passes, linearize_uop
+
+TABLE_NAME = f"process_replay_{getenv('GITHUB_RUN_ID', 'HEAD')}_{getenv('GITHUB_RUN_ATTEMPT')}"
+REPEAT, THRESHOLD = getenv("REPEAT", 3), getenv("THRESHOLD", 1.1)
+
+class CountingMatcher(PatternMatcher):
+  def __init__(self, pm:PatternMatcher):
+    self.pm, self.calls, self.rewrites = pm, 0, 0
+  def rewrite(self, uop:UOp):
+    self.calls += 1
+    if (ret:=self.pm.rewrite(uop)) is not None: self.rewrites += 1
+    return ret
+
+def load_corpus() -> Tuple[str, List[Kernel]]:
+  kernels: List[Kernel] = []
+  for ast, opts, applied_opts, _, _, ctx in diskcache_values(TABLE_NAME):
+    with Context(**{k:v for k,v in ctx.items() if k in ContextVar._cache and k != "DEBUG"}):
+      k = Kernel(ast, opts=opts)
+      for opt in applied_opts: k.apply_opt(opt)
+    kernels.append(k)
+  if kernels: return TABLE_NAME, kernels
+  from extra.models.resnet import ResNet50
+  sched = ResNet50()(Tensor.empty(getenv("BS", 64), 3, 224, 224)).schedule()
+  for ast in {x.ast.key:x.ast for x in sched if x.ast.op is UOps.SINK}.values():
+    (k:=Kernel(ast)).hand_coded_optimizations()
+    kernels.append(k)
+  return "resnet50", kernels
+
+def timeit(fxn, *args):
+  # min over REPEAT runs, every run gets the same input so it returns the same (interned) output
+  tms = []
+  for _ in range(REPEAT):
+    st = time.perf_counter()
+    ret = fxn(*args)
+    tms.append(time.perf_counter() - st)
+  return ret, min(tms)
+
+def bench_kernel(k:Kernel, stats:Dict[str, Dict[str, float]]):
+  def add(name:str, tm:float, **kwargs):
+    s = stats.setdefault(name, {"time_ms": 0.0, "nodes": 0, "calls": 0, "rewrites": 0})
+    s["time_ms"] += tm*1e3
+    for key,v in kwargs.items(): s[key] += v
+  sink, tm = timeit(lambda: ast_to_uop(k.get_optimized_ast(), k.opts))
+  add("lower", tm, nodes=len(toposort(sink)))
+  uopgraph.acc_number = 0
+  for name,pm in graph_rewrite_passes(k.opts):
+    acc_number = uopgraph.acc_number
+    def run(pm:PatternMatcher) -> UOp:
+      uopgraph.acc_number = acc_number
+      return graph_rewrite(sink, pm)
+    ret, tm = timeit(run, pm)
+    cpm = CountingMatcher(pm)
+    assert run(cpm) is ret, f"{name} isn't deterministic"
+    add(name, tm, nodes=len(toposort(sink:=ret)), calls=cpm.calls, rewrites=cpm.rewrites)
+  uops, tm = timeit(linearize_uop, sink)
+  add("linearize", tm, nodes=len(uops))
+  _, tm = timeit(k.opts.render, k.name, uops)
+  add("render", tm)
+
+def compare(report, baseline) -> bool:
+  ok = True
+  print(f"{'pass':14s} {'base ms':>10s} {'ms':>10s} {'ratio':>7s}  {'nodes':>16s} {'rewrites':>16s}", file=sys.stderr)
+  for name,s in report["passes"].items():
+    if (b:=baseline["passes"].get(name)) is None: continue
+    ratio = s["time_ms"]/max(b["time_ms"], 1e-9)
+    if (slow:=ratio > THRESHOLD): ok = False
+    # node and rewrite counts don't depend on timing, if they change the generated code did
+    changed = b["nodes"] != s["nodes"] or b["rewrites"] != s["rewrites"]
+    print(f"{name:14s} {b['time_ms']:10.2f} {s['time_ms']:10.2f} {ratio:6.2f}x  {b['nodes']:7d} -> {s['nodes']:7d} "
+          f"{b['rewrites']:7d} -> {s['rewrites']:7d}" + ("  SLOWER" if slow else "") + ("  CHANGED" if changed else ""), file=sys.stderr)
+  return ok
+
+if __name__ == "__main__":
+  corpus, kernels = load_corpus()
+  if (limit:=getenv("LIMIT", -1)) != -1: kernels = kernels[:limit]
+  stats: Dict[str, Dict[str, float]] = {}
+  for k in kernels: bench_kernel(k, stats)
+  report = {"corpus": corpus, "kernels": len(kernels), "repeat": REPEAT, "passes": stats,
+            "total_ms": sum(s["time_ms"] for s in stats.values())}
+  print(out:=json.dumps(report, indent=2))
+  if (fn:=getenv("OUT", "")):
+    with open(fn, "w") as f: f.write(out)
+  if (fn:=getenv("BASELINE", "")):
+    with open(fn) as f: sys.exit(0 if compare(report, json.load(f)) else 1)
@@ -0,0 +1,26 @@
+# time per uop of the graph helpers on deep graphs, it should stay flat as the graph grows
+import time
+from tinygrad.dtype import dtypes, PtrDType
+from tinygrad.ops import UOp, UOps, toposort, children_map
+from tinygrad.codegen.uopgraph import linearize_uop
+from tinygrad.helpers import getenv
+
+def chain_sink(depth:int) -> UOp:
+  buf = UOp(UOps.DEFINE_GLOBAL, PtrDType(dtypes.float), (), 0)
+  rng = UOp(UOps.RANGE, dtypes.int, (UOp.const(dtypes.int, 0), UOp.const(dtypes.int, 16)), (0, False))
+  x = UOp(UOps.LOAD, dtypes.float, (buf, rng))
+  for i in range(depth): x = x * UOp.const(dtypes.float, i) + x
+  return UOp(UOps.SINK, dtypes.void, (UOp(UOps.STORE, dtypes.void, (buf, rng, x)),))
+
+def timeit(fxn, x) -> float:
+  st = time.perf_counter()
+  fxn(x)
+  return time.perf_counter() - st
+
+if __name__ == "__main__":
+  print(f"{'uops':>8s} {'parents':>12s} {'toposort':>12s} {'children':>12s} {'linearize':>12s}  (ns/uop)")
+  for depth in [1000*2**i for i in range(getenv("STEPS", 6))]:
+    sink = chain_sink(depth)
+    n = len(toposort(sink))
+    tms = [timeit(lambda x: x.parents, sink), timeit(toposort, sink), timeit(children_map, sink), timeit(linearize_uop, sink)]
+    print(f"{n:8d} " + " ".join(f"{tm*1e9/n:12.1f}" for tm in tms))
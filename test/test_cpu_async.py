@@ -0,0 +1,57 @@
+import unittest, threading
+import numpy as np
+from tinygrad import Tensor, Device, TinyJit
+from tinygrad.helpers import Context
+from tinygrad.engine.realize import ExecItem, CustomOp
+
+@unittest.skipUnless(hasattr(Device[Device.DEFAULT], "queue"), "needs a CPU queue")
+class TestCPUAsync(unittest.TestCase):
+  def setUp(self):
+    self.queue = Device[Device.DEFAULT].queue
+    self.ctx = Context(CPU_ASYNC=1)
+    self.ctx.__enter__()
+  def tearDown(self):
+    self.queue.synchronize()
+    self.ctx.__exit__()
+
+  def test_realize_returns_before_run(self):
+    a = Tensor([1.0, 2.0, 3.0]).realize()
+    self.queue.submit((gate:=threading.Event()).wait)
+    b = (a+1).realize()
+    self.assertFalse(b.lazydata.base.realized._event.done())
+    gate.set()
+    np.testing.assert_equal(b.numpy(), [2.0, 3.0, 4.0])
+
+  def test_copyin_waits_on_readers(self):
+    a = Tensor([1.0, 2.0, 3.0]).realize()
+    self.queue.submit((gate:=threading.Event()).wait)
+    b = (a*2).realize()
+    threading.Timer(0.1, gate.set).start()
+    # the kernel reading a has to run before a is overwritten
+    a.lazydata.base.realized.copyin(memoryview(np.array([5.0, 5.0, 5.0], dtype=np.float32)))
+    np.testing.assert_equal(b.numpy(), [2.0, 4.0, 6.0])
+    np.testing.assert_equal(a.numpy(), [5.0, 5.0, 5.0])
+
+  def test_sync_runner_waits(self):
+    a = Tensor([1.0, 2.0, 3.0]).realize()
+    self.queue.submit((gate:=threading.Event()).wait)
+    b = (a+1).realize()
+    threading.Timer(0.1, gate.set).start()
+    # a CustomOp gets the raw buffers, the kernel writing b has to be done before it runs
+    def check(x): self.assertTrue(x._event.done())
+    ExecItem(CustomOp(check), [b.lazydata.base.realized]).run()
+
+  def test_chain(self):
+    x = Tensor.arange(16).float().realize()
+    for _ in range(10): x = (x*2+1).realize()
+    np.testing.assert_equal(x.numpy(), np.arange(16)*1024+1023)
+
+  def test_jit(self):
+    w = Tensor.randn(8, 8).realize()
+    jf = TinyJit(lambda x: (x @ w).relu().realize())
+    for _ in range(5):
+      x = Tensor.randn(4, 8).realize()
+      np.testing.assert_allclose(jf(x).numpy(), np.maximum(x.numpy() @ w.numpy(), 0), atol=1e-5, rtol=1e-5)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,14 +1,17 @@
 #!/usr/bin/env python
-import unittest, functools
+import unittest, functools, tempfile, struct, pathlib
+from unittest.mock import patch
 import numpy as np
 
 from hypothesis import given, settings, strategies as strat
 from test.helpers import assert_jit_cache_len
 from tinygrad.tensor import Tensor
-from tinygrad.engine.jit import TinyJit
+from tinygrad.engine.jit import TinyJit, CapturedJit
 from tinygrad.device import Device
 from tinygrad.helpers import CI, Context
 from tinygrad.dtype import dtypes
+from tinygrad.shape.symbolic import Variable
+from tinygrad.device import Compiler
 from extra.models.unet import ResBlock
 
 def _simple_test(add, extract=lambda x: x, N=10):
@@ -136,6 +139,83 @@ class TestJit(unittest.TestCase):
         a = Tensor.randn(10, 10).realize()[:, i:i+2]
         add(a)
 
+  def test_jit_multi_shape(self):
+    w = Tensor.randn(8, 3).realize()
+    jf = TinyJit(lambda x: (x @ w).relu().realize(), max_captured=3)
+    for _ in range(3):
+      for bs in [1, 4, 8]:
+        x = Tensor.randn(bs, 8).realize()
+        np.testing.assert_allclose(jf(x).numpy(), np.maximum(x.numpy() @ w.numpy(), 0), atol=1e-5, rtol=1e-5)
+    # the first call isn't jitted, then each batch size is captured once
+    self.assertEqual((jf.misses, jf.hits, len(jf.captured_cache)), (3, 5, 3))
+    self.assertEqual(jf.captured.expected_st_vars_dtype_device[0][0].shape, (8, 8))
+
+  def test_jit_multi_shape_lru(self):
+    jf = TinyJit(lambda x: (x*2).realize(), max_captured=2)
+    for bs in [1, 2, 3, 2, 1, 3, 2]:
+      x = Tensor.randn(bs).realize()
+      np.testing.assert_allclose(jf(x).numpy(), x.numpy()*2, atol=1e-6)
+    # 1 is ignored, 2 and 3 are captured, 2 hits, 1 evicts 3, 3 evicts 2, 2 evicts 1
+    self.assertEqual((jf.misses, jf.hits), (5, 1))
+    self.assertEqual([sig[1][0][0].shape for sig in jf.captured_cache], [(3,), (2,)])
+
+  def test_jit_buckets(self):
+    w = Tensor.randn(8, 3).realize()
+    jf = TinyJit(lambda x, y: ((x @ w).relu().realize(), (y*2).realize()), buckets=[4, 8, 16])
+    for bs in [1, 3, 4, 5, 7, 8, 2, 16, 11, 6]:
+      x, y = Tensor.randn(bs, 8).realize(), Tensor.randn(bs).realize()
+      out, out2 = jf(x, y=y)
+      self.assertEqual((out.shape, out2.shape), ((bs, 3), (bs,)))
+      np.testing.assert_allclose(out.numpy(), np.maximum(x.numpy() @ w.numpy(), 0), atol=1e-5, rtol=1e-5)
+      np.testing.assert_allclose(out2.numpy(), y.numpy()*2, atol=1e-6)
+    # one capture per bucket, the first call isn't jitted
+    self.assertEqual((jf.misses, jf.hits, len(jf.captured_cache)), (3, 6, 3))
+    with self.assertRaises(ValueError): jf(Tensor.randn(17, 8).realize(), y=Tensor.randn(17).realize())
+    with self.assertRaises(ValueError): jf(Tensor.randn(3, 8).realize(), y=Tensor.randn(4).realize())
+
+  def test_jit_buckets_axis(self):
+    jf = TinyJit(lambda x: (x+1).sum(0, keepdim=True).realize(), buckets=[2, 4], bucket_axis=1)
+    for n in [1, 2, 3, 4, 3]:
+      x = Tensor.randn(5, n).realize()
+      np.testing.assert_allclose(jf(x).numpy(), (x.numpy()+1).sum(0, keepdims=True), atol=1e-5, rtol=1e-5)
+    self.assertEqual((jf.misses, jf.hits), (2, 2))
+
+  def test_jit_buckets_pad_shrink(self):
+    w = Tensor.randn(4).realize()
+    jf = TinyJit(lambda x: (x.max(0).realize(), (x*2).realize(), (w+1).realize()), buckets=[4, 8], bucket_pad=-float("inf"),
+                 bucket_shrink=(False, True, False))
+    for n in [3, 4, 2, 3, 6]:
+      x = Tensor.randn(n, 5).realize()
+      mx, x2, w1 = jf(x)
+      np.testing.assert_allclose(mx.numpy(), x.numpy().max(0), atol=1e-6)
+      np.testing.assert_allclose(x2.numpy(), x.numpy()*2, atol=1e-6)
+      # the same size as a bucket on bucket_axis, but not per-row
+      np.testing.assert_allclose(w1.numpy(), w.numpy()+1, atol=1e-6)
+
+  def test_jit_buckets_args(self):
+    jf = TinyJit(lambda x, w, mask: ((x @ w)*mask).realize(), buckets=[4, 8], bucket_args=(0,))
+    w, mask = Tensor.randn(5, 3).realize(), Tensor.randn(3).realize()
+    for n in [3, 2, 4, 6, 3]:
+      x = Tensor.randn(n, 5).realize()
+      np.testing.assert_allclose(jf(x, w, mask=mask).numpy(), (x.numpy() @ w.numpy())*mask.numpy(), atol=1e-5, rtol=1e-5)
+    self.assertEqual((jf.misses, jf.hits), (2, 2))
+    with self.assertRaisesRegex(ValueError, "bucket_args"): TinyJit(lambda x: x.realize(), buckets=[4], bucket_args=("x",))(Tensor.ones(4))
+
+  def test_jit_buckets_exact_size_contiguous(self):
+    jf = TinyJit(lambda x: (x*2).realize(), buckets=[4, 8])
+    for x in [Tensor.randn(3, 5), Tensor.randn(5, 4).T, Tensor.randn(2, 5), Tensor.randn(8, 5)[::2], Tensor.randn(4, 5)]:
+      np.testing.assert_allclose(jf(x.realize()).numpy(), x.numpy()*2, atol=1e-6)
+    # the strided inputs at a bucket size run the capture of the padded ones
+    self.assertEqual((jf.misses, jf.hits, len(jf.captured_cache)), (1, 3, 1))
+
+  def test_jit_buckets_error_ndim(self):
+    jf = TinyJit(lambda x, y: (x+y).realize(), buckets=[4, 8], bucket_axis=1)
+    with self.assertRaisesRegex(ValueError, "have no axis 1"): jf(Tensor.randn(2, 3).realize(), Tensor.randn(3).realize())
+
+  def test_jit_buckets_error_sizes(self):
+    jf = TinyJit(lambda x, y: (x+y).realize(), buckets=[4, 8])
+    with self.assertRaisesRegex(ValueError, r"\{(2, 3|3, 2)\}"): jf(Tensor.randn(2).realize(), Tensor.randn(3).realize())
+
   def test_jit_duplicate_fail(self):
     # the jit doesn't support duplicate arguments
     @TinyJit
@@ -412,6 +492,25 @@ class TestJit(unittest.TestCase):
       xc = jf(a)
       np.testing.assert_allclose((a.numpy().sum(axis=(1,)) + 5).view(np.int32), xc.numpy(), atol=1e-4, rtol=1e-5)
 
+  @unittest.skipUnless(hasattr(Device[Device.DEFAULT].allocator, "offset"), "needs offset support")
+  def test_jit_intermediates_slab(self):
+    @TinyJit
+    def f(a):
+      x = (a*2).realize()
+      y = (x.cast(dtypes.int32)+1).realize()
+      z = y.cast(dtypes.float32).exp2().realize()
+      return (z+x).realize()
+    with Context(JIT=2):
+      for _ in range(5):
+        a = Tensor.randn(10).realize()
+        out = f(a)
+        np.testing.assert_allclose(out.numpy(), np.exp2((a.numpy()*2).astype(np.int32)+1)+a.numpy()*2, atol=1e-4, rtol=1e-5)
+    # the intermediates x, y and z share one slab, the only other buffer is the output (inputs are cleared after a call)
+    bases = {b.base for ei in f.jit_cache for b in ei.bufs if b is not None}
+    self.assertEqual(len(bases), 2)
+    slab = [b for b in bases if b.dtype == dtypes.uint8][0]
+    self.assertEqual({b.dtype for ei in f.jit_cache for b in ei.bufs if b is not None and b.base is slab}, {dtypes.float32, dtypes.int32})
+
 @unittest.skip("Pending multioutput implementation #3607")
 class TestMultioutputJit(unittest.TestCase):
   def _test(self, f):
@@ -453,5 +552,82 @@ class TestJitInsideJit(unittest.TestCase):
     with self.assertRaisesRegex(RuntimeError, "having TinyJit inside another TinyJit is not supported"):
       g(Tensor([1])).realize()
 
+class TestJitArtifact(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.fn = str(pathlib.Path(self.tmp.name) / "jit.pkl")
+  def tearDown(self): self.tmp.cleanup()
+
+  def test_roundtrip(self):
+    w = Tensor.randn(16, 8).realize()
+    @TinyJit
+    def f(x): return (x @ w).relu().sum(axis=1).realize()
+    for _ in range(3): f(Tensor.randn(4, 16))
+    f.captured.save(self.fn)
+    x = Tensor.randn(4, 16).realize()
+    want = f(x).numpy()
+    with patch.object(Compiler, "compile", side_effect=AssertionError("compiled on load")):
+      g = TinyJit(None, captured=CapturedJit.load(self.fn))
+      for _ in range(2): np.testing.assert_allclose(g(x).numpy(), want, atol=1e-5, rtol=1e-5)
+
+  def test_symbolic(self):
+    @TinyJit
+    def f(a, b): return (a+b).realize()
+    for i in range(1, 4):
+      vi = Variable("i", 1, 10).bind(i)
+      f(Tensor.rand(3, i).reshape(3, vi), Tensor.rand(3, i).reshape(3, vi))
+    f.captured.save(self.fn)
+    g = TinyJit(None, captured=CapturedJit.load(self.fn))
+    for i in range(1, 5):
+      vi = Variable("i", 1, 10).bind(i)
+      a, b = Tensor.rand(3, i).realize(), Tensor.rand(3, i).realize()
+      np.testing.assert_allclose(g(a.reshape(3, vi), b.reshape(3, vi)).reshape(3, i).numpy(), a.numpy()+b.numpy(), atol=1e-6)
+
+  def test_bad_version(self):
+    @TinyJit
+    def f(x): return (x+1).realize()
+    for _ in range(3): f(Tensor.randn(4))
+    f.captured.save(self.fn)
+    with open(self.fn, "r+b") as fp:
+      fp.seek(8)
+      fp.write(struct.pack("<I", 0xdead))
+    with self.assertRaisesRegex(RuntimeError, "version"): CapturedJit.load(self.fn)
+
+@unittest.skipUnless(Device.DEFAULT == "CLANG", "ClangGraph")
+class TestClangGraph(unittest.TestCase):
+  def _jit(self):
+    w = Tensor.randn(8, 8).realize()
+    @TinyJit
+    def f(x, y): return ((x @ w).relu() + y.reshape(4, 1)).sum(1).realize()
+    return f, w
+
+  def _graph(self, f):
+    from tinygrad.runtime.graph.clang import ClangGraph
+    return [ei.prg for ei in f.captured._jit_cache if isinstance(ei.prg, ClangGraph)][0]
+
+  def test_replay_swaps_inputs(self):
+    f, w = self._jit()
+    xs, ys = [Tensor.randn(4, 8).realize() for _ in range(3)], [Tensor.randn(4).realize() for _ in range(3)]
+    for i in range(3): f(xs[i], ys[i])
+    for i in [2, 0, 0, 1]:
+      np.testing.assert_allclose(f(xs[i], ys[i]).numpy(), (np.maximum(xs[i].numpy() @ w.numpy(), 0) + ys[i].numpy()[:, None]).sum(1), atol=1e-5)
+
+  def test_source_has_no_addresses(self):
+    # the same function captured twice uses different buffers, the batched library is the same
+    libs = []
+    for _ in range(2):
+      f, _ = self._jit()
+      for _ in range(3): f(Tensor.randn(4, 8).realize(), Tensor.randn(4).realize())
+      libs.append(self._graph(f).clprg.lib)
+    self.assertEqual(libs[0], libs[1])
+
+  def test_symbolic(self):
+    @TinyJit
+    def f(a): return (a*2+1).realize()
+    for i in range(1, 6):
+      vi = Variable("i", 1, 10).bind(i)
+      a = Tensor.rand(3, i).realize()
+      np.testing.assert_allclose(f(a.reshape(3, vi)).reshape(3, i).numpy(), a.numpy()*2+1, atol=1e-6)
+
 if __name__ == '__main__':
   unittest.main()
@@ -1,6 +1,7 @@
 from typing import List, Tuple, Union
 import numpy as np
 import unittest
+from unittest.mock import patch
 from dataclasses import replace
 
 from test.helpers import ast_const
@@ -1681,6 +1682,22 @@ class TestFloat4(unittest.TestCase):
       assert count == expected, f"{count=}, {expected=}"
 
 class TestHandCodedOpts(unittest.TestCase):
+  @unittest.skipUnless(Device[Device.DEFAULT].renderer.threads, "test requires cpu threads")
+  def test_threads(self):
+    s = create_schedule([(Tensor.rand(256, 256) @ Tensor.rand(256, 256)).lazydata])[-1]
+    with patch.object(Device[Device.DEFAULT].renderer, "threads", 12):
+      (k0:=Kernel(s.ast)).hand_coded_optimizations()
+      with Context(THREAD_OPT=1):
+        k = Kernel(s.ast)
+        k.hand_coded_optimizations()
+        p = k.to_program()
+    # opt-in, without it the kernel stays on one thread so a JIT can still batch it into ClangGraph
+    self.assertNotIn(OptOps.THREAD, [o.op for o in k0.applied_opts])
+    # 12 doesn't divide the globals, 8 does
+    self.assertIn(Opt(OptOps.THREAD, 0, 8), k.applied_opts)
+    self.assertEqual(p.global_size, [8, 1, 1])
+    self.assertIn("core_id", p.src)
+
   def test_masked_upcast(self):
     layer_1 = Tensor.cat(*[Tensor.rand(5) for _ in range(4)])
     layer_2 = Tensor.cat(layer_1.unsqueeze(0), Tensor.rand(6, 20))
@@ -2021,6 +2038,22 @@ class TestKernelOpts(unittest.TestCase):
       [Opt(OptOps.PADTO, 0, 32), Opt(OptOps.PADTO, 1, 32), Opt(OptOps.UPCAST, 0, 2), Opt(OptOps.UPCAST, 1, 2),],
     ])
 
+  @unittest.skipUnless(Device[Device.DEFAULT].renderer.threads, "test requires cpu threads")
+  def test_thread(self):
+    N = 32
+    a, b = Tensor.rand(N, N), Tensor.rand(N, N)
+    helper_linearizer_opt(a@b, [
+      [Opt(OptOps.THREAD, 0, 4)],
+      [Opt(OptOps.THREAD, 1, 8)],
+      [Opt(OptOps.THREAD, 0, 0)],
+      [Opt(OptOps.THREAD, 0, 4), Opt(OptOps.UPCAST, 0, 4), Opt(OptOps.UNROLL, 0, 4)],
+      [Opt(OptOps.UPCAST, 1, 4), Opt(OptOps.THREAD, 0, 2), Opt(OptOps.UPCAST, 0, 2)],
+      # the thread axis is upcasted away
+      [Opt(OptOps.THREAD, 0, 4), Opt(OptOps.UPCAST, 0, 4)],
+    ])
+    with self.assertRaises(KernelOptError): helper_linearizer_opt(a@b, [[Opt(OptOps.THREAD, 0, 2), Opt(OptOps.THREAD, 0, 2)]])
+    with self.assertRaises(KernelOptError): helper_linearizer_opt(a@b, [[Opt(OptOps.THREAD, 2, 2)]])
+
   def test_padto_upcasted_not_ok(self):
     N = 4
     a = Tensor.rand(N, N)
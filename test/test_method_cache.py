@@ -1,5 +1,10 @@
-import unittest
+import unittest, threading
+from unittest.mock import patch
+import numpy as np
 from tinygrad import Tensor, Device, Variable
+from tinygrad.helpers import Context
+from tinygrad.engine import realize
+from tinygrad.engine.realize import lower_schedule, CompiledRunner
 from examples.gpt2 import Transformer
 from tinygrad.nn.state import get_state_dict
 
@@ -41,6 +46,61 @@ class TestMethodCache(unittest.TestCase):
     Device[Device.DEFAULT].compiler = None
     for i in range(3): model(Tensor([[1,2,3,4]]), Variable("start_pos", 0, 10).bind(i)).realize()
 
+class TestLowerAhead(unittest.TestCase):
+  def test_compiles_on_pool(self):
+    threads, codegen_threads = [], []
+    def _compile_program(dev, prg):
+      threads.append(threading.current_thread())
+      return compile_program(dev, prg)
+    def _get_kernel(renderer, ast):
+      codegen_threads.append(threading.current_thread())
+      return get_kernel(renderer, ast)
+    a = Tensor.rand(16).realize()
+    outs = [(a*3.1+i*0.37).sqrt() for i in range(6)]
+    sched = Tensor.schedule(*outs)
+    compile_program, get_kernel = realize._compile_program, realize.get_kernel
+    with Context(LOWER_AHEAD=3), patch.object(realize, "_compile_program", _compile_program), patch.object(realize, "get_kernel", _get_kernel):
+      eis = list(lower_schedule(sched))
+    self.assertEqual(len(threads), 6)
+    self.assertTrue(all(t is not threading.main_thread() for t in threads))
+    # codegen has process global state, only the compiler runs on the pool
+    self.assertTrue(all(t is threading.main_thread() for t in codegen_threads))
+    self.assertTrue(all(isinstance(ei.prg, CompiledRunner) for ei in eis))
+    self.assertEqual(len(realize.compiling), 0)
+    for ei in eis: ei.run()
+    for i,out in enumerate(outs): np.testing.assert_allclose(out.numpy(), np.sqrt(a.numpy()*3.1+i*0.37), rtol=1e-6)
+
+  def test_error_drops_pending(self):
+    a = Tensor.rand(16).realize()
+    sched = Tensor.schedule(*[(a*1.7+i*0.29).sqrt() for i in range(5)])
+    with Context(LOWER_AHEAD=3), patch.object(realize, "lower_schedule_item", side_effect=RuntimeError("lowering failed")):
+      with self.assertRaises(RuntimeError): list(lower_schedule(sched))
+    self.assertEqual(len(realize.compiling), 0)
+    # the compiles that already started still finish
+    if realize.lower_pool is not None: realize.lower_pool.shutdown(wait=True)
+    realize.lower_pool = None
+
+  def test_disabled(self):
+    a = Tensor.rand(16).realize()
+    with Context(LOWER_AHEAD=0), patch.object(realize, "_compile_program", side_effect=AssertionError("compiled ahead")):
+      list(lower_schedule((a*4.3).schedule()))
+
+@unittest.skipUnless(Device.DEFAULT == "CLANG", "needs a compiler with compile_batch")
+class TestBatchCompile(unittest.TestCase):
+  def test_one_library(self):
+    compiler = Device[Device.DEFAULT].compiler
+    a = Tensor.rand(16).realize()
+    outs = [(a*2.3+i*0.71).sqrt() for i in range(5)]
+    sched = Tensor.schedule(*outs)
+    with Context(BATCH_COMPILE=1), patch.object(compiler, "cachekey", None), \
+         patch.object(compiler, "compile", wraps=compiler.compile) as compile_mock:
+      eis = list(lower_schedule(sched))
+    self.assertEqual(compile_mock.call_count, 1)
+    self.assertEqual(len(set(ei.prg.lib for ei in eis)), 1)
+    self.assertEqual(len(realize.compiling), 0)
+    for ei in eis: ei.run()
+    for i,out in enumerate(outs): np.testing.assert_allclose(out.numpy(), np.sqrt(a.numpy()*2.3+i*0.71), rtol=1e-6)
+
 if __name__ == '__main__':
   unittest.main()
 
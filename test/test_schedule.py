@@ -3,6 +3,7 @@
 # NOTE: this has overlap with external_test_opt.py
 
 import unittest
+from unittest.mock import patch
 import numpy as np
 from typing import List, Optional, Union, cast
 
@@ -16,6 +17,7 @@ from tinygrad.ops import BinaryOps, MetaOps, UOp, UnaryOps, UOps
 from tinygrad.ops import graph_rewrite
 from tinygrad.helpers import AST_REWRITE, CI, DEBUG, FUSE_ARANGE, flatten, getenv, SPLIT_REDUCEOP, unwrap, prod
 from tinygrad.codegen.kernel import Kernel, verify_ast
+from tinygrad.engine import schedule
 from tinygrad.engine.schedule import create_schedule, reduceop_fusor, st_fixup
 from tinygrad.engine.realize import CompiledRunner, run_schedule
 from test.helpers import ast_const, is_dtype_supported, Context, timeit
@@ -1026,6 +1028,11 @@ class TestSchedule(unittest.TestCase):
     schedule = check_schedule([b, c], 3)
     self.assertIs(schedule[0].ast.src[0].src[2].arg, BinaryOps.ADD)
 
+  def test_no_fuse_reduce_tail(self):
+    a = Tensor.empty(4, 4)
+    check_schedule((a.sum(1) + 6) * 2, 1)
+    with Context(FUSE_REDUCE_TAIL=0): check_schedule((a.sum(1) + 6) * 2, 2)
+
   # multireduce spec
   def test_multireduce_simple_chase(self):
     Tensor.manual_seed(0)
@@ -1556,6 +1563,19 @@ class TestScheduleRewrite(unittest.TestCase):
     self.assertEqual(new_uop.st, ShapeTracker.from_shape((4,)).reshape((4, 1)))
     self.assertLess(et, 1e3)
 
+  def test_reuse_rewritten_ast(self):
+    a, b = Tensor.empty(4, 4).realize(), Tensor.empty(4, 4).realize()
+    s1 = (a.sum(0).reshape(2, 2)+1).schedule()
+    s2 = (b.sum(0).reshape(2, 2)+1).schedule()
+    self.assertEqual(len(s1), len(s2))
+    for si1, si2 in zip(s1, s2): self.assertIs(si1.ast, si2.ast)
+
+  def test_repeated_step_skips_rewrite(self):
+    def step(a:Tensor): return (a.sum(1).reshape(3, 2)*2).schedule()
+    a = Tensor.empty(6, 5).realize()
+    step(a)
+    with patch.object(schedule, "graph_rewrite", side_effect=AssertionError("rewrote a repeated AST")): step(a)
+
   def test_no_rewrite_elementwise(self):
     bufs = [UOp(UOps.DEFINE_GLOBAL, PtrDType(dtypes.int), (), i) for i in range(3)]
     ld1 = UOp(UOps.LOAD, dtypes.int, (bufs[1], ShapeTracker.from_shape((32, 32)).to_uop()))
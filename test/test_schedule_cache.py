@@ -0,0 +1,65 @@
+import unittest
+from unittest.mock import patch
+import numpy as np
+from tinygrad import Tensor, Variable
+from tinygrad.helpers import Context
+from tinygrad.engine import schedule
+from tinygrad.engine.schedule import create_schedule_with_vars
+from tinygrad.engine.realize import run_schedule
+
+def _model(a:Tensor, b:Tensor) -> Tensor: return ((a @ b).relu() + a.sum(axis=1, keepdim=True)).exp2()
+
+class TestScheduleCache(unittest.TestCase):
+  def setUp(self):
+    self.ctx = Context(SCHEDULE_CACHE=1)
+    self.ctx.__enter__()
+  def tearDown(self): self.ctx.__exit__()
+
+  def _schedule(self, out:Tensor):
+    return create_schedule_with_vars(out.lazydata.lbs)
+
+  def test_cache_hit_skips_scheduler(self):
+    a, b = Tensor.rand(7, 7).realize(), Tensor.rand(7, 7).realize()
+    sched, _ = self._schedule(_model(a, b))
+    c, d = Tensor.rand(7, 7).realize(), Tensor.rand(7, 7).realize()
+    with patch.object(schedule, "_graph_schedule", side_effect=AssertionError("cache miss")):
+      out = _model(c, d)
+      sched2, _ = self._schedule(out)
+    self.assertEqual([si.ast.key for si in sched], [si.ast.key for si in sched2])
+    # buffers are rebound to the new graph
+    self.assertIn(c.lazydata.base.buffer, sched2[0].bufs+sched2[-1].bufs)
+    self.assertNotIn(a.lazydata.base.buffer, [b for si in sched2 for b in si.bufs])
+    self.assertIs(sched2[-1].outputs[0], out.lazydata.base.buffer)
+    run_schedule(sched2)
+    np.testing.assert_allclose(out.numpy(), _model(Tensor(c.numpy()), Tensor(d.numpy())).numpy(), rtol=1e-5, atol=1e-5)
+
+  def test_different_structure_misses(self):
+    a = Tensor.rand(5, 5).realize()
+    self._schedule((a+1).sum())
+    with patch.object(schedule, "_graph_schedule", side_effect=AssertionError("cache miss")):
+      with self.assertRaises(AssertionError): self._schedule((a*2).sum())
+      with self.assertRaises(AssertionError): self._schedule((Tensor.rand(6, 5).realize()+1).sum())
+
+  def test_shared_input_is_not_aliased(self):
+    a, b = Tensor.rand(4).realize(), Tensor.rand(4).realize()
+    self._schedule(a+b)
+    with patch.object(schedule, "_graph_schedule", side_effect=AssertionError("cache miss")):
+      with self.assertRaises(AssertionError): self._schedule(a+a)
+
+  def test_symbolic_var_vals(self):
+    a = Tensor.rand(3, 10).realize()
+    sched, var_vals = self._schedule(a.shrink(((0, 3), (0, Variable("i", 1, 10).bind(4)))).sum())
+    self.assertEqual({k.expr:v for k,v in var_vals.items()}, {"i": 4})
+    with patch.object(schedule, "_graph_schedule", side_effect=AssertionError("cache miss")):
+      sched2, var_vals2 = self._schedule(a.shrink(((0, 3), (0, Variable("i", 1, 10).bind(7)))).sum())
+    self.assertEqual({k.expr:v for k,v in var_vals2.items()}, {"i": 7})
+    self.assertEqual([si.ast.key for si in sched], [si.ast.key for si in sched2])
+
+  def test_disabled(self):
+    a = Tensor.rand(5).realize()
+    self._schedule(a+3)
+    with Context(SCHEDULE_CACHE=0), patch.object(schedule, "_graph_schedule", side_effect=AssertionError("cache miss")):
+      with self.assertRaises(AssertionError): self._schedule(a+3)
+
+if __name__ == '__main__':
+  unittest.main()
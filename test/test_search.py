@@ -1,15 +1,19 @@
-import unittest
+import unittest, random, time, math, multiprocessing, pickle
+import numpy as np
+from unittest.mock import patch
 
 from test.helpers import ast_const
 from tinygrad.codegen.kernel import Opt, OptOps
 from tinygrad.codegen.kernel import Kernel
 from tinygrad.ops import UOp, UOps, BinaryOps
 from tinygrad.engine.schedule import create_schedule
-from tinygrad.engine.search import time_linearizer, bufs_from_lin, actions, beam_search
-from tinygrad.device import Device, Buffer
+from tinygrad.engine import search
+from tinygrad.engine.search import time_linearizer, bufs_from_lin, actions, beam_search, CostModel, kernel_features, rank_with_cost_model
+from tinygrad.engine.search import search_kernel, search_strategies, ast_signature, get_transfer_seeds, timing_stats, timing_estimate, _time_program
+from tinygrad.device import Device, Buffer, Compiler
 from tinygrad.tensor import Tensor
 from tinygrad.dtype import dtypes, PtrDType
-from tinygrad.helpers import Context, GlobalCounters
+from tinygrad.helpers import Context, GlobalCounters, CACHELEVEL, diskcache_get
 from tinygrad.engine.realize import capturing
 from tinygrad.shape.shapetracker import ShapeTracker
 from tinygrad.shape.view import View
@@ -59,6 +63,222 @@ class TestTimeLinearizer(unittest.TestCase):
     time_linearizer(lin, bufs, allow_test_size=False, cnt=2, disable_cache=True, clear_l2=True)
     assert GlobalCounters.kernel_count == kernel_count, "kernel count was incremented by time_linearizer"
 
+class TestTimingHarness(unittest.TestCase):
+  def setUp(self):
+    si = [i for i in create_schedule([Tensor([1,2,3,4]).add(1).lazydata]) if i.ast.op is UOps.SINK][0]
+    self.p = Kernel(si.ast).to_program()
+    self.lib = Device[Device.DEFAULT].compiler.compile(self.p.src)
+    self.bufs = bufs_from_lin(Kernel(si.ast))
+
+  def test_stats(self):
+    mean, hw = timing_stats([1.0, 1.02, 0.98, 1.0, 1.01, 0.99, 50.0])
+    self.assertAlmostEqual(mean, 1.0)
+    self.assertLess(hw, 0.05)
+    self.assertEqual(timing_stats([1.0]), (1.0, float('inf')))
+    self.assertEqual(timing_estimate([1.0, float('inf')]), float('inf'))
+
+  def test_fixed_count(self):
+    self.assertEqual(len(_time_program(self.p, self.lib, {}, self.bufs, cnt=5)), 5)
+
+  def test_clearly_faster(self):
+    # far faster than the best, two runs are enough to tell
+    self.assertEqual(len(_time_program(self.p, self.lib, {}, self.bufs, cnt=5, best=1e3, max_cnt=50)), 2)
+
+  def test_clear_l2(self):
+    tms = _time_program(self.p, self.lib, {}, self.bufs, cnt=3, clear_l2=True)
+    self.assertTrue(all(0 < t < float('inf') for t in tms))
+
+class TestFusionSearch(unittest.TestCase):
+  def _graph(self):
+    a, b = Tensor.rand(64, 64).realize(), Tensor.rand(64, 1).realize()
+    return a, b, ((a.sum(1, keepdim=True)+b).relu()*a).sum(1)
+
+  def test_choice(self):
+    _, _, x = self._graph()
+    with patch.object(search, "CACHELEVEL", 0): self.assertIn(search.fusion_search(x.lazydata.lbs), search.fusion_choices)
+
+  def test_picks_fastest(self):
+    # the tail is split off when more kernels time faster, and stays fused when fewer do
+    with patch.object(search, "CACHELEVEL", 0):
+      with patch.object(search, "_time_schedule", lambda lsis, var_vals: -len(lsis)):
+        self.assertEqual(search.fusion_search(self._graph()[2].lazydata.lbs)["FUSE_REDUCE_TAIL"], 0)
+      with patch.object(search, "_time_schedule", lambda lsis, var_vals: len(lsis)):
+        self.assertEqual(search.fusion_search(self._graph()[2].lazydata.lbs)["FUSE_REDUCE_TAIL"], 1)
+
+  def test_outside_method_cache(self):
+    from tinygrad.engine.realize import method_cache
+    x = self._graph()[2]
+    cnt = len(method_cache)
+    with patch.object(search, "CACHELEVEL", 0): search.fusion_search(x.lazydata.lbs)
+    self.assertEqual(len(method_cache), cnt)
+
+  def test_failing_choice_dropped(self):
+    # FUSE_ARANGE=1 can't schedule this graph, the search skips it instead of raising
+    x = Tensor.arange(10).reshape(2, 5).sum(1)
+    with patch.object(search, "CACHELEVEL", 0): self.assertEqual(search.fusion_search(x.lazydata.lbs)["FUSE_ARANGE"], 0)
+    with Context(FUSE_SEARCH=1): self.assertEqual(x.tolist(), [10, 35])
+
+  def test_current_choice_fails(self):
+    x = Tensor.arange(10).reshape(2, 5).sum(1)
+    with patch.object(search, "CACHELEVEL", 0), Context(FUSE_ARANGE=1): self.assertIsNone(search.fusion_search(x.lazydata.lbs))
+
+  def test_not_searchable(self):
+    # CUSTOM kernels can't be timed
+    self.assertIsNone(search.fusion_search(Tensor.rand(4, 4).lazydata.lbs))
+
+  def test_realize(self):
+    a, b, x = self._graph()
+    with Context(FUSE_SEARCH=1): out = x.numpy()
+    np.testing.assert_allclose(out, ((a.numpy().sum(1, keepdims=True)+b.numpy()).clip(0, None)*a.numpy()).sum(1), rtol=1e-4)
+
+class HangingCompiler(Compiler):
+  def compile(self, src:str) -> bytes:
+    time.sleep(60)
+    return b""
+
+class TestCompilePool(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls): cls.pool = search.CompilePool(2)
+  @classmethod
+  def tearDownClass(cls): cls.pool.close()
+  def setUp(self):
+    from test.test_linearizer import helper_realized_ast
+    self.lins = list(search.get_kernel_actions(Kernel(helper_realized_ast(Tensor.rand(16, 16) @ Tensor.rand(16, 16))[0])).values())[:10]
+
+  def test_compile(self):
+    ret = dict(self.pool.compile(self.lins, Device[Device.DEFAULT].compiler))
+    self.assertEqual(set(ret), set(range(len(self.lins))))
+    self.assertTrue(all(x is not None and isinstance(x[1], bytes) for x in ret.values()))
+
+  def test_timeout(self):
+    st, pool = time.perf_counter(), self.pool.pool
+    self.assertEqual(list(self.pool.compile(self.lins[:2], HangingCompiler(), timeout=1)), [])
+    self.assertLess(time.perf_counter()-st, 30)
+    # the hung workers were replaced
+    self.assertIsNot(self.pool.pool, pool)
+    self.assertEqual(len(list(self.pool.compile(self.lins[:2], Device[Device.DEFAULT].compiler))), 2)
+
+class TestCostModel(unittest.TestCase):
+  def setUp(self):
+    from test.test_linearizer import helper_realized_ast
+    self.ast, self.bufs = helper_realized_ast(Tensor.rand(32, 32) @ Tensor.rand(32, 32))
+
+  def test_fit(self):
+    random.seed(0)
+    samples = [([a:=random.uniform(0, 4), b:=random.uniform(0, 4), 1.0], 2**(3*a-b+2)) for _ in range(50)]
+    for w,ref in zip(CostModel.fit(samples, l2=1e-6).weights, [3, -1, 2]): self.assertAlmostEqual(w, ref, places=3)
+
+  def test_fit_underdetermined(self):
+    samples = [([1.0, 2.0, 0.0, 1.0], 8.0), ([2.0, 1.0, 0.0, 1.0], 4.0)]
+    model = CostModel.fit(samples, l2=0)
+    for f,tm in samples: self.assertAlmostEqual(model.predict(f), math.log2(tm), places=6)
+
+  def test_fit_partway(self):
+    k = Kernel(self.ast)
+    key, recorded = (k.opts.device, k.opts.suffix), [([1.0, float(i%4), 1.0], 2.0**(i%4)) for i in range(10)]
+    with patch.object(search, "diskcache_values", lambda *_: recorded), patch.object(search, "diskcache_put", lambda *_: None), \
+         patch.object(search, "kernel_features", lambda *_: [1.0, 1.0, 1.0]), patch.object(search, "BEAM_RECORD_FEATURES", 1), \
+         patch.object(search, "CACHELEVEL", 2), patch.dict(search._cost_models, clear=True), patch.dict(search._cost_model_checked, clear=True):
+      self.assertIsNone(search.get_cost_model(*key))
+      # more samples in the diskcache aren't looked at until this process recorded enough of its own
+      recorded += recorded*20
+      self.assertIsNone(search.get_cost_model(*key))
+      for _ in range(64): search._put_features(k, [], {}, 1.0)
+      self.assertIsNotNone(model:=search.get_cost_model(*key))
+      self.assertIs(search.get_cost_model(*key), model)
+
+  def test_features(self):
+    k, k2 = Kernel(self.ast), Kernel(self.ast)
+    k2.apply_opt(Opt(OptOps.UPCAST, 0, 4))
+    f, f2 = [kernel_features(x, x.linearize().uops, {}) for x in [k, k2]]
+    self.assertEqual(len(f), len(f2))
+    self.assertGreater(f2[10], f[10])  # upcast size
+
+  def test_rank(self):
+    lins = list(search.get_kernel_actions(Kernel(self.ast), include_0=False).values())[:20]
+    # only count uops
+    ranked = rank_with_cost_model(lins, {}, CostModel([0, 0, 1] + [0]*10))
+    self.assertEqual([len(x.uops) for x in ranked], sorted(len(x.uops) for x in lins))
+
+  def test_beam_topk(self):
+    search.cost_model = CostModel([0, 0, 1] + [0]*10)
+    try: beam_search(Kernel(self.ast), self.bufs, 2, disable_cache=True, cost_topk=3)
+    finally: search.cost_model = None
+
+  @unittest.skipIf(CACHELEVEL < 2, "needs the diskcache")
+  def test_time_linearizer_records(self):
+    k = Kernel(self.ast)
+    key = {"ast": k.ast.key, "opts": str(k.applied_opts), "device": k.opts.device, "suffix": k.opts.suffix}
+    with patch.object(search, "kernel_features", side_effect=AssertionError("recorded without BEAM_RECORD_FEATURES")):
+      with patch.object(search, "BEAM_RECORD_FEATURES", 0): time_linearizer(k, self.bufs, disable_cache=True)
+    with patch.object(search, "BEAM_RECORD_FEATURES", 1): tm = time_linearizer(k, self.bufs, disable_cache=True)
+    feats, recorded_tm = diskcache_get("kernel_features", key)
+    self.assertEqual(recorded_tm, tm)
+    self.assertEqual(len(feats), 13)
+
+class TestSearchStrategies(unittest.TestCase):
+  def setUp(self):
+    from test.test_linearizer import helper_realized_ast
+    self.ast, self.bufs = helper_realized_ast(Tensor.rand(32, 32) @ Tensor.rand(32, 32))
+
+  def test_strategies(self):
+    random.seed(0)
+    for strategy in ["beam", "mcts", "random"]:
+      with self.subTest(strategy=strategy):
+        k = search_kernel(Kernel(self.ast), self.bufs, 4 if strategy == "beam" else 20, strategy)
+        self.assertGreater(len(k.applied_opts), 0)
+        self.assertNotEqual(time_linearizer(k, self.bufs, disable_cache=True), float('inf'))
+
+  def test_unknown_strategy(self):
+    with self.assertRaises(RuntimeError): search_kernel(Kernel(self.ast), self.bufs, 2, "annealing")
+
+  def test_budget(self):
+    for strategy in search_strategies:
+      with self.subTest(strategy=strategy):
+        # no time to time anything, so the kernel comes back unoptimized
+        k = search_strategies[strategy](Kernel(self.ast), self.bufs, 100, disable_cache=True, deadline=0.0)
+        self.assertEqual(k.applied_opts, [])
+
+  def test_register(self):
+    calls = []
+    def first_action(lin, rawbufs, amt, allow_test_size=True, deadline=None):
+      calls.append(deadline)
+      return list(search.get_kernel_actions(lin, include_0=False).values())[0]
+    search_strategies["first"] = first_action
+    try: k = search_kernel(Kernel(self.ast), self.bufs, 1, "first", budget=10)
+    finally: del search_strategies["first"]
+    self.assertEqual(len(k.applied_opts), 1)
+    self.assertIsNotNone(calls[0])
+
+  @unittest.skipIf(CACHELEVEL < 1, "needs the diskcache")
+  def test_cached(self):
+    random.seed(1)
+    k = search.random_search(Kernel(self.ast), self.bufs, 10, disable_cache=True)
+    key = {"ast": k.ast.key, "amt": 10, "allow_test_size": True, "device": k.opts.device, "suffix": k.opts.suffix}
+    self.assertEqual(diskcache_get("random_search", key), k.applied_opts)
+
+class TestBeamTransfer(unittest.TestCase):
+  def _ast(self, n):
+    from test.test_linearizer import helper_realized_ast
+    return helper_realized_ast(Tensor.rand(n, 40) @ Tensor.rand(40, 56))
+
+  def test_signature(self):
+    self.assertEqual(ast_signature(self._ast(24)[0]), ast_signature(self._ast(48)[0]))
+    self.assertNotEqual(self._ast(24)[0].key, self._ast(48)[0].key)
+    from test.test_linearizer import helper_realized_ast
+    self.assertNotEqual(ast_signature(self._ast(24)[0]), ast_signature(helper_realized_ast(Tensor.rand(24, 40) + 1)[0]))
+
+  @unittest.skipIf(CACHELEVEL < 1, "needs the diskcache")
+  def test_seed(self):
+    ast, bufs = self._ast(24)
+    best = beam_search(Kernel(ast), bufs, 2, disable_cache=True)
+    ast2, bufs2 = self._ast(48)
+    seeds = get_transfer_seeds(Kernel(ast2), 100)
+    self.assertIn(best.applied_opts, [x.applied_opts for x in seeds])
+    self.assertEqual(get_transfer_seeds(Kernel(ast2), 0), [])
+    k = beam_search(Kernel(ast2), bufs2, 2, disable_cache=True, transfer=2)
+    self.assertNotEqual(time_linearizer(k, bufs2, disable_cache=True), float('inf'))
+
 class TestBEAM(unittest.TestCase):
   def test_dynamic_beam(self):
     # TODO: make this infra globally usable
@@ -101,6 +321,31 @@ class TestBEAM(unittest.TestCase):
     if Opt(OptOps.GROUPTOP, 0, 0) in actions:
       assert len([x for x in lins if x.applied_opts[0] == Opt(OptOps.GROUPTOP, axis=0, amt=3)]) == 0, "did not de-dup GROUPTOP"
 
+  def test_default_parallel(self):
+    from tinygrad.engine.search import _default_parallel
+    for device in ["METAL", "GPU", "PYTHON"]: self.assertEqual(_default_parallel(device), 0)
+    self.assertEqual(_default_parallel("CUDA"), multiprocessing.cpu_count())
+    with patch.object(multiprocessing, "cpu_count", return_value=1): self.assertEqual(_default_parallel("CLANG"), 0)
+    with patch.object(multiprocessing, "cpu_count", return_value=8): self.assertEqual(_default_parallel("CLANG"), 8)
+    with patch.object(multiprocessing, "cpu_count", return_value=8): self.assertEqual(_default_parallel("LLVM"), 0)
+
+  def test_default_parallel_compilers_pickle(self):
+    # the compile workers are sent the compiler, so every backend that defaults to them needs one that pickles
+    for device in search.PARALLEL_DEVICES | search.PARALLEL_CPU_DEVICES:
+      try: compiler = Device[device].compiler
+      except Exception: continue
+      with self.subTest(device=device): pickle.dumps(compiler)
+
+  @unittest.skipUnless(Device[Device.DEFAULT].renderer.threads, "test requires cpu threads")
+  def test_beam_threads(self):
+    from test.test_linearizer import helper_realized_ast
+    from tinygrad.engine.search import get_kernel_actions
+    realized_ast, bufs = helper_realized_ast(Tensor.rand(64, 64) @ Tensor.rand(64, 64))
+    lins = get_kernel_actions(Kernel(realized_ast), False).values()
+    self.assertIn(Opt(OptOps.THREAD, 0, 4), [x.applied_opts[0] for x in lins])
+    # times the threaded candidates
+    beam_search(Kernel(realized_ast), bufs, 2)
+
   def test_filter_global_buffer(self):
     # taken from https://github.com/tinygrad/tinygrad/issues/4612
     ast = UOp(UOps.SINK, dtypes.void, arg=None, src=(
@@ -0,0 +1,75 @@
+import unittest, tempfile, os, pickle, sqlite3
+from unittest.mock import patch
+from tinygrad import Tensor, Device
+from tinygrad.codegen.kernel import Kernel, Opt, OptOps
+from tinygrad.engine import realize
+from tinygrad.engine.realize import get_kernel, load_tuned
+from tinygrad.helpers import Context
+from tinygrad.ops import UOps
+from tinygrad.tune import TABLE, tune, merge_tuned, load_asts
+
+def _asts():
+  return [si.ast for si in (Tensor.empty(64, 64) @ Tensor.empty(64, 64)).schedule() + (Tensor.empty(256)+1).schedule() if si.ast.op is UOps.SINK]
+
+class TestTune(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.db = os.path.join(self.tmp.name, "tuned.db")
+  def tearDown(self): self.tmp.cleanup()
+
+  def _rows(self, db):
+    return {(ast, device): pickle.loads(val) for ast, device, _, val in sqlite3.connect(db).execute(f"SELECT * FROM '{TABLE}'").fetchall()}
+
+  def test_load_asts(self):
+    with open(fn:=os.path.join(self.tmp.name, "asts.pkl"), "wb") as f: pickle.dump(_asts()*2, f)
+    self.assertEqual([x.key for x in load_asts(fn)], [x.key for x in _asts()])
+
+  def test_tune(self):
+    self.assertEqual(tune(_asts(), self.db, Device.DEFAULT, 2), 2)
+    rows = self._rows(self.db)
+    self.assertEqual(set(rows), {(x.key, Device.DEFAULT) for x in _asts()})
+    for opts, tm in rows.values():
+      self.assertIsInstance(opts, list)
+      self.assertGreater(tm, 0)
+
+  def test_merge_keeps_faster(self):
+    fast, slow = os.path.join(self.tmp.name, "fast.db"), os.path.join(self.tmp.name, "slow.db")
+    for db, tm, opts in [(fast, 1e-6, [Opt(OptOps.UPCAST, 0, 4)]), (slow, 1e-3, [])]:
+      conn = sqlite3.connect(db)
+      conn.execute(f"CREATE TABLE '{TABLE}' (ast blob, device text, suffix text, val blob, PRIMARY KEY (ast, device, suffix))")
+      conn.execute(f"INSERT INTO '{TABLE}' VALUES (?, ?, ?, ?)", (b"k", "CLANG", "", pickle.dumps((opts, tm))))
+      conn.commit()
+    self.assertEqual(merge_tuned(slow, self.db), 1)
+    self.assertEqual(merge_tuned(fast, self.db), 1)
+    self.assertEqual(merge_tuned(slow, self.db), 0)
+    self.assertEqual(self._rows(self.db)[(b"k", "CLANG")][0], [Opt(OptOps.UPCAST, 0, 4)])
+
+  def test_get_kernel_uses_tuned(self):
+    ast = (Tensor.empty(256)+1).schedule()[-1].ast
+    renderer = Device[Device.DEFAULT].renderer
+    with patch.object(realize, "has_tuned_opts", return_value=True), \
+         patch.object(realize, "diskcache_get", return_value=([Opt(OptOps.UPCAST, 0, 2)], 1e-6)):
+      self.assertEqual(get_kernel(renderer, ast).applied_opts, [Opt(OptOps.UPCAST, 0, 2)])
+      with Context(NOOPT=1): self.assertEqual(get_kernel(renderer, ast).applied_opts, [])
+      # opts that don't fit are ignored
+      with patch.object(realize, "diskcache_get", return_value=([Opt(OptOps.UPCAST, 0, 7)], 1e-6)):
+        self.assertIsNone(load_tuned(Kernel(ast, opts=renderer)))
+
+  def test_no_query_without_tuned(self):
+    k = Kernel((Tensor.empty(256)+1).schedule()[-1].ast)
+    with patch.object(realize, "diskcache_get", side_effect=AssertionError("queried the tuned opts")):
+      with patch.object(realize, "has_tuned_opts", return_value=False): self.assertIsNone(load_tuned(k))
+      with patch.object(realize, "has_tuned_opts", return_value=True), patch.object(realize, "TUNED", 0): self.assertIsNone(load_tuned(k))
+
+  def test_merge_finds_table(self):
+    # the table is only looked for once, merging tuned opts in looks again
+    dst = os.path.join(self.tmp.name, "cache.db")
+    with patch.object(realize, "CACHELEVEL", 1), patch.object(realize, "db_connection", lambda: sqlite3.connect(dst)):
+      realize.has_tuned_opts.cache_clear()
+      self.assertFalse(realize.has_tuned_opts())
+      merge_tuned(self.db, dst)
+      self.assertTrue(realize.has_tuned_opts())
+    realize.has_tuned_opts.cache_clear()
+
+if __name__ == '__main__':
+  unittest.main()
@@ -174,6 +174,23 @@ class TestGraphRewrite(unittest.TestCase):
       self.assertEqual(sink.src[1].op, UOps.CONST)
       self.assertEqual(len([x for x in sink.sparents if x.op is UOps.CONST]), 1)
 
+  def test_combine_like_terms(self):
+    a = UOp(UOps.DEFINE_VAR, dtypes.int, arg=('a', UOp.const(dtypes.int, 0), UOp.const(dtypes.int, 8)))
+    b = UOp(UOps.DEFINE_VAR, dtypes.int, arg=('b', UOp.const(dtypes.int, 0), UOp.const(dtypes.int, 3)))
+    # (a+b)*2 is distributed before the add sees it
+    sink = graph_rewrite((a*32+b)+(a+b)*2, constant_folder)
+    self.assertEqual(sink.arg, BinaryOps.ADD)
+    self.assertEqual([(x.src[0], x.src[1].arg) for x in sink.src], [(a, 34), (b, 3)])
+    sink = graph_rewrite((a*2+b)+(b-a*2), constant_folder)
+    self.assertEqual((sink.arg, sink.src[0], sink.src[1].arg), (BinaryOps.MUL, b, 2))
+
+  def test_combine_like_terms_float(self):
+    a = UOp(UOps.DEFINE_VAR, dtypes.float, arg=('a', UOp.const(dtypes.float, 0), UOp.const(dtypes.float, 8)))
+    b = UOp(UOps.DEFINE_VAR, dtypes.float, arg=('b', UOp.const(dtypes.float, 0), UOp.const(dtypes.float, 3)))
+    # floats aren't combined, a*inf+a*-inf isn't a*nan
+    sink = graph_rewrite((a*2.0+b)+(a*3.0+b), constant_folder)
+    self.assertIs(sink.src[1].src[1], b)
+
 class TestUOpGraph(unittest.TestCase):
   def test_add_constant_fold(self):
     c1 = UOp(UOps.CONST, dtypes.float, arg=1.0)
@@ -374,6 +374,44 @@ class TestUOpMethod(unittest.TestCase):
     self.assertEqual((gidx0*3+6).const_factor(), 3)
     self.assertEqual((gidx0*3+1).const_factor(), 1)
 
+class TestUOpIntern(unittest.TestCase):
+  def test_same_structure_is_same_uop(self):
+    a = UOp(UOps.DEFINE_GLOBAL, PtrDType(dtypes.float), (), 0)
+    self.assertIs(UOp(UOps.DEFINE_GLOBAL, PtrDType(dtypes.float), (), 0), a)
+    self.assertIs(a.cast(dtypes.half) + 2.0, a.cast(dtypes.half) + 2.0)
+    self.assertIs(UOp(UOps.SINK, src=[a]), UOp(UOps.SINK, src=(a,)))
+
+  def test_equal_args_different_types(self):
+    self.assertIsNot(UOp(UOps.CONST, dtypes.float, (), 0.0), UOp(UOps.CONST, dtypes.float, (), -0.0))
+    self.assertIsNot(UOp(UOps.CONST, dtypes.int, (), 1), UOp(UOps.CONST, dtypes.int, (), True))
+    self.assertIsNot(UOp(UOps.VCONST, dtypes.float.vec(2), (), (0.0, 1.0)), UOp(UOps.VCONST, dtypes.float.vec(2), (), (-0.0, 1.0)))
+    self.assertIsNot(UOp(UOps.CONST, dtypes.float, (), 1.0), UOp(UOps.CONST, PtrDType(dtypes.float), (), 1.0))
+
+  def test_unhashable_arg(self):
+    self.assertIsNot(UOp(UOps.NOOP, dtypes.int, (), ["x"]), UOp(UOps.NOOP, dtypes.int, (), ["x"]))
+
+  def test_pickle(self):
+    import pickle
+    a = UOp.const(dtypes.float, 2.0) * UOp(UOps.DEFINE_VAR, dtypes.float, (), ("x", 0, 1))
+    self.assertIs(pickle.loads(pickle.dumps(a)), a)
+
+  def test_threads_same_uop(self):
+    import sys, threading
+    old_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+      for k in range(100):
+        outs: List[UOp] = []
+        barrier = threading.Barrier(8)
+        def _make(k=k):
+          barrier.wait()
+          outs.append(UOp(UOps.CONST, dtypes.int, (), 1000+k))
+        ths = [threading.Thread(target=_make) for _ in range(8)]
+        for t in ths: t.start()
+        for t in ths: t.join()
+        self.assertEqual(len(set(id(x) for x in outs)), 1)
+    finally: sys.setswitchinterval(old_interval)
+
 class TestUOpStr(unittest.TestCase):
   def test_uop_str(self):
     a = UOp(UOps.CONST, dtypes.float, (), 2.0) + UOp(UOps.CONST, dtypes.float, (), 3.0)
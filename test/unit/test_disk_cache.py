@@ -1,6 +1,6 @@
 import unittest
-import pickle
-from tinygrad.helpers import diskcache_get, diskcache_put, diskcache, diskcache_clear
+import pickle, threading
+from tinygrad.helpers import diskcache_get, diskcache_put, diskcache, diskcache_clear, db_connection
 
 def remote_get(table,q,k): q.put(diskcache_get(table, k))
 def remote_put(table,k,v): diskcache_put(table, k, v)
@@ -13,6 +13,19 @@ class DiskCache(unittest.TestCase):
     diskcache_put(table, "hello", "world2")
     self.assertEqual(diskcache_get(table, "hello"), "world2")
 
+  def test_thread_connection(self):
+    # every thread opens its own connection, the main thread's one isn't shared
+    conns = []
+    def _put():
+      diskcache_put("test_thread_connection", "k", 1)
+      conns.append(db_connection())
+    for _ in range(2):
+      (t:=threading.Thread(target=_put)).start()
+      t.join()
+    self.assertIsNot(conns[0], db_connection())
+    self.assertIsNot(conns[0], conns[1])
+    self.assertEqual(diskcache_get("test_thread_connection", "k"), 1)
+
   def test_putcomplex(self):
     table = "test_putcomplex"
     diskcache_put(table, "k", ("complex", 123, "object"))
@@ -1,5 +1,9 @@
-import unittest, subprocess, platform
-from tinygrad.runtime.support.elf import elf_loader
+import unittest, subprocess, platform, ctypes
+from unittest.mock import patch
+from tinygrad.runtime.support.elf import elf_loader, jit_loader
+from tinygrad.runtime import ops_clang
+import tinygrad.runtime.autogen.libc as libc
+from tinygrad.runtime.ops_clang import ClangJITCompiler, ClangProgram, CLANG_JIT
 
 class TestElfLoader(unittest.TestCase):
   def test_load_clang_jit_strtab(self):
@@ -15,5 +19,45 @@ class TestElfLoader(unittest.TestCase):
     section_names = [sh.name for sh in sections]
     assert '.text' in section_names and '.rela.text' in section_names, str(section_names)
 
+@unittest.skipUnless(CLANG_JIT, "needs an ELF host jit_loader can relocate for")
+class TestJitLoader(unittest.TestCase):
+  def test_rodata_and_calls(self):
+    # the constant table lives in .rodata and scale is called through a relocation
+    src = '''
+      float scale(float x) { return x*3.25f; }
+      float lookup(int i) { const float tbl[5] = {1.5f, 2.25f, 7.0f, 9.5f, 11.75f}; return scale(tbl[i]); }
+    '''
+    lib = ClangJITCompiler(cachekey=None).compile(src)
+    self.assertIn("lookup", jit_loader(lib)[1])
+    prg = ClangProgram("lookup", lib)
+    prg.fxn.restype = ctypes.c_float
+    self.assertEqual([prg.fxn(i) for i in range(5)], [x*3.25 for x in [1.5, 2.25, 7.0, 9.5, 11.75]])
+
+  def test_unresolved_symbol(self):
+    obj = subprocess.check_output(('clang', '-x', 'c', '-c', '-fPIC', '-g0', '-', '-o', '-'), input=b"void ext(int); void f(int x) { ext(x); }")
+    with self.assertRaises(RuntimeError): jit_loader(obj)
+
+  def test_compile_batch(self):
+    srcs = [f"int add{i}(int a) {{ return a+{i}; }}" for i in range(4)]
+    lib = ClangJITCompiler(cachekey=None).compile_batch(srcs + srcs[:1])
+    prgs = [ClangProgram(f"add{i}", lib) for i in range(4)]
+    self.assertTrue(all(p.loaded is prgs[0].loaded for p in prgs))
+    for p in prgs: p.fxn.restype = ctypes.c_int
+    self.assertEqual([p.fxn(10) for p in prgs], [10, 11, 12, 13])
+
+  def test_image_not_writable(self):
+    # the image is relocated while writable and then mapped read+exec only
+    prg = ClangProgram("add1", ClangJITCompiler(cachekey=None).compile("int add1(int a) { return a+1; }"))
+    prg.fxn.restype = ctypes.c_int
+    self.assertEqual(prg.fxn(1), 2)
+    with open("/proc/self/maps") as f: perms = [l.split()[1] for l in f if int(l.split("-")[0], 16) == prg.loaded.addr]
+    self.assertEqual(perms, ["r-xp"])
+
+  def test_no_clear_cache(self):
+    # on arm without libgcc's __clear_cache the kernel is linked and dlopened instead
+    with patch.object(ops_clang.platform, "machine", lambda: "aarch64"), patch.object(ops_clang, "clear_icache", lambda: None):
+      lib = ClangJITCompiler(cachekey=None).compile("int add1(int a) { return a+1; }")
+    self.assertNotEqual(libc.Elf64_Ehdr.from_buffer_copy(lib).e_type, libc.ET_REL)
+
 if __name__ == '__main__':
   unittest.main()
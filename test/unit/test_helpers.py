@@ -2,6 +2,7 @@ import gzip, unittest
 from PIL import Image
 from tinygrad.helpers import Context, ContextVar
 from tinygrad.helpers import merge_dicts, strip_parens, prod, round_up, fetch, fully_flatten, from_mv, to_mv, get_contraction, get_shape
+from tinygrad.helpers import LRUCache, memoize, cache_stats, clear_all_caches
 from tinygrad.shape.symbolic import Variable, NumNode
 
 VARIABLE = ContextVar("VARIABLE", 0)
@@ -142,6 +143,43 @@ class TestRoundUp(unittest.TestCase):
     self.assertEqual(round_up(232, 24984), 24984)
     self.assertEqual(round_up(24984, 232), 25056)
 
+class TestMemoTables(unittest.TestCase):
+  def test_lru_evicts_least_recently_used(self):
+    c: LRUCache[int, str] = LRUCache("test_lru", maxsize=2)
+    c[1], c[2] = "a", "b"
+    self.assertEqual(c.get(1), "a")
+    c[3] = "c"
+    self.assertNotIn(2, c)
+    self.assertEqual((c.get(1), c.get(2), c.get(3)), ("a", None, "c"))
+    self.assertEqual(cache_stats()["test_lru"], {"hits": 3, "misses": 1, "maxsize": 2, "size": 2})
+
+  def test_memoize_bounded(self):
+    calls = []
+    @memoize("test_memoize", maxsize=2)
+    def f(x): return calls.append(x) or x
+    for x in [1, 2, 1, 3, 2]: f(x)
+    self.assertEqual(calls, [1, 2, 3, 2])
+    self.assertEqual(cache_stats()["test_memoize"], {"hits": 1, "misses": 4, "maxsize": 2, "size": 2})
+
+  def test_clear_all_caches(self):
+    from tinygrad.shape.view import View
+    View.create((3, 4))
+    self.assertGreater(cache_stats()["View.create"]["size"], 0)
+    clear_all_caches()
+    self.assertEqual(cache_stats()["View.create"], {"hits": 0, "misses": 0, "maxsize": cache_stats()["View.create"]["maxsize"], "size": 0})
+    self.assertEqual(View.create((3, 4)).shape, (3, 4))
+
+  def test_uop_const_bounded(self):
+    import gc, weakref
+    from tinygrad.ops import UOp
+    from tinygrad.dtype import dtypes
+    self.assertIsNotNone(cache_stats()["UOp.const"]["maxsize"])
+    c = weakref.ref(UOp.const(dtypes.int, 123457))
+    # the memo table is the only thing holding the UOp, the intern table lets it go once it's cleared
+    clear_all_caches()
+    gc.collect()
+    self.assertIsNone(c())
+
 @unittest.skip("no fetch tests because they need internet")
 class TestFetch(unittest.TestCase):
   def test_fetch_bad_http(self):
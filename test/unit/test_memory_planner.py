@@ -0,0 +1,84 @@
+import unittest, random, time
+from tinygrad import Device, dtypes
+from tinygrad.device import Buffer
+from tinygrad.engine.realize import best_fit_offsets, _internal_memory_planner
+
+def _overlaps(a, b): return not (a[1] < b[0] or b[1] < a[0])
+
+class TestBestFitOffsets(unittest.TestCase):
+  def check_valid(self, reqs, offsets, total):
+    for i,a in enumerate(reqs):
+      self.assertLessEqual(offsets[i]+a[2], total)
+      for j,b in enumerate(reqs[i+1:], start=i+1):
+        if _overlaps(a, b): self.assertTrue(offsets[i]+a[2] <= offsets[j] or offsets[j]+b[2] <= offsets[i], f"{a}@{offsets[i]} {b}@{offsets[j]}")
+
+  def test_disjoint_lifetimes_share(self):
+    offsets, total = best_fit_offsets([(0, 1, 1024), (2, 3, 1024), (4, 5, 512)])
+    self.assertEqual(offsets, [0, 0, 0])
+    self.assertEqual(total, 1024)
+
+  def test_overlapping_lifetimes(self):
+    reqs = [(0, 2, 1024), (1, 3, 1024), (2, 4, 256)]
+    offsets, total = best_fit_offsets(reqs)
+    self.check_valid(reqs, offsets, total)
+    self.assertEqual(total, 1024+1024+256)
+
+  def test_best_fit_gap(self):
+    # the gap left by the 768 buffer is a better fit than the one left by the 2048 buffer
+    reqs = [(0, 9, 4096), (0, 1, 2048), (0, 9, 1024), (0, 1, 768), (0, 9, 700), (2, 3, 512)]
+    offsets, total = best_fit_offsets(reqs)
+    self.check_valid(reqs, offsets, total)
+    self.assertEqual(offsets[5], offsets[3])
+
+  def test_alignment(self):
+    reqs = [(0, 0, 4), (0, 0, 1000), (0, 0, 2), (0, 0, 300)]
+    offsets, _ = best_fit_offsets(reqs, align=0x100)
+    self.assertEqual(offsets[1] % 0x100, 0)
+    self.assertEqual(offsets[3] % 0x100, 0)
+    self.assertEqual(offsets[0] % 4, 0)
+
+  def test_random(self):
+    random.seed(1337)
+    reqs = [(s:=random.randint(0, 200), s+random.randint(0, 10), random.randint(1, 1<<16)) for _ in range(300)]
+    offsets, total = best_fit_offsets(reqs)
+    self.check_valid(reqs, offsets, total)
+    self.assertLess(total, sum(r[2] for r in reqs))
+
+  def test_long_lifetimes(self):
+    # buffers alive for thousands of steps don't make placing each one walk every step
+    random.seed(1337)
+    reqs = [(s:=random.randint(0, 20000), s+random.randint(0, 5000), random.randint(1, 1<<20)) for _ in range(500)]
+    offsets, total = best_fit_offsets(reqs)
+    self.check_valid(reqs, offsets, total)
+
+  def test_scaling(self):
+    # with short lifetimes each buffer only overlaps a few others, so 4x the buffers over 4x the steps is ~4x the time, not 16x
+    def t(n):
+      random.seed(n)
+      reqs = [(s:=random.randint(0, n), s+random.randint(0, 50), random.randint(1, 1<<20)) for _ in range(n)]
+      ret = []
+      for _ in range(3):
+        st = time.perf_counter()
+        best_fit_offsets(reqs)
+        ret.append(time.perf_counter() - st)
+      return min(ret)
+    self.assertLess(t(8000) / t(2000), 10)
+
+class TestMemoryPlanner(unittest.TestCase):
+  @unittest.skipUnless(hasattr(Device[Device.DEFAULT].allocator, "offset"), "needs offset support for arenas")
+  def test_arena(self):
+    bufs = [Buffer(Device.DEFAULT, sz, dtypes.float32) for sz in [64, 128, 64, 32]]
+    assigned = _internal_memory_planner([[bufs[0], bufs[1]], [bufs[1], bufs[2]], [bufs[2], bufs[3]]])
+    self.assertEqual(len(set(assigned[b].base for b in bufs)), 1)
+    # 0 and 2 are alive at the same step as 1, 3 isn't alive with 0 or 1
+    self.assertEqual(assigned[bufs[0]].base.nbytes, 128*4+64*4)
+    for b in bufs: self.assertEqual((assigned[b].size, assigned[b].dtype), (b.size, b.dtype))
+
+  def test_allocated_not_planned(self):
+    a, b = Buffer(Device.DEFAULT, 16, dtypes.float32).allocate(), Buffer(Device.DEFAULT, 16, dtypes.float32)
+    assigned = _internal_memory_planner([[a], [b]])
+    self.assertNotIn(a, assigned)
+    self.assertIs(assigned[b], b)
+
+if __name__ == '__main__':
+  unittest.main()
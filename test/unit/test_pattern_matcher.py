@@ -67,7 +67,7 @@ class TestPatternMatcher(unittest.TestCase):
   def test_dup_name(self):
     matcher = PatternMatcher([(UPat(UOps.ALU, name="x", src=(UPat(UOps.CONST, name="y"), UPat(UOps.CONST, name="y"))), lambda x, y: x)])
     y1 = UOp(UOps.CONST, dtypes.float, arg=1.0)
-    y2 = UOp(UOps.CONST, dtypes.float, arg=1.0)
+    y2 = UOp(UOps.CONST, dtypes.float, arg=2.0)  # UOps are interned, an equal CONST would be y1
     c1 = UOp(UOps.ALU, dtypes.float, (y1, y1), BinaryOps.ADD)
     c2 = UOp(UOps.ALU, dtypes.float, (y1, y2), BinaryOps.ADD)
     self.assertEqual(matcher.rewrite(c1), c1)
@@ -150,6 +150,48 @@ class TestPatternMatcher(unittest.TestCase):
     self.assertIsNotNone(matcher.rewrite(u1))
     self.assertIsNotNone(matcher.rewrite(u2))
 
+  def test_none_tries_next_pattern(self):
+    calls = []
+    def fxn(a, b):
+      calls.append((a, b))
+      return None
+    c1 = UOp(UOps.CONST, dtypes.float, arg=1.0)
+    c2 = UOp(UOps.CONST, dtypes.float, arg=2.0)
+    matcher = PatternMatcher([
+      (UPat(UOps.ALU, src=[UPat(UOps.CONST, name="a"), UPat(UOps.CONST, name="b")]), fxn),
+      (UPat(UOps.ALU, name="x"), lambda x: x),
+    ])
+    u = UOp(UOps.ALU, dtypes.float, (c1, c2), BinaryOps.ADD)
+    self.assertIs(matcher.rewrite(u), u)
+    # only the first match of a pattern is tried, not the other permutation
+    self.assertEqual(calls, [(c1, c2)])
+
+  def test_repeat_name(self):
+    matcher = PatternMatcher([(UPat(UOps.VECTORIZE, src=UPat(UOps.CAST, src=(UPat(name="x"),)), name="v"), lambda v,x: x)])
+    c1 = UOp(UOps.CONST, dtypes.float, arg=1.0)
+    c2 = UOp(UOps.CONST, dtypes.float, arg=2.0)
+    x1, x2 = UOp(UOps.CAST, dtypes.int, (c1,)), UOp(UOps.CAST, dtypes.int, (c2,))
+    self.assertIs(matcher.rewrite(UOp(UOps.VECTORIZE, dtypes.int.vec(3), (x1, x1, x1))), c1)
+    self.assertIsNone(matcher.rewrite(UOp(UOps.VECTORIZE, dtypes.int.vec(3), (x1, x1, x2))))
+    # with no srcs there's nothing to bind x, the early reject skips it
+    self.assertIsNone(matcher.rewrite(UOp(UOps.VECTORIZE, dtypes.int, ())))
+
+  def test_any_len_fewer_srcs(self):
+    matcher = PatternMatcher([(UPat(UOps.ALU, name="x", src=(UPat(UOps.CONST), UPat(UOps.CONST)), allow_any_len=True), lambda x: x)])
+    c1 = UOp(UOps.CONST, dtypes.float, arg=1.0)
+    c2 = UOp(UOps.ALU, dtypes.float, (c1,), UnaryOps.EXP2)
+    c3 = UOp(UOps.ALU, dtypes.float, (c2,), UnaryOps.EXP2)
+    self.assertIs(matcher.rewrite(c2), c2)
+    self.assertIsNone(matcher.rewrite(c3))
+
+  def test_any(self):
+    matcher = PatternMatcher([(UPat(UOps.ALU, src=(UPat.any(UPat(UOps.CONST, name="c"), UPat(UOps.CAST, name="c")),), name="x"), lambda x,c: c)])
+    c1 = UOp(UOps.CONST, dtypes.float, arg=1.0)
+    c2 = UOp(UOps.CAST, dtypes.float, (c1,))
+    self.assertIs(matcher.rewrite(UOp(UOps.ALU, dtypes.float, (c1,), UnaryOps.EXP2)), c1)
+    self.assertIs(matcher.rewrite(UOp(UOps.ALU, dtypes.float, (c2,), UnaryOps.EXP2)), c2)
+    self.assertIsNone(matcher.rewrite(UOp(UOps.ALU, dtypes.float, (c2.alu(UnaryOps.EXP2),), UnaryOps.EXP2)))
+
   def _assert_eq_upat(self, a:UPat, b:UPat):
     assert (sorted(map(str,a.op)) if a.op else [] == (sorted(map(str,b.op)) if b.op else []))
     assert (sorted(a.dtype) if a.dtype else [] == (sorted(b.dtype) if b.dtype else []))
@@ -0,0 +1,56 @@
+import unittest
+from tinygrad.dtype import dtypes, PtrDType
+from tinygrad.ops import UOp, UOps, BinaryOps, toposort, children_map, reachable
+
+def _chain(depth:int) -> UOp:
+  x = UOp(UOps.DEFINE_VAR, dtypes.int, arg=("x", UOp.const(dtypes.int, 0), UOp.const(dtypes.int, 10)))
+  for i in range(depth): x = x + UOp.const(dtypes.int, i)
+  return x
+
+class TestToposort(unittest.TestCase):
+  def test_srcs_first(self):
+    a, b = UOp.const(dtypes.int, 1), UOp.const(dtypes.int, 2)
+    c = a + b
+    d = UOp(UOps.ALU, dtypes.int, (c, a), BinaryOps.MUL)
+    self.assertEqual(list(toposort(d)), [a, b, c, d])
+    self.assertEqual(list(toposort(b, d)), [b, a, c, d])
+
+  def test_parents_order(self):
+    a, b = UOp.const(dtypes.int, 1), UOp.const(dtypes.int, 2)
+    c = UOp(UOps.ALU, dtypes.int, (a, b), BinaryOps.ADD)
+    d = UOp(UOps.ALU, dtypes.int, (c, b), BinaryOps.MUL)
+    # srcs first, then the parents of each src
+    self.assertEqual(list(d.parents), [c, b, a])
+    self.assertEqual(list(d.sparents), [c, b, a, d])
+
+  def test_deep(self):
+    x = _chain(20000)
+    topo = toposort(x)
+    self.assertEqual(len(topo), 20000*2+1)
+    self.assertEqual(len(x.parents), len(topo)-1)
+    for u in topo: self.assertTrue(all(s in topo for s in u.src))
+
+class TestChildrenReachable(unittest.TestCase):
+  def test_children_map(self):
+    a, b = UOp.const(dtypes.int, 1), UOp.const(dtypes.int, 2)
+    c = a + b
+    d = UOp(UOps.ALU, dtypes.int, (c, c), BinaryOps.MUL)
+    children = children_map(d)
+    self.assertEqual(list(children), list(toposort(d)))
+    self.assertEqual(children[a], [c])
+    self.assertEqual(children[c], [d, d])
+    self.assertEqual(children[d], [])
+
+  def test_reachable(self):
+    buf = UOp(UOps.DEFINE_GLOBAL, PtrDType(dtypes.int), (), 0)
+    a = UOp.const(dtypes.int, 1)
+    st = UOp(UOps.STORE, dtypes.void, (buf, a, a+2))
+    sink = UOp(UOps.SINK, dtypes.void, (st, a*3))
+    children = children_map(sink)
+    self.assertEqual(set(reachable(a, children)), {a+2, a*3, st, sink})
+    self.assertEqual(set(reachable(a, children, lambda u: u.op is not UOps.STORE)), {a+2, a*3, st, sink})
+    self.assertEqual(set(reachable(a, children, lambda u: u.op is UOps.ALU and u.arg is BinaryOps.ADD)), {a+2, a*3, st})
+    self.assertEqual(set(reachable(sink, children)), set())
+
+if __name__ == '__main__':
+  unittest.main()
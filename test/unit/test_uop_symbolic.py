@@ -153,6 +153,11 @@ class TestSymbolic(unittest.TestCase):
     a = Variable("a", 0, 8)
     self.helper_test_variable(a+a, 0, 16, "(a*2)")
 
+  def test_add_like_terms(self):
+    a, b = Variable("a", 0, 8), Variable("b", 0, 3)
+    self.helper_test_variable((a*32+b)+(a*64+b*2), 0, 777, "((a*96)+(b*3))")
+    self.helper_test_variable((a*2+b)+(b-a*2), 0, 6, "(b*2)")
+
   def test_sub_self(self):
     a = Variable("a", 0, 8)
     self.helper_test_variable(a-a, 0, 0, "0")
@@ -4,12 +4,12 @@ from dataclasses import dataclass
 from collections import defaultdict
 from typing import Optional, List, Tuple, cast, Dict, Final, DefaultDict
 
-from tinygrad.ops import TRACK_MATCH_STATS, BinaryOps, UNSAFE_PAD_OPS, KernelInfo, BUFFER_UOPS, UOp, UOps, print_uops, type_verify
+from tinygrad.ops import TRACK_MATCH_STATS, BinaryOps, UNSAFE_PAD_OPS, KernelInfo, BUFFER_UOPS, UOp, UOps, print_uops, type_verify, toposort
 from tinygrad.device import Device
 from tinygrad.renderer import Renderer, TensorCore, Program
 from tinygrad.dtype import ImageDType, PtrDType
 from tinygrad.helpers import _CURRENT_KERNEL, all_same, colored, ansilen, dedup, getenv, prod, DEBUG, TC_OPT, USE_TC, AMX, round_up, all_int, \
-                             get_contraction, to_function_name, diskcache_put, ContextVar
+                             get_contraction, to_function_name, diskcache_put, ContextVar, THREAD_OPT
 from tinygrad.shape.shapetracker import ShapeTracker
 from tinygrad.shape.symbolic import Variable, sint
 from tinygrad.shape.view import strides_for_shape
@@ -19,7 +19,7 @@ from enum import Enum, auto
 
 class OptOps(Enum):
   TC = auto(); UPCAST = auto(); UPCASTMID = auto(); UNROLL = auto(); LOCAL = auto() # noqa: E702
-  GROUP = auto(); GROUPTOP = auto(); NOLOCALS = auto(); PADTO = auto(); SWAP = auto() # noqa: E702
+  GROUP = auto(); GROUPTOP = auto(); NOLOCALS = auto(); PADTO = auto(); SWAP = auto(); THREAD = auto() # noqa: E702
   def __lt__(self, x:OptOps): return self.value < x.value
 
 class KernelOptError(Exception): pass
@@ -62,9 +62,7 @@ class Kernel:
       print(self.ast)
       raise e
 
-    @functools.lru_cache(None)
-    def ordered_parents(op:UOp) -> List[UOp]: return dedup([item for x in op.src for item in ordered_parents(x)] + [op])
-    self.reduceops = dedup([x for x in ordered_parents(self.ast) if x.op is UOps.REDUCE_AXIS])
+    self.reduceops = [x for x in toposort(self.ast) if x.op is UOps.REDUCE_AXIS]
 
     self.vars: List[Variable] = self.ast.variables()
     self.bufs: List[UOp] = [x for x in self.ast.parents if x.op in BUFFER_UOPS]
@@ -99,6 +97,7 @@ class Kernel:
     # the local aliased buffers for A and B
     self.bufs_for_tensor_core: Dict[UOp, Tuple[int, int]] = {}
     self.dont_use_locals: bool = False
+    self.threaded: bool = False
 
     # group simplifies
     self.simplify_ones()
@@ -116,8 +115,8 @@ class Kernel:
     ret.sts = self.sts[:len(ret.bufs)+len(ret.reduceops)*2] # NOTE: must redo the local buffers with TC in beam
 
     # parameters for optimizations
-    ret.applied_opts, ret.group_for_reduces, ret.upcasted, ret.local_dims, ret.dont_use_locals = \
-      self.applied_opts[:], self.group_for_reduces, self.upcasted, self.local_dims, self.dont_use_locals
+    ret.applied_opts, ret.group_for_reduces, ret.upcasted, ret.local_dims, ret.dont_use_locals, ret.threaded = \
+      self.applied_opts[:], self.group_for_reduces, self.upcasted, self.local_dims, self.dont_use_locals, self.threaded
     ret.tensor_core, ret.tensor_core_opts, ret.bufs_for_tensor_core, ret.use_tensor_cores = \
       self.tensor_core, self.tensor_core_opts, self.bufs_for_tensor_core, self.use_tensor_cores
 
@@ -164,6 +163,9 @@ class Kernel:
   @property
   def global_dims(self) -> int: return self.first_reduce-self.local_dims
 
+  @property
+  def uses_threads(self) -> bool: return self.threaded and self.global_dims > 0  # the thread axis can be upcasted away
+
   # there's eight chunks of the shape
   # blue   -- global dims
   # cyan   -- local dims (warp ones first)
@@ -454,8 +456,15 @@ class Kernel:
       check(self.opts.has_local and not self.dont_use_locals, "NOLOCALS is meaningless if target does not support local or already not using locals")
       check(self.local_dims == 0 and self.group_for_reduces == 0, "can't have no locals with locals")
       self.dont_use_locals = True
+    elif opt.op is OptOps.THREAD:
+      check(self.opts.threads > 0, "target does not run on cpu threads")
+      check(not self.threaded, "already threaded")
+      check(axis < self.global_dims, "thread is for globals")
+      self.shift_to(axis, amt, top=True, insert_before=0)
+      self.threaded = True
     elif opt.op is OptOps.SWAP:
       check(axis < amt and amt < self.global_dims, f"swap is only for globals with axis < amt, getting {amt=}, {axis=}, {self.global_dims=}")
+      check(not self.threaded or axis != 0, "can't swap the thread axis")
       permute = list(range(self.shape_len))
       permute[axis], permute[amt] = permute[amt], permute[axis]
       self.reshape_and_permute(None, tuple(permute))
@@ -593,6 +602,16 @@ class Kernel:
       if self.upcasted == 0 and self.full_unupcasted_shape and self.full_unupcasted_shape[-1] % splits == 0:
         self.apply_opt(Opt(OptOps.UPCAST, len(self.full_unupcasted_shape)-1, splits))
 
+    # **** cpu threads ****
+
+    # split a global across as many threads as divide it, if there's enough work to pay for waking them up
+    # opt-in: ClangGraph can't batch threaded kernels, so by default only BEAM picks THREAD when it's faster
+    if THREAD_OPT and self.opts.threads > 1 and all_int(self.full_shape) and prod(self.full_shape) >= 0x10000:
+      for amt, axis in itertools.product(range(self.opts.threads, 1, -1), range(self.global_dims)):
+        if self.full_shape[axis] % amt == 0:
+          self.apply_opt(Opt(OptOps.THREAD, axis, amt))
+          break
+
     # **** local groups ****
 
     if self.opts.has_local:
@@ -733,7 +752,7 @@ class Kernel:
           return UOp(UOps.LOAD, op.dtype, (local_buffer, st_uop, UOp.store(local_buffer, st_uop, grouped_reduce)))
         arg = (alu_op, axis)
       elif op.op is UOps.SINK:
-        arg = KernelInfo(self.local_dims, self.upcasted, self.dont_use_locals)
+        arg = KernelInfo(self.local_dims, self.upcasted, self.dont_use_locals, self.uses_threads)
       return op.replace(src=tuple(fixup_ast(x, apply_to_st) for x in op.src), arg=arg)
     return fixup_ast(self.ast)
 
@@ -772,7 +791,8 @@ class Kernel:
       for _, group in itertools.groupby([x for x in self.ast.parents if x.op in BUFFER_UOPS and x.src[0].op is UOps.DEFINE_GLOBAL],
                         key=lambda x: (x.op, x.src[0].arg)))
     return Program(ansiname, src, self.opts.device, self.uops, mem_estimate=mem_bytes,
-                   global_size=[1,1,1] if self.opts.has_local else None, local_size=[1,1,1] if self.opts.has_local else None)
+                   global_size=[1,1,1] if self.opts.has_local or self.uses_threads else None,
+                   local_size=[1,1,1] if self.opts.has_local or self.uses_threads else None)
 
 # the living definition of intermediate UOps
 
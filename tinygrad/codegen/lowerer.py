@@ -64,6 +64,8 @@ class IndependentLowerer:
       # all loops are RANGES
       self.idxs = [UOp(UOps.RANGE, dtypes.pyint, (UOp.const(dtypes.pyint, 0), variable_to_uop(g)), (i, False))
                    for i,g in enumerate(full_shape[:first_reduce])]
+      # the first global is the cpu core id
+      if ki.threaded: self.idxs[0] = UOp(UOps.SPECIAL, dtypes.pyint, (), ("gidx0", full_shape[0]))
 
     # reduce loops
     self.idxs += [UOp(UOps.RANGE, dtypes.pyint, (UOp.const(dtypes.pyint, 0), variable_to_uop(g)), (i, True))
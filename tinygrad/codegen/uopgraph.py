@@ -1,10 +1,10 @@
 from __future__ import annotations
-from typing import Optional, Tuple, Dict, List, Set, cast, TYPE_CHECKING, Any, DefaultDict, Callable
+from typing import Optional, Tuple, Dict, List, Set, cast, TYPE_CHECKING, Any, DefaultDict, Callable, Iterator
 import functools, itertools, heapq, math, operator
 from collections import defaultdict
 from tinygrad.dtype import dtypes, PtrDType, ImageDType, ConstType
 from tinygrad.ops import UnaryOps, BinaryOps, exec_alu, UOp, UOps, END_FOR_UOP, type_verify, print_uops, identity_element
-from tinygrad.ops import UPat, PatternMatcher, graph_rewrite
+from tinygrad.ops import UPat, PatternMatcher, graph_rewrite, children_map, reachable
 from tinygrad.helpers import DEBUG, getenv, flatten, dedup, TRANSCENDENTAL, AMX, prod, CI, partition, all_same
 from tinygrad.codegen.transcendental import xexp2, xlog2, xsin, TRANSCENDENTAL_SUPPORTED_DTYPES
 if TYPE_CHECKING: from tinygrad.renderer import Renderer
@@ -146,6 +146,20 @@ def lt_folding(x:UOp, c:int) -> Optional[UOp]:
   if (newx:=div_folding(x,c)) is not None and newx.op is UOps.ALU and newx.arg is BinaryOps.IDIV: return newx.src[0].lt(newx.src[1])
   return cast(UOp, x.divides(g)).lt(c//g) if ((g:=math.gcd(x.const_factor(), c)) > 1) else None
 
+def _terms(x:UOp) -> Iterator[Tuple[UOp, ConstType]]:
+  for u in _get_chain(x, BinaryOps.ADD):
+    yield (u.src[0], u.src[1].arg) if u.op is UOps.ALU and u.arg is BinaryOps.MUL and u.src[1].op is UOps.CONST else (u, 1)
+
+def combine_terms(x:UOp, y:UOp) -> Optional[UOp]:
+  # x+y where y is a sum (eg. from (a+b)*c -> a*c+b*c) that has a term of x, (a*c0+b)+(a*c1+b*c2) -> a*(c0+c1)+b*(1+c2)
+  # a normal index chain is ((a+b)+c)+d, its y is never a sum so this doesn't walk it for every ADD in it
+  yterms = list(_terms(y))
+  ys = {t for t,_ in yterms}
+  if not any(t in ys for t,_ in _terms(x)): return None
+  terms: Dict[UOp, ConstType] = {}
+  for t,c in itertools.chain(_terms(x), yterms): terms[t] = terms.get(t, 0) + c
+  return functools.reduce(operator.add, [t if c == 1 else t*c for t,c in terms.items() if c != 0], x.const_like(0))
+
 def fold_unrolled_divs(divs:UOp):
   # div pattern in unrolled arange
   # example: (x//4+(x+1)//4+(x+2)//4+(x+3)//4 -> x
@@ -431,6 +445,8 @@ constant_folder = PatternMatcher([
   (UPat.var("x") * UPat.cvar("c0") + UPat.var("x") * UPat.cvar("c1"), lambda x,c0,c1: x*(c0+c1)), # (x*c0)+(x*c1) -> x*(c0+c1)
   (UPat.var("x") + UPat.var("x") * UPat.cvar("c"), lambda x,c: x*(c+1)), # (x+x*c)-> x*(c+1)
   (UPat.var("x") + UPat.var("x"), lambda x: x*2), # (x+x)-> x*2
+  (UPat(UOps.ALU, arg=BinaryOps.ADD, src=(UPat.var("x"), UPat(UOps.ALU, arg=BinaryOps.ADD, name="y"))),
+   lambda x,y: combine_terms(x, y) if dtypes.is_int(x.dtype) else None),
   ((UPat.var("x") // UPat.cvar("c0")) // UPat.cvar("c1"), lambda x,c0,c1: x//(c0*c1)), # (x//c0)//c1 -> x//(c0*c1)
   ((UPat.var("x") / UPat.var("x2")) / UPat.var("x3"), lambda x,x2,x3: x/(x2*x3)), # (x/x2)/x3 -> x/(x2*x3)
   (-1 * (UPat.var("x") + UPat.var("y")), lambda x,y: (-x)+(-y)),  # -(x+y) -> -x + -y
@@ -651,59 +667,47 @@ no_pyint = PatternMatcher([(UPat((UOps.CONST, UOps.VCONST, UOps.ALU, UOps.SPECIA
 
 # *** uop graph ***
 
-def get_children_dfs(u:UOp, children:Dict[UOp, List[UOp]], srcs:Dict[UOp, Dict[UOp, None]], in_degree:Dict[UOp, int]):
-  if u in children: return srcs[u]
-  srcs[u] = {}
-  children[u] = []
-  for x in u.src:
-    srcs[u].update(get_children_dfs(x, children, srcs, in_degree))
-    if x.op is UOps.RANGE and x.arg[1]: srcs[u][x] = None
-    children[x].append(u)
-  in_degree[u] = len(u.src)
-  return srcs[u]
-
 linearize_cnt = 0
+def graph_rewrite_passes(opts:Optional[Renderer]=None, expand:bool=True) -> List[Tuple[str, PatternMatcher]]:
+  folder = constant_folder + transcendental_folding(tuple() if TRANSCENDENTAL >= 2 or opts is None else tuple(opts.code_for_op.keys()))
+  # fold, then rewrite pyint to int32
+  ret = [("folder", folder), ("no_pyint", no_pyint)]
+  if expand:
+    ret.append(("expander", folder+expander))
+    if getenv("DO_REDUCE", 1):
+      ret += [("just_reduce", folder+just_reduce),
+              ("devectorize", folder+(devectorize+float4_folding if opts is not None and opts.supports_float4 else devectorize)),
+              ("reducer", folder+reducer)]
+  # for PTX only
+  if opts is not None and opts.extra_matcher is not None: ret.append(("extra_matcher", folder+opts.extra_matcher))
+  return ret
+
 def full_graph_rewrite(sink:UOp, opts:Optional[Renderer]=None) -> UOp:
   global linearize_cnt, acc_number
   assert sink.op is UOps.SINK, f"sink isn't sink, it's {sink.op}"
-  folder = constant_folder + transcendental_folding(tuple() if TRANSCENDENTAL >= 2 or opts is None else tuple(opts.code_for_op.keys()))
-
-  # do graph rewrite
   acc_number = 0
-  sink = graph_rewrite(sink, folder)
-
-  # rewrite pyint to int32
-  sink = graph_rewrite(sink, no_pyint)
-
-  # expand
   linearize_cnt += 1
-  if linearize_cnt != (de:=getenv("DEBUG_EXPAND", 0)) and de != -1:
-    sink = graph_rewrite(sink, folder+expander)
-    if getenv("DO_REDUCE", 1):
-      sink = graph_rewrite(sink, folder+just_reduce)
-      sink = graph_rewrite(sink, folder+(devectorize+float4_folding if opts is not None and opts.supports_float4 else devectorize))
-      sink = graph_rewrite(sink, folder+reducer)
-
-  # for PTX only
-  if opts is not None and opts.extra_matcher is not None: sink = graph_rewrite(sink, folder+opts.extra_matcher)
+  for _,pm in graph_rewrite_passes(opts, linearize_cnt != (de:=getenv("DEBUG_EXPAND", 0)) and de != -1): sink = graph_rewrite(sink, pm)
   return sink
 
 def linearize_uop(sink:UOp, skip_check:bool=not __debug__) -> List[UOp]:
   assert sink.op is UOps.SINK, f"sink isn't sink, it's {sink.op}"
   # filter nodes that don't link to a sink
   # BFS toposort
-  children: Dict[UOp, List[UOp]] = {}
+  children = children_map(sink)
+  in_degree = {u:len(u.src) for u in children}
   range_srcs: Dict[UOp, Dict[UOp, None]] = {}
-  in_degree: Dict[UOp, int] = {}
-  get_children_dfs(sink, children, range_srcs, in_degree)
-
-  @functools.lru_cache(None)
-  def get_recursive_children(x:UOp, end:UOps, include_self=False) -> Set[UOp]:
-    if x.op is UOps.SINK: return set()
-    return set.union({x} if include_self else set(), *([get_recursive_children(u, end, True) for u in children[x] if x.op is not end]))
+  for u in children:
+    range_srcs[u] = {}
+    for x in u.src:
+      range_srcs[u].update(range_srcs[x])
+      if x.op is UOps.RANGE and x.arg[1]: range_srcs[u][x] = None
 
   # scope children impact the toposort and END* insertion
-  scope_children = {p:get_recursive_children(p, END_FOR_UOP[p.op][0]) for p in reversed(in_degree) if p.op in END_FOR_UOP}
+  def get_scope_children(p:UOp) -> Set[UOp]:
+    end = END_FOR_UOP[p.op][0]
+    return {u for u in reachable(p, children, lambda u: u.op is not end and u.op is not UOps.SINK) if u.op is not UOps.SINK}
+  scope_children = {p:get_scope_children(p) for p in reversed(children) if p.op in END_FOR_UOP}
   range_phi = {r:[p for p in scope_children[r] if p.op is UOps.ASSIGN] for r in scope_children if r.op is UOps.RANGE}
 
   queue:List[Tuple[int, UOp]] = []
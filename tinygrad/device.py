@@ -2,6 +2,7 @@ from __future__ import annotations
 import multiprocessing, decimal, statistics, random
 from dataclasses import dataclass
 from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import List, Optional, Dict, Tuple, Any, cast, Protocol, Type
 import importlib, inspect, functools, pathlib, os, ctypes, atexit, time, contextlib, array
 from tinygrad.helpers import SAVE_SCHEDULE, getenv, diskcache_get, diskcache_put, DEBUG, GlobalCounters, flat_mv, from_mv, ProfileLogger, PROFILE
@@ -55,6 +56,7 @@ class Buffer:
     assert isinstance(dtype, DType)
     if isinstance(dtype, ImageDType): options = BufferOptions(image=dtype) # TODO: image hack shouldn't be here. where should it be?
     self.device, self.size, self.dtype, self.options, self.offset = device, size, dtype, options, offset
+    self._event: Optional[Future] = None  # the last queued work that used this (base) buffer
     if base is None:
       assert offset == 0, "base buffers can't have offset"
       self._base = None
@@ -106,7 +108,11 @@ class Buffer:
     return f"<buf real:{hasattr(self, '_buf')} device:{self.device} size:{self.size} dtype:{self.dtype}" + \
            (f" offset:{self.offset}" if hasattr(self, "base") else "") + \
            (">" if self.options is None else f" {self.options=}>")
+  def wait(self) -> Buffer:
+    if (ev:=self.base._event) is not None: ev.result()
+    return self
   def as_buffer(self, allow_zero_copy=False, force_zero_copy=False) -> memoryview:
+    self.wait()
     # zero copy with as_buffer (disabled by default due to use after free)
     if (force_zero_copy or allow_zero_copy) and hasattr(self.allocator, 'as_buffer'): return self.allocator.as_buffer(self._buf)
     assert not force_zero_copy, "force zero copy was passed, but copy is required"
@@ -115,13 +121,13 @@ class Buffer:
     mv = flat_mv(mv)
     assert len(mv) == self.nbytes, f"size mismatch, {len(mv)=} != {self.dtype=} {self.size=}"
     assert self.is_allocated(), "can't copyin to unallocated buffer"
-    self.allocator.copyin(self._buf, mv)
+    self.wait().allocator.copyin(self._buf, mv)
     return self
   def copyout(self, mv:memoryview) -> memoryview:
     mv = flat_mv(mv)
     assert len(mv) == self.nbytes, f"size mismatch, {len(mv)=} != {self.dtype=} {self.size=}"
     assert self.is_allocated(), "can't copyout unallocated buffer"
-    self.allocator.copyout(mv, self._buf)
+    self.wait().allocator.copyout(mv, self._buf)
     return mv
   def view(self, size:int, dtype:DType, offset:int) -> Buffer:
     assert offset < self.nbytes, "offset must be less than nbytes"
@@ -169,6 +175,19 @@ class _MallocAllocator(LRUAllocator):
 
 MallocAllocator = _MallocAllocator()
 
+class CPUQueue:
+  """
+  Runs work in order on one background thread, for devices whose programs run on the calling thread.
+
+  With CPU_ASYNC=1 kernels are queued here and the buffers they use hold the returned future, so copyout waits on only what it needs.
+  """
+  def __init__(self, device:str): self.pool, self.last = ThreadPoolExecutor(1, thread_name_prefix=f"{device}_queue"), cast(Optional[Future], None)
+  def submit(self, fxn, *args) -> Future:
+    self.last = self.pool.submit(fxn, *args)
+    return self.last
+  def synchronize(self):
+    if self.last is not None: self.last.result()
+
 # **************** for Compiled Devices ****************
 
 class CompileError(Exception): pass
@@ -182,6 +201,9 @@ class Compiler:
       lib = self.compile(src)
       if self.cachekey is not None: diskcache_put(self.cachekey, src, lib)
     return lib
+  def compile_batch(self, srcs:List[str]) -> Optional[bytes]:
+    """Compiles all of `srcs` into one library the runtime loads each function from by name, None if this compiler can't."""
+    return None
 
 class Compiled:
   def __init__(self, device:str, allocator:Allocator, renderer:Optional[Renderer], compiler:Optional[Compiler], runtime, graph=None):
@@ -1,7 +1,7 @@
 import os, atexit, functools, contextlib
 from collections import defaultdict
 from typing import List, Any, DefaultDict
-from tinygrad.ops import UnaryOps, BinaryOps, ReduceOps, MetaOps, TernaryOps, UOps, UOp
+from tinygrad.ops import UnaryOps, BinaryOps, ReduceOps, MetaOps, TernaryOps, UOps, UOp, toposort
 from tinygrad.device import Device
 from tinygrad.helpers import GRAPHPATH, DEBUG, GlobalCounters
 from tinygrad.lazy import LazyBuffer
@@ -86,4 +86,4 @@ def graph_uops(uops:List[UOp]):
     for v in u.src: G.add_edge(uops.index(v), uops.index(u))
   save_graph(G, f'{GRAPHPATH}.{graph_uops_cnt}.uops', '-Grankdir=LR')
   graph_uops_cnt += 1
-def graph_uop(uop:UOp): return graph_uops(list(uop.sparents))
+def graph_uop(uop:UOp): return graph_uops(list(toposort(uop)))
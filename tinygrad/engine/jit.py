@@ -1,17 +1,17 @@
 from __future__ import annotations
 from typing import TypeVar, Generic, Callable, List, Tuple, Union, Dict, cast, Optional, Any
-import functools, itertools, collections
+import functools, itertools, collections, pickle, mmap, struct, io, ctypes, pathlib
 from tinygrad.tensor import Tensor
 from tinygrad.lazy import LazyBuffer
-from tinygrad.helpers import flatten, merge_dicts, DEBUG, Context, GRAPH, BEAM, getenv, all_int, colored, JIT, dedup, partition
-from tinygrad.device import Buffer, Compiled, Device
+from tinygrad.helpers import flatten, merge_dicts, DEBUG, Context, GRAPH, BEAM, getenv, all_int, colored, JIT, dedup, partition, round_up
+from tinygrad.device import Buffer, Compiled, Device, MallocAllocator
 from tinygrad.dtype import DType
 from tinygrad.shape.shapetracker import ShapeTracker
 from tinygrad.shape.symbolic import Variable, sint, sym_infer
 from tinygrad.engine.realize import ExecItem, capturing, EmptyOp, ViewOp, BufferXfer, CompiledRunner, Runner, _internal_memory_planner
 from tinygrad.nn.state import get_parameters
-from dataclasses import dataclass
-from weakref import WeakKeyDictionary
+from dataclasses import dataclass, replace
+from weakref import WeakKeyDictionary, WeakSet
 
 class GraphException(Exception): pass
 
@@ -128,6 +128,8 @@ class MultiGraphRunner(GraphRunner):  # pylint: disable=abstract-method
     return list({id(x):x for x in wait_nodes}.values())
 
 ReturnType = TypeVar('ReturnType')
+JIT_ARTIFACT_MAGIC, JIT_ARTIFACT_VERSION = b"tinyjit\0", 1
+
 @dataclass
 class CapturedJit(Generic[ReturnType]):
   ret: Any  # includes the Tensors or any other returned object
@@ -168,6 +170,65 @@ class CapturedJit(Generic[ReturnType]):
     self._clear_inputs()
     return self.ret
 
+  # *** artifacts: the captured jit with its compiled programs and buffers, runnable without tracing or compiling ***
+
+  def save(self, fn:Union[str, pathlib.Path]):
+    buffers: Dict[Buffer, int] = {}
+    runners: Dict[CompiledRunner, int] = {}
+    def persistent_id(x):
+      if isinstance(x, CompiledRunner): return ("p", runners.setdefault(x, len(runners)))
+      if not isinstance(x, Buffer): return None
+      if x not in buffers:
+        if x._base is not None: persistent_id(x._base)
+        buffers[x] = len(buffers)
+      return ("b", buffers[x])
+    pickler = pickle.Pickler(graph:=io.BytesIO())
+    pickler.persistent_id = persistent_id  # type: ignore[method-assign]
+    pickler.dump((self.ret, self.jit_cache, self.input_replace, self.extra_view_inputs, self.expected_names, self.expected_st_vars_dtype_device))
+
+    # libs and buffer contents go in the blob, the tables only hold their (offset, size)
+    chunks: List[Union[bytes, memoryview]] = []
+    blob_size = 0
+    def add_chunk(x:Union[bytes, memoryview]) -> Tuple[int, int]:
+      nonlocal blob_size
+      chunks.append(x)
+      blob_size = (off:=blob_size) + round_up(len(x), 0x40)
+      return off, len(x)
+    buffer_table = [(b.device, b.size, b.dtype, b.options, None if b._base is None else buffers[b._base], b.offset, b.lb_refcount, b.is_allocated(),
+                     add_chunk(b.as_buffer()) if b._base is None and b.is_allocated() else None) for b in buffers]
+    program_table = [(replace(r.p, uops=None), r.p.op_estimate, r.p.lds_estimate, add_chunk(r.lib)) for r in runners]
+    header = pickle.dumps((buffer_table, program_table, graph.getvalue()))
+    with open(fn, "wb") as f:
+      f.write(JIT_ARTIFACT_MAGIC + struct.pack("<IQ", JIT_ARTIFACT_VERSION, len(header)) + header)
+      # the blob is page aligned, so host buffers can be mapped straight from the file
+      f.write(b"\0" * (round_up(f.tell(), mmap.PAGESIZE) - f.tell()))
+      for c in chunks: f.write(c), f.write(b"\0" * (round_up(len(c), 0x40) - len(c)))
+
+  @staticmethod
+  def load(fn:Union[str, pathlib.Path]) -> CapturedJit:
+    with open(fn, "rb") as f: mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    if mm[:len(JIT_ARTIFACT_MAGIC)] != JIT_ARTIFACT_MAGIC: raise RuntimeError(f"{fn} is not a jit artifact")
+    version, header_len = struct.unpack_from("<IQ", mm, st:=len(JIT_ARTIFACT_MAGIC))
+    if version != JIT_ARTIFACT_VERSION: raise RuntimeError(f"{fn} is a version {version} jit artifact, expected {JIT_ARTIFACT_VERSION}")
+    buffer_table, program_table, graph = pickle.loads(mm[(st:=st+struct.calcsize("<IQ")):st+header_len])
+    blob = round_up(st+header_len, mmap.PAGESIZE)
+
+    buffers: List[Buffer] = []
+    for device, size, dtype, options, base, offset, lb_refcount, allocated, data in buffer_table:
+      if base is not None: buffers.append(buf:=Buffer(device, size, dtype, base=buffers[base], offset=offset))
+      else: buffers.append(buf:=Buffer(device, size, dtype, options=options, lb_refcount=lb_refcount))
+      if data is not None:
+        if Device[device].allocator is MallocAllocator: buf.allocate((ctypes.c_uint8 * data[1]).from_buffer(mm, blob+data[0]))
+        else: buf.allocate().copyin(memoryview(mm)[blob+data[0]:blob+data[0]+data[1]])
+      elif allocated: buf.allocate()
+    runners: List[CompiledRunner] = []
+    for p, op_estimate, lds_estimate, (lib_off, lib_len) in program_table:
+      p._ops_lds = (op_estimate, lds_estimate)
+      runners.append(CompiledRunner(p, precompiled=mm[blob+lib_off:blob+lib_off+lib_len]))
+    unpickler = pickle.Unpickler(io.BytesIO(graph))
+    unpickler.persistent_load = lambda pid: buffers[pid[1]] if pid[0] == "b" else runners[pid[1]]  # type: ignore[method-assign]
+    return CapturedJit(*unpickler.load())
+
 def _prepare_jit_inputs(args, kwargs):
   input_tensors: List[Tuple[Union[int, str], Tensor]] = \
     [(cast(Union[int, str], name),t) for name,t in itertools.chain(enumerate(args), sorted(kwargs.items())) if t.__class__ is Tensor]
@@ -183,16 +244,31 @@ def _prepare_jit_inputs(args, kwargs):
   return input_buffers, var_vals, names, st_vars_dtype_device
 
 class TinyJit(Generic[ReturnType]):
-  def __init__(self, fxn:Optional[Callable[..., ReturnType]], captured:Optional[CapturedJit]=None, prune=False):
+  def __init__(self, fxn:Optional[Callable[..., ReturnType]], captured:Optional[CapturedJit]=None, prune=False, max_captured=1,
+               buckets:Optional[List[int]]=None, bucket_axis=0, bucket_pad:float=0.0, bucket_shrink:Optional[Tuple[bool, ...]]=None,
+               bucket_args:Optional[Tuple[Union[int, str], ...]]=None):
     assert fxn or captured, "need either a function or a CapturedJit"
     self.fxn = fxn
-    self.captured: Optional[CapturedJit] = captured
+    # with buckets, the inputs are padded on bucket_axis up to the next bucket so there's at most one capture per bucket. see _call_bucketed
+    self.buckets, self.bucket_axis = sorted(buckets) if buckets is not None else None, bucket_axis
+    self.bucket_pad, self.bucket_shrink, self.bucket_args = bucket_pad, bucket_shrink, bucket_args
+    if self.buckets is not None: max_captured = max(max_captured, len(self.buckets))
+    self.prune, self.max_captured, self.hits, self.misses = prune, max_captured, 0, 0
+    # the captured jits by input signature, least recently used first. with max_captured=1 a different signature is an error
+    self.captured_cache: collections.OrderedDict[Tuple, CapturedJit] = collections.OrderedDict()
+    self.captured: Optional[CapturedJit] = None  # the last one that ran
+    if captured is not None: self._add_captured(captured)
     self.cnt: int = 2 if self.fxn is None else 0
-    self.prune = prune
+
+  def _add_captured(self, captured:CapturedJit):
+    self.captured = self.captured_cache[(tuple(captured.expected_names), tuple(captured.expected_st_vars_dtype_device))] = captured
+    while len(self.captured_cache) > self.max_captured: self.captured_cache.popitem(last=False)
 
   def add_buffer(self, b:Buffer) -> Buffer:
     if found:=self._buffer_replace.get(b, None): return found
-    if b.is_allocated() or b.lb_refcount > 0: return b
+    if b.is_allocated() or b.lb_refcount > 0:
+      if not b.is_allocated() and b._base is None: self._realized.add(b)
+      return b
     if b._base is not None:
       self._buffer_replace[b] = ret = Buffer(b.device, b.size, b.dtype, base=self.add_buffer(b._base), offset=b.offset)
     else:
@@ -206,6 +282,7 @@ class TinyJit(Generic[ReturnType]):
     assert self.fxn is not None, "can't reset without function"
     self.cnt = 0
     self.captured = None
+    self.captured_cache.clear()
 
   def __reduce__(self):
     assert self.captured is not None, "can't pickle an uncaptured JIT"
@@ -219,20 +296,76 @@ class TinyJit(Generic[ReturnType]):
 
   def __get__(self, obj, objtype): return functools.partial(self.__call__, obj) # add support for instance methods
 
+  def _call_bucketed(self, *args, **kwargs) -> ReturnType:
+    """
+    Pads every input Tensor on `bucket_axis` with `bucket_pad` up to the next bucket, runs the capture for that bucket, and slices the outputs back.
+    `bucket_args` picks which inputs (positions of args, names of kwargs) are padded, so weights or masks without the batch axis are passed as is.
+
+    The function must treat the rows on `bucket_axis` independently: a reduction over that axis also sees the padded rows. `bucket_pad` can
+    make some of them neutral (0 for sum, -inf for max), a mean over the bucket axis is always wrong.
+    Outputs are per-row along `bucket_axis`: every output Tensor that is the bucket size on that axis is sliced back. `bucket_shrink` picks which of
+    the returned values (the elements of a returned tuple or list, or the single returned value) are sliced, so other outputs that happen to be the
+    bucket size stay whole.
+    """
+    assert self.buckets is not None
+    inputs: Dict[Union[int, str], Any] = {**dict(enumerate(args)), **cast(Dict[Union[int, str], Any], kwargs)}
+    if self.bucket_args is None: bucketed = {k for k,x in inputs.items() if isinstance(x, Tensor)}
+    elif (bad:=[k for k in self.bucket_args if not isinstance(inputs.get(k), Tensor)]): raise ValueError(f"bucket_args {bad} aren't Tensor inputs")
+    else: bucketed = set(self.bucket_args)
+    if (bad:=[k for k in bucketed if inputs[k].ndim <= self.bucket_axis]): raise ValueError(f"bucketed inputs {bad} have no axis {self.bucket_axis}")
+    sizes = {inputs[k].shape[self.bucket_axis] for k in bucketed}
+    if len(sizes) != 1 or not isinstance(sz:=next(iter(sizes)), int):
+      raise ValueError(f"bucketed JIT needs one int size on axis {self.bucket_axis}, got {sizes}")
+    if (bucket:=next((b for b in self.buckets if b >= sz), None)) is None:
+      raise ValueError(f"size {sz} is bigger than the largest bucket {self.buckets[-1]}")
+    # contiguous, also at a bucket size, so every size in a bucket has the same input signature
+    def pad(k:Union[int, str], x:Any) -> Any:
+      if k not in bucketed: return x
+      if bucket == sz: return x.contiguous()
+      return x.pad(tuple((0, bucket-sz) if i == self.bucket_axis else None for i in range(x.ndim)), value=self.bucket_pad).contiguous()
+    def shrink(x:Any) -> Any:
+      if isinstance(x, Tensor):
+        if bucket == sz or x.ndim <= self.bucket_axis or x.shape[self.bucket_axis] != bucket: return x
+        return x.shrink(tuple((0, sz) if i == self.bucket_axis else None for i in range(x.ndim)))
+      if isinstance(x, (list, tuple)): return type(x)(shrink(y) for y in x)
+      if isinstance(x, dict): return {k:shrink(v) for k,v in x.items()}
+      return x
+    ret = self._call(*[pad(i, x) for i,x in enumerate(args)], **{k:pad(k, v) for k,v in kwargs.items()})
+    if self.bucket_shrink is None: return shrink(ret)
+    rets = ret if isinstance(ret, (list, tuple)) else (ret,)
+    if len(rets) != len(self.bucket_shrink): raise ValueError(f"bucket_shrink has {len(self.bucket_shrink)} entries for {len(rets)} outputs")
+    outs = [shrink(x) if m else x for x,m in zip(rets, self.bucket_shrink)]
+    return cast(ReturnType, type(ret)(outs) if isinstance(ret, (list, tuple)) else outs[0])
+
   def __call__(self, *args, **kwargs) -> ReturnType:
+    return self._call(*args, **kwargs) if self.buckets is None else self._call_bucketed(*args, **kwargs)
+
+  def _call(self, *args, **kwargs) -> ReturnType:
     input_buffers, var_vals, names, st_vars_dtype_device = _prepare_jit_inputs(args, kwargs)
-    if not JIT or self.cnt == 0:
+    if JIT and self.cnt >= 1 and (captured:=self.captured_cache.get(sig:=(tuple(names), tuple(st_vars_dtype_device)))) is not None:
+      # jit exec
+      self.hits += 1
+      self.captured_cache.move_to_end(sig)
+      self.captured = captured
+      ret = captured(input_buffers, var_vals)
+    elif not JIT or self.cnt == 0:
       # jit ignore
       assert self.fxn is not None
       with Context(BEAM=0 if getenv("IGNORE_JIT_FIRST_BEAM") else BEAM.value):
         ret = self.fxn(*args, **kwargs)
         if len(params:=get_parameters(ret)): Tensor.realize(params[0], *params[1:])
-    elif self.cnt == 1:
+    else:
       # jit capture
-      assert self.fxn is not None
+      if self.max_captured == 1 and self.captured is not None:
+        assert self.captured.expected_names == names, f"args mismatch in JIT: {self.captured.expected_names=} != {names}"
+        assert self.captured.expected_st_vars_dtype_device == st_vars_dtype_device, \
+          f"args mismatch in JIT: {self.captured.expected_st_vars_dtype_device=} != {st_vars_dtype_device=}"
+      assert self.fxn is not None, "can't capture a new input signature without the function"
+      self.misses += 1
       if capturing: raise RuntimeError(f"having TinyJit inside another TinyJit is not supported {len(capturing)=} {capturing=}")
       self._jit_cache: List[ExecItem] = []
       self._buffer_replace: WeakKeyDictionary[Buffer, Buffer] = WeakKeyDictionary()
+      self._realized: WeakSet[Buffer] = WeakSet()
       # TODO: should we always disable the memory planner here? it must be off for prune
       with Context(GRAPH=getenv("JITGRAPH", GRAPH.value), BEAM=getenv("JITBEAM", BEAM.value), NO_MEMORY_PLANNER=int(self.prune)):
         capturing.append(self)
@@ -241,10 +374,10 @@ class TinyJit(Generic[ReturnType]):
           if len(params:=get_parameters(ret)): Tensor.realize(params[0], *params[1:])
         except Exception as e: raise e
         finally: capturing.clear()
-      jit_cache = self._jit_cache
-      del self._buffer_replace, self._jit_cache
+      jit_cache, realized = self._jit_cache, set(self._realized)
+      del self._buffer_replace, self._jit_cache, self._realized
       assert len(jit_cache), "didn't JIT anything!"
-      if DEBUG >= 1: print(f"JIT captured {len(jit_cache)} kernels with {len(input_buffers)} inputs")
+      if DEBUG >= 1: print(f"JIT captured {len(jit_cache)} kernels with {len(input_buffers)} inputs ({self.misses} captures, {self.hits} hits)")
 
       # track inputs that are views of buffers
       # TODO: eventually expected_buffers should live in ExecItem
@@ -271,24 +404,24 @@ class TinyJit(Generic[ReturnType]):
           ei.run(var_vals, jit=True)
         jit_cache = pruned
 
+      # buffers realized inside the function that nothing outside the jit holds anymore are intermediates, replace them so they can be planned
+      if not self.prune and len(rebuf:={b:Buffer(b.device, b.size, b.dtype, options=b.options) for b in realized if b.lb_refcount == 0}):
+        for b in dedup(b for ei in jit_cache for b in ei.bufs if b is not None and b._base in rebuf):
+          rebuf[b] = Buffer(b.device, b.size, b.dtype, base=rebuf[b.base], offset=b.offset)
+        jit_cache = [ExecItem(ei.prg, [rebuf.get(b, b) if b is not None else None for b in ei.bufs], ei.metadata) for ei in jit_cache]
+
       # memory planning (optional)
       # Exclude buffers involved in transfer ops to preserve parallelism.
+      # The intermediates are laid out in one slab per device, so a replay only touches one allocation.
       noopt_buffers = {b for ji in jit_cache if isinstance(ji.prg, BufferXfer) for b in ji.bufs}
-      assigned = _internal_memory_planner([cast(List[Buffer], item.bufs) for item in jit_cache], noopt_buffers, debug_prefix="JIT ")
+      assigned = _internal_memory_planner([cast(List[Buffer], item.bufs) for item in jit_cache], noopt_buffers, debug_prefix="JIT ", slab=True)
       jit_cache = [ExecItem(item.prg, [assigned.get(b,b).ensure_allocated() for b in item.bufs if b is not None]) for item in jit_cache]
 
       input_replace = get_input_replace(jit_cache, input_buffers)
       if DEBUG >= 1 and len(set(input_replace.values())) != len(input_buffers): print("WARNING: some input tensors not found")
 
       # set this for next run
-      self.captured = CapturedJit(ret, jit_cache, input_replace, extra_view_inputs, names, st_vars_dtype_device)
-    elif self.cnt >= 2:
-      # jit exec
-      assert self.captured is not None
-      assert self.captured.expected_names == names, f"args mismatch in JIT: {self.captured.expected_names=} != {names}"
-      assert self.captured.expected_st_vars_dtype_device == st_vars_dtype_device, \
-        f"args mismatch in JIT: {self.captured.expected_st_vars_dtype_device=} != {st_vars_dtype_device=}"
-      ret = self.captured(input_buffers, var_vals)
+      self._add_captured(CapturedJit(ret, jit_cache, input_replace, extra_view_inputs, names, st_vars_dtype_device))
 
     self.cnt += 1
     return ret
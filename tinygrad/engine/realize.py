@@ -1,35 +1,55 @@
-from typing import List, Dict, Optional, cast, Generator, Tuple, Union
-import time, pprint
+from typing import List, Dict, Optional, cast, Generator, Tuple, Union, DefaultDict, Callable
+import time, pprint, os, bisect, functools
 from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass, replace
 from tinygrad.helpers import colored, getenv, DEBUG, GlobalCounters, ansilen, BEAM, NOOPT, all_int, CAPTURING, Metadata, Context, TRACEMETA, dedup
-from tinygrad.helpers import NO_MEMORY_PLANNER
+from tinygrad.helpers import NO_MEMORY_PLANNER, LOWER_AHEAD, CPU_ASYNC, BATCH_COMPILE, round_up, diskcache_get, LRUCache, CACHELEVEL, VERSION
+from tinygrad.helpers import db_connection
 from tinygrad.ops import MetaOps, UOps, UOp
-from tinygrad.dtype import dtypes
+from tinygrad.dtype import dtypes, ImageDType
 from tinygrad.device import Device, Buffer
 from tinygrad.shape.symbolic import Variable, sym_infer, sint
 from tinygrad.renderer import Renderer, Program
-from tinygrad.codegen.kernel import Kernel
+from tinygrad.codegen.kernel import Kernel, KernelOptError
 from tinygrad.engine.schedule import ScheduleItem
 
 # **************** Program Creation ****************
 
+# kernels tuned offline with python -m tinygrad.tune, TUNED=0 ignores them
+TUNED = getenv("TUNED", 1)
+
+@functools.lru_cache(None)
+def has_tuned_opts() -> bool:
+  """Whether the diskcache has tuned opts at all, so there's no query per kernel without them. merge_tuned clears this."""
+  if CACHELEVEL < 1: return False
+  return db_connection().execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (f"tuned_opts_{VERSION}",)).fetchone() is not None
+
+def load_tuned(k:Kernel) -> Optional[Kernel]:
+  """Returns `k` with the tuned opts for its AST applied, or None if it wasn't tuned for this device."""
+  if not TUNED or not has_tuned_opts(): return None
+  if (val:=diskcache_get("tuned_opts", {"ast": k.ast.key, "device": k.opts.device, "suffix": k.opts.suffix})) is None: return None
+  ret = k.copy()
+  try:
+    for o in val[0]: ret.apply_opt(o)
+  except KernelOptError: return None
+  return ret
+
 logkerns, logkerns_level = open(getenv("LOGKERNS", ""), "a") if getenv("LOGKERNS", "") else None, getenv("LOGKERNS_LEVEL", 1)
 def get_kernel(renderer:Renderer, ast:UOp) -> Kernel:
   if DEBUG >= 5:
     print(ast)
   k = Kernel(ast, opts=renderer).required_optimizations()
-  if not NOOPT:
+  if not NOOPT and not BEAM and (tk:=load_tuned(k)) is not None: k = tk
+  elif not NOOPT:
     if not (used_tensor_cores:=k.apply_tensor_cores(getenv("TC", 1))): k.hand_coded_optimizations()
     if BEAM >= 1:
-      from tinygrad.engine.search import beam_search, time_linearizer, bufs_from_lin
+      from tinygrad.engine.search import search_kernel, time_linearizer, bufs_from_lin
       kb, k_opt = Kernel(ast, opts=renderer).required_optimizations(), k
       rawbufs = bufs_from_lin(kb, allocate=False)
-      if BEAM.value >= 100:
-        from extra.mcts_search import mcts_search
-        k = mcts_search(kb, rawbufs, BEAM.value)
-      else:
-        k = beam_search(kb, rawbufs, BEAM.value, bool(getenv("BEAM_ESTIMATE", 1)))
+      # BEAM>=100 used to mean mcts
+      k = search_kernel(kb, rawbufs, BEAM.value, getenv("SEARCH_STRATEGY", "mcts" if BEAM.value >= 100 else "beam"),
+                        bool(getenv("BEAM_ESTIMATE", 1)), getenv("SEARCH_BUDGET", 0.0))
       if beam_compare:=getenv("BEAM_COMPARE", 1):
         # TODO: move the HC/TC/BEAM compare to beam_search so it can be optionally cached which choice is better
         lins: List[Tuple[str, Kernel]] = [(f"beam{BEAM.value}", k), (("tc" if used_tensor_cores else "hc"), k_opt)]
@@ -147,7 +167,7 @@ class BufferXfer(BufferCopy):
 
 # **************** method cache ****************
 
-method_cache: Dict[Tuple[str, bytes, int, int, bool], CompiledRunner] = {}
+method_cache: LRUCache[Tuple[str, bytes, int, int, bool], CompiledRunner] = LRUCache("method_cache", getenv("METHOD_CACHE_SIZE", 4096))
 def get_runner(dname:str, ast:UOp) -> CompiledRunner:
   ckey = (dname, ast.key, BEAM.value, NOOPT.value, False)
   if cret:=method_cache.get(ckey): return cret
@@ -155,13 +175,52 @@ def get_runner(dname:str, ast:UOp) -> CompiledRunner:
   if bret:=method_cache.get(bkey):
     method_cache[ckey] = ret = CompiledRunner(replace(bret.p, dname=dname), bret.lib)
   else:
-    prg: Program = get_kernel(Device[dname].renderer, ast).to_program()
+    prg, lib = fut.result() if (fut:=compiling.pop(bkey, None)) is not None else (get_kernel(Device[dname].renderer, ast).to_program(), None)
     if getenv("FUZZ_UOPS"):
       from test.external.fuzz_uops import UOpsFuzzerRunner
       return UOpsFuzzerRunner(replace(prg, dname=dname))
-    method_cache[ckey] = method_cache[bkey] = ret = CompiledRunner(replace(prg, dname=dname))
+    method_cache[ckey] = method_cache[bkey] = ret = CompiledRunner(replace(prg, dname=dname), lib)
   return ret
 
+# **************** lowering ahead ****************
+
+# programs rendered ahead and compiling on the lowering pool, keyed like the method_cache entries they will become
+compiling: Dict[Tuple[str, bytes, int, int, bool], Future] = {}
+lower_pool: Optional[ThreadPoolExecutor] = None
+
+def _bkey(si:ScheduleItem) -> Tuple[str, bytes, int, int, bool]:
+  return (si.outputs[0].device.split(":")[0], si.ast.key, BEAM.value, NOOPT.value, True)
+
+def _compile_program(dev, prg:Program) -> Tuple[Program, bytes]:
+  # the program is loaded into the runtime on the main thread, some runtimes have per-thread contexts
+  return prg, dev.compiler.compile_cached(prg.src)
+
+def compile_ahead(si:ScheduleItem):
+  global lower_pool
+  if si.ast.op is not UOps.SINK or (bkey:=_bkey(si)) in method_cache or bkey in compiling: return
+  # codegen has process global state (acc_number, kernel counts) and interns UOps, so it stays on this thread and only the compiler runs on the pool
+  dev = Device[si.outputs[0].device]
+  try: prg = get_kernel(dev.renderer, si.ast).to_program()
+  except Exception: return  # get_runner lowers it again in order and raises there
+  if lower_pool is None: lower_pool = ThreadPoolExecutor(getenv("LOWER_WORKERS", os.cpu_count() or 1), thread_name_prefix="lower")
+  compiling[bkey] = lower_pool.submit(_compile_program, dev, prg)
+
+def batch_compile(schedule:List[ScheduleItem]):
+  # render all the new kernels up front, the ones the compiler cache doesn't have are compiled into one library per device
+  prgs: DefaultDict[str, Dict[Tuple[str, bytes, int, int, bool], Program]] = defaultdict(dict)
+  for si in schedule:
+    if si.ast.op is not UOps.SINK: continue
+    if (bkey:=_bkey(si)) in method_cache or bkey in compiling or bkey in prgs[bkey[0]]: continue
+    prgs[bkey[0]][bkey] = get_kernel(Device[si.outputs[0].device].renderer, si.ast).to_program()
+  for dname, dprgs in prgs.items():
+    compiler = Device[dname].compiler
+    todo = {p.src for p in dprgs.values() if compiler.cachekey is None or diskcache_get(compiler.cachekey, p.src) is None}
+    lib = compiler.compile_batch(list(todo)) if len(todo) > 1 else None
+    for bkey,p in dprgs.items():
+      fut: Future[Tuple[Program, bytes]] = Future()
+      compiling[bkey] = fut
+      fut.set_result((p, lib if lib is not None and p.src in todo else compiler.compile_cached(p.src)))
+
 # **************** lowering functions ****************
 
 @dataclass(frozen=True)
@@ -171,7 +230,16 @@ class ExecItem:
   metadata: Optional[Tuple[Metadata, ...]] = None
   def run(self, var_vals:Optional[Dict[Variable, int]]=None, wait=False, jit=False, do_update_stats=True) -> Optional[float]:
     bufs = [cast(Buffer, x) for x in self.bufs] if jit else [cast(Buffer, x).ensure_allocated() for x in self.bufs]
-    et = self.prg(bufs, var_vals if var_vals is not None else {}, wait=wait or DEBUG >= 2)
+    if CPU_ASYNC and not isinstance(self.prg, (BufferCopy, CustomOp)) and (q:=getattr(Device[self.prg.dname], "queue", None)) is not None:
+      # runners that touch memory from python stay synchronous, copyin/copyout of every buffer this uses (also inside a graph) waits on it
+      fut = q.submit(self.prg, bufs, var_vals if var_vals is not None else {}, wait or DEBUG >= 2)
+      for b in bufs + [b for ei in getattr(self.prg, "jit_cache", ()) for b in ei.bufs if b is not None]: b.base._event = fut
+      et = fut.result() if wait or DEBUG >= 2 else None
+    else:
+      # a queued kernel can still be using any of them, the DISK copies and CustomOps don't go through Buffer methods that wait
+      if CPU_ASYNC:
+        for b in bufs: b.wait()
+      et = self.prg(bufs, var_vals if var_vals is not None else {}, wait=wait or DEBUG >= 2)
     if do_update_stats:
       GlobalCounters.kernel_count += 1
       GlobalCounters.global_ops += (op_est:=sym_infer(self.prg.op_estimate, var_vals))
@@ -204,10 +272,17 @@ def lower_schedule_item(si:ScheduleItem) -> ExecItem:
   raise RuntimeError(f"don't know how to lower {si.ast}")
 
 def lower_schedule(schedule:List[ScheduleItem]) -> Generator[ExecItem, None, None]:
+  # BEAM times kernels on the device (and uses SIGALRM), so it isn't pipelined
+  ahead = LOWER_AHEAD.value if BEAM < 1 and not getenv("FUZZ_UOPS") else 0
+  if BATCH_COMPILE and not getenv("FUZZ_UOPS"): batch_compile(schedule)
   while len(schedule):
+    for x in schedule[:ahead]: compile_ahead(x)
     si = schedule.pop(0)
     try: yield lower_schedule_item(si)
     except Exception as e:
+      # this and the rest of the schedule won't be lowered, so the programs compiling for them are dropped
+      for x in [si]+schedule:
+        if x.ast.op is UOps.SINK and (fut:=compiling.pop(_bkey(x), None)) is not None: fut.cancel()
       if DEBUG >= 2:
         print(f"error lowering {si.ast.op}")
         print("tensor operations:")
@@ -225,7 +300,41 @@ def run_schedule(schedule:List[ScheduleItem], var_vals:Optional[Dict[Variable, i
 
 # **************** memory planning ****************
 
-def _internal_memory_planner(buffers:List[Union[List[Buffer], Tuple[Buffer, ...]]], noopt_buffers=None, debug_prefix="") -> Dict[Buffer, Buffer]:
+# greedy by size, best-fit: the biggest buffers are placed first, each into the smallest gap between the buffers alive at the same time
+# reqs are (first step, last step, nbytes), returns the offset of each request and the total size
+def best_fit_offsets(reqs:List[Tuple[int, int, int]], align:int=0x100) -> Tuple[List[int], int]:
+  # the placed buffers whose lifetime overlaps [st, en] are the ones alive at st and the ones that start in (st, en]. the first are found with a
+  # segment tree over the steps (each placed buffer is in the O(log steps) nodes that cover its lifetime), the second by bisecting the starts
+  n = 1 << max((r[1] for r in reqs), default=0).bit_length()
+  alive: List[List[Tuple[int, int]]] = [[] for _ in range(2*n)]  # (offset, end offset) of the placed buffers alive in each node's steps
+  starts: List[Tuple[int, int, int]] = []  # (first step, offset, end offset) of the placed buffers, sorted
+  offsets, total = [0]*len(reqs), 0
+  for i in sorted(range(len(reqs)), key=lambda i: -reqs[i][2]):
+    st, en, sz = reqs[i]
+    # small buffers can't be loaded with wide vectors, so they don't need the full alignment
+    a, best, top = min(align, 1 << max(sz-1, 0).bit_length()), None, 0
+    lo, hi = bisect.bisect_right(starts, (st, float("inf"))), bisect.bisect_right(starts, (en, float("inf")))
+    overlap, node = [(off, off_en) for _,off,off_en in starts[lo:hi]], st+n
+    while node:
+      overlap.extend(alive[node])
+      node //= 2
+    # the gaps are between the overlapping buffers in offset order
+    for off, off_en in sorted(overlap):
+      if off - (gap_st:=round_up(top, a)) >= sz and (best is None or off - gap_st < best[0]): best = (off - gap_st, gap_st)
+      top = max(top, off_en)
+    offsets[i] = best[1] if best is not None else round_up(top, a)
+    bisect.insort(starts, (st, offsets[i], offsets[i]+sz))
+    lo, hi = st+n, en+n+1
+    while lo < hi:
+      if lo & 1: alive[lo].append((offsets[i], offsets[i]+sz)); lo += 1  # noqa: E702
+      if hi & 1: hi -= 1; alive[hi].append((offsets[i], offsets[i]+sz))  # noqa: E702
+      lo, hi = lo//2, hi//2
+    total = max(total, offsets[i]+sz)
+  return offsets, total
+
+def _internal_memory_planner(buffers:List[Union[List[Buffer], Tuple[Buffer, ...]]], noopt_buffers=None, debug_prefix="",
+                             plan_offsets:Callable[[List[Tuple[int, int, int]]], Tuple[List[int], int]]=best_fit_offsets,
+                             slab=False) -> Dict[Buffer, Buffer]:
   if NO_MEMORY_PLANNER: return {}
   first_appearance, last_appearance = {}, {}
   for i,u in enumerate(buffers):
@@ -234,30 +343,34 @@ def _internal_memory_planner(buffers:List[Union[List[Buffer], Tuple[Buffer, ...]
       if buf.base not in first_appearance: first_appearance[buf.base] = i
       last_appearance[buf.base] = i
 
-  # Sort buffers by size in descending order, prioritizing largest buffers for allocation first.
-  # Track free segments, each containing (start, stop, and buffer that could be reused on this segment).
-  free_segs: Dict[Tuple, List[Tuple[int, int, Buffer]]] = defaultdict(list) # Dict[buffer key, Tuple[start, end, buffer to reuse on the seg]]
-  def find_replace_buffer(buf, st, en):
-    key = (buf.device, buf.dtype, buf.options) + ((buf.nbytes,) if not hasattr(Device[buf.device].allocator, "offset") else tuple())
+  # buffers on allocators that support offset are packed into one arena per key, the others can only reuse buffers of the same size
+  # with slab, the arena is a single uint8 buffer per device (and options) shared by all dtypes
+  groups: DefaultDict[Tuple, List[Buffer]] = defaultdict(list)
+  for buf in first_appearance:
+    if not hasattr(Device[buf.device].allocator, "offset") or isinstance(buf.dtype, ImageDType):
+      groups[(buf.device, buf.dtype, buf.options, buf.nbytes)].append(buf)
+    else: groups[(buf.device, dtypes.uint8 if slab else buf.dtype, buf.options, None)].append(buf)
 
-    default_buf = (0, len(buffers) - 1, buf) # will return the buffer itself if the replace one is not found.
-    seg_st, seg_en, seg_buf = next((free_segs[key].pop(i) for i,(sst,sen,_) in enumerate(free_segs[key]) if sst <= st and en <= sen), default_buf)
-
-    free_segs[key] += [(seg_st, st - 1, seg_buf)] if st - 1 >= seg_st else []
-    free_segs[key] += [(en + 1, seg_en, seg_buf)] if seg_en >= en + 1 else []
-
-    return seg_buf if seg_buf.nbytes == buf.nbytes else Buffer(buf.device, buf.size, buf.dtype, base=seg_buf)
-
-  buffer_requests = sorted([(first_appearance[buf], last_appearance[buf], buf) for buf in first_appearance.keys()], key=lambda x: -x[2].nbytes)
-  assigned = {buf:find_replace_buffer(buf, st, en) for st, en, buf in buffer_requests}
+  assigned: Dict[Buffer, Buffer] = {}
+  for key,bufs in groups.items():
+    if len(bufs) == 1: continue
+    offsets, total = plan_offsets([(first_appearance[buf], last_appearance[buf], buf.nbytes) for buf in bufs])
+    if key[3] is None:
+      base = Buffer(key[0], total//key[1].itemsize, key[1], options=key[2])
+      for buf,off in zip(bufs, offsets): assigned[buf] = Buffer(buf.device, buf.size, buf.dtype, base=base, offset=off)
+    else:
+      # all requests have the same size, so each offset is a slot
+      slots: Dict[int, Buffer] = {}
+      for buf,off in zip(bufs, offsets): assigned[buf] = slots.setdefault(off, buf)
 
   for i,u in enumerate(buffers):
     for buf in u:
       if buf.is_allocated() or buf.lb_refcount > 0 or (noopt_buffers is not None and buf.base in noopt_buffers): continue
-      if buf._base is not None: assigned[buf] = Buffer(buf.device, buf.size, buf.dtype, base=assigned.get(buf.base, buf.base).base, offset=buf.offset)
+      if buf._base is not None:
+        assigned[buf] = Buffer(buf.device, buf.size, buf.dtype, base=(nb:=assigned.get(buf.base, buf.base)).base, offset=nb.offset+buf.offset)
       else: assigned[buf] = assigned.get(buf, buf)
 
-  if DEBUG >= 1 and len(ak:=dedup(x for x in assigned.keys() if x._base is None)) != len(av:=dedup(x for x in assigned.values() if x._base is None)):
+  if DEBUG >= 1 and len(ak:=dedup(x for x in assigned.keys() if x._base is None)) != len(av:=dedup(x.base for x in assigned.values())):
     print(debug_prefix+f"memory reduced from {sum([x.nbytes for x in ak])/1e6:.2f} MB -> {sum([x.nbytes for x in av])/1e6:.2f} MB,",
           f"{len(ak)} -> {len(av)} bufs")
   return assigned
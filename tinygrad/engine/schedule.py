@@ -1,12 +1,14 @@
-import sys, pickle, atexit, importlib, contextlib
+import sys, pickle, atexit, importlib, contextlib, hashlib
 from collections import defaultdict, deque
 from dataclasses import dataclass, field
 from typing import Callable, Tuple, List, Dict, Optional, DefaultDict, cast, get_args
 from tinygrad.ops import REDUCE_ALU, MetaOps, ReduceOps, UNSAFE_PAD_OPS, UnaryOps, UOp, UOps
 from tinygrad.ops import PatternMatcher, UPat, graph_rewrite
 from tinygrad.engine.graph import log_lazybuffer, realized_lazybuffer
-from tinygrad.helpers import GRAPH, DEBUG, MULTIOUTPUT, SAVE_SCHEDULE, FUSE_CONV_BW, FUSE_ARANGE, AST_REWRITE, \
-                             GlobalCounters, all_same, colored, prod, dedup, all_int, merge_dicts, getenv, Metadata, unwrap
+from tinygrad.helpers import GRAPH, DEBUG, MULTIOUTPUT, SAVE_SCHEDULE, FUSE_CONV_BW, FUSE_ARANGE, AST_REWRITE, SCHEDULE_CACHE, \
+                             FUSE_REDUCE_TAIL, FUSE_SEARCH, Context, \
+                             GlobalCounters, all_same, colored, prod, dedup, all_int, merge_dicts, getenv, Metadata, unwrap, \
+                             diskcache_get, diskcache_put, LRUCache
 from tinygrad.shape.symbolic import Variable, sint
 from tinygrad.dtype import ConstType, ImageDType, PtrDType, dtypes
 from tinygrad.lazy import LazyBuffer
@@ -114,9 +116,13 @@ reduceop_fusor = PatternMatcher([
   (UPat(UOps.REDUCE_AXIS, src=(UPat(UOps.REDUCE_AXIS, name="first_reduce"),), name="root"), merge_double_reduce),
 ])
 
+# repeated kernels (eg. every step of a training loop) reuse their rewritten AST. UOps are interned, so the same AST before the rewrite is the
+# same UOp and the memo is keyed on it without hashing. NOTE: only the rewrite is skipped, the group is still lowered to get here
+ast_rewrite_cache: LRUCache[UOp, UOp] = LRUCache("ast_rewrite_cache")
 def full_ast_rewrite(sink:UOp) -> UOp:
   if not AST_REWRITE: return sink
-  return graph_rewrite(sink, reduceop_fusor)
+  if (ret:=ast_rewrite_cache.get(sink)) is None: ast_rewrite_cache[sink] = ret = graph_rewrite(sink, reduceop_fusor)
+  return ret
 
 # *** List[LazyBuffer] lowering to ScheduleItem ***
 
@@ -291,6 +297,8 @@ def _get_output_groups(outs:List[LazyBuffer]) -> \
     _recursive_group(r, r.st, r, children, realizes, reduce_for_op, group, cache={})
     # max one reduceop per kernel
     can_chase = all(tr not in reduce_for_op for tr in group)
+    # don't fuse the elementwise ops after the reduce, it's stored as is
+    if not FUSE_REDUCE_TAIL: group, can_chase = {}, False
     # TODO: forced_realize exists because the scheduler is incapable of checking for self-contained DAGs
     forced_realize = r in group
     if not forced_realize and len(group) > 1:
@@ -394,9 +402,70 @@ def _graph_schedule(outs:List[LazyBuffer]) -> \
     SCHEDULES.append((graph, in_degree))
   return graph, in_degree, var_vals
 
+# *** schedule cache: structurally identical graphs share a schedule ***
+
+def _recurse_signature(buf:LazyBuffer, nodes:Dict[LazyBuffer, Optional[int]], sig:List[Tuple], var_vals:Dict[Variable, int]) -> Optional[int]:
+  """recursively describe the graph structure of a LazyBuffer, returns its place in the walk or None if it can't be cached"""
+  if buf in nodes: return nodes[buf]
+  # image dtypes get patched in _get_output_groups, and CUSTOM can only be keyed on importable functions
+  if isinstance(buf.dtype, ImageDType) or (buf.base.realized is None and buf.base.op is MetaOps.CUSTOM and "<" in buf.base.arg.__qualname__):
+    nodes[buf] = None
+    return None
+  st, st_var_vals = buf.st.unbind()
+  var_vals.update(st_var_vals)
+  # buffer identity is abstracted away, a realized buffer is only its place in the walk
+  if buf is not buf.base: desc: Optional[Tuple] = (st, base) if (base:=_recurse_signature(buf.base, nodes, sig, var_vals)) is not None else None
+  elif buf.realized is not None: desc = (buf.device, st, buf.dtype)
+  else:
+    if isinstance(arg:=buf.arg, Variable): arg, var_vals[arg] = arg.unbind()
+    srcs = tuple(_recurse_signature(x, nodes, sig, var_vals) for x in buf.srcs)
+    desc = None if None in srcs else (buf.device, st, buf.dtype, buf.op, arg, srcs, buf.forced_realize, buf.metadata)
+  if desc is not None: sig.append(desc)
+  nodes[buf] = ret = None if desc is None else len(sig)-1
+  return ret
+
+def _graph_signature(outs:List[LazyBuffer]) -> Optional[Tuple[List[LazyBuffer], str, Dict[Variable, int]]]:
+  """returns (all LazyBuffers in walk order, structural key, var_vals) for the graph, or None if it can't be cached"""
+  nodes: Dict[LazyBuffer, Optional[int]] = {}
+  sig: List[Tuple] = []
+  var_vals: Dict[Variable, int] = {}
+  if None in (out_idxs:=tuple(_recurse_signature(x, nodes, sig, var_vals) for x in outs)): return None
+  ctx = (MULTIOUTPUT.value, FUSE_ARANGE.value, FUSE_CONV_BW.value, FUSE_REDUCE_TAIL.value, AST_REWRITE.value)
+  return list(nodes), hashlib.sha256(pickle.dumps((sig, out_idxs, ctx))).hexdigest(), var_vals
+
+def graph_key(outs:List[LazyBuffer]) -> Optional[str]:
+  """the structural key of the graph of `outs` under the current scheduler context, or None if it can't be keyed"""
+  return None if (sig:=_graph_signature(outs)) is None else sig[1]
+
+def create_lb_schedule(outs:List[LazyBuffer]) -> Tuple[List[LBScheduleItem], Dict[Variable, int]]:
+  """the LBScheduleItems for `outs` in the order they run, and their var_vals. nothing is marked scheduled, so `outs` can be scheduled after"""
+  graph, in_degree, var_vals = _graph_schedule(outs)
+  lsis: List[LBScheduleItem] = []
+  queue = deque(lsi for lsi,deg in in_degree.items() if deg == 0)
+  while queue:
+    lsis.append(lsi:=queue.popleft())
+    for x in graph[lsi]:
+      in_degree[x] -= 1
+      if in_degree[x] == 0: queue.append(x)
+  return lsis, var_vals
+
+def _schedule_from_template(nodes:List[LazyBuffer], template) -> List[ScheduleItem]:
+  schedule: List[ScheduleItem] = []
+  for ast, buf_idxs, out_idxs, metadata in template:
+    for i in out_idxs: del nodes[i].srcs  # can only schedule once
+    schedule.append(ScheduleItem(ast, tuple(nodes[i].buffer for i in buf_idxs), metadata))
+  return schedule
+
 # *** DAG ordering: breadth first search ***
 
 def create_schedule_with_vars(outs:List[LazyBuffer]) -> Tuple[List[ScheduleItem], Dict[Variable, int]]:
+  if FUSE_SEARCH and not (GRAPH or SAVE_SCHEDULE):
+    from tinygrad.engine.search import fusion_search
+    if (fuse_ctx:=fusion_search(outs)) is not None:
+      with Context(FUSE_SEARCH=0, **fuse_ctx): return create_schedule_with_vars(outs)
+  signature = _graph_signature(outs) if SCHEDULE_CACHE and not (GRAPH or SAVE_SCHEDULE or getenv("RUN_PROCESS_REPLAY")) else None
+  if signature is not None and (cached:=diskcache_get("schedule", signature[1])) is not None:
+    return _schedule_from_template(signature[0], cached[0]), {v:signature[2][v] for v in cached[1]}
   graph, in_degree, var_vals = _graph_schedule(outs)
   if getenv("RUN_PROCESS_REPLAY") and getenv("COMPARE_SCHEDULE", 1):
     # NOTE: process relpay needs PYTHONPATH=., remove this once it just pickles LazyBuffers
@@ -404,6 +473,8 @@ def create_schedule_with_vars(outs:List[LazyBuffer]) -> Tuple[List[ScheduleItem]
 
   queue = deque(lsi for lsi,deg in in_degree.items() if deg == 0)
   schedule: List[ScheduleItem] = []
+  template: List[Tuple[UOp, Tuple[int, ...], Tuple[int, ...], Optional[Tuple[Metadata, ...]]]] = []
+  node_idx = {lb:i for i,lb in enumerate(signature[0])} if signature is not None else {}
   kernel_number = GlobalCounters.kernel_count
   while queue:
     lsi = queue.popleft()
@@ -412,6 +483,9 @@ def create_schedule_with_vars(outs:List[LazyBuffer]) -> Tuple[List[ScheduleItem]
       for out in lsi.outputs: realized_lazybuffer(out, kernel_number)
     for out in lsi.outputs: del out.srcs  # can only schedule once
     schedule.append(ScheduleItem(lsi.ast, tuple(x.buffer for x in lsi.outputs+lsi.inputs if x.size != 0), tuple(lsi.metadata)))
+    if signature is not None:
+      template.append((lsi.ast, tuple(node_idx[x] for x in lsi.outputs+lsi.inputs if x.size != 0), tuple(node_idx[x] for x in lsi.outputs),
+                       tuple(lsi.metadata)))
     for x in graph[lsi]:
       in_degree[x] -= 1
       if in_degree[x] == 0: queue.append(x)
@@ -420,6 +494,7 @@ def create_schedule_with_vars(outs:List[LazyBuffer]) -> Tuple[List[ScheduleItem]
   if any(degree != 0 for degree in in_degree.values()) or len(in_degree) != len(schedule):
     raise RuntimeError(f"cycle detected in graph, prescheduled {len(in_degree)} but only scheduled {len(schedule)}")
   if DEBUG >= 1 and len(schedule) >= 10: print(f"scheduled {len(schedule)} kernels")
+  if signature is not None: diskcache_put("schedule", signature[1], (template, tuple(var_vals)))
   return schedule, var_vals
 
 def create_schedule(outs:List[LazyBuffer]) -> List[ScheduleItem]:
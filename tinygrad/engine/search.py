@@ -1,16 +1,19 @@
-from typing import Dict, List, cast, DefaultDict, Optional, Tuple, Callable
-import itertools, functools, random, math, time, multiprocessing, traceback, signal
-from collections import defaultdict
+from typing import Dict, List, cast, DefaultDict, Optional, Tuple, Callable, Any, Generator, Iterable
+import itertools, functools, random, math, time, multiprocessing, traceback, signal, hashlib, statistics, ctypes, threading
+from collections import defaultdict, Counter
 from dataclasses import replace
-from tinygrad.ops import UOp, UOps
+from tinygrad.ops import UOp, UOps, flops_mem
 from tinygrad.device import Device, Buffer, Compiler
-from tinygrad.helpers import prod, flatten, DEBUG, CACHELEVEL, diskcache_get, diskcache_put, getenv, Context, colored, to_function_name
+from tinygrad.helpers import prod, flatten, DEBUG, CACHELEVEL, diskcache_get, diskcache_put, diskcache_values, getenv, Context, colored, all_int
+from tinygrad.helpers import to_function_name, all_same, FUSE_REDUCE_TAIL, FUSE_ARANGE, FUSE_CONV_BW
 from tinygrad.dtype import ImageDType
 from tinygrad.codegen.kernel import Kernel
 from tinygrad.codegen.kernel import Opt, OptOps, KernelOptError
 from tinygrad.tensor import Tensor
-from tinygrad.shape.symbolic import Variable, sym_infer
-from tinygrad.engine.realize import CompiledRunner
+from tinygrad.shape.symbolic import Variable, sym_infer, sint
+from tinygrad.engine.realize import CompiledRunner, get_kernel
+from tinygrad.engine.schedule import LBScheduleItem, create_lb_schedule, graph_key
+from tinygrad.lazy import LazyBuffer
 from tinygrad.renderer import Program
 
 actions = [Opt(op=OptOps.UPCAST, axis=axis, amt=amt) for amt in [0,2,3,4,5,7] for axis in range(6)]
@@ -22,8 +25,11 @@ if getenv("BEAM_PADTO", 1): actions += [Opt(op=OptOps.PADTO, axis=axis, amt=amt)
 actions += [Opt(op=OptOps.LOCAL, axis=0, amt=32), Opt(op=OptOps.UPCASTMID, axis=1, amt=4), Opt(op=OptOps.TC, axis=0, amt=0)]
 actions += [Opt(op=OptOps.TC, axis=axis, amt=getenv("TC_OPT", 2)) for axis in range(9)] # covers resnet kernels (3 global * 3 reduce)
 actions += [Opt(op=OptOps.SWAP, axis=axis, amt=amt) for axis in range(5) for amt in range(axis+1, 5)]
+actions += [Opt(op=OptOps.THREAD, axis=axis, amt=amt) for amt in [2,4,8,16,32,64] for axis in range(3)]
 if getenv("NOLOCALS"): actions += [Opt(op=OptOps.NOLOCALS)]
 
+BEAM_TIMING_MAX, BEAM_TIMING_RTOL = getenv("BEAM_TIMING_MAX", 10), getenv("BEAM_TIMING_RTOL", 0.02)
+
 def _get_test_global_size(global_size, max_global_size, var_vals):
   test_global_size, factor = [sym_infer(sz, var_vals) for sz in global_size], 1
   while prod(test_global_size) > max_global_size:
@@ -34,32 +40,60 @@ def _get_test_global_size(global_size, max_global_size, var_vals):
         break
   return test_global_size, factor
 
+# two sided 95% t quantiles for 1..9 degrees of freedom
+_T95 = [12.71, 4.30, 3.18, 2.78, 2.57, 2.45, 2.36, 2.31, 2.26]
+def timing_stats(tms:List[float]) -> Tuple[float, float]:
+  """Mean and 95% confidence half width of `tms`, ignoring outliers more than 3 scaled MADs from the median."""
+  med = statistics.median(tms)
+  mad = statistics.median([abs(t-med) for t in tms])*1.4826
+  if len(ok:=[t for t in tms if abs(t-med) <= 3*mad]) < 2: return med, math.inf
+  return statistics.mean(ok), (_T95[len(ok)-2] if len(ok) <= 10 else 1.96)*statistics.stdev(ok)/math.sqrt(len(ok))
+
+def timing_estimate(tms:List[float]) -> float: return timing_stats(tms)[0] if all(t < math.inf for t in tms) else math.inf
+
+@functools.lru_cache(None)
+def _cpu_flush_buf() -> ctypes.Array:
+  try:
+    with open("/sys/devices/system/cpu/cpu0/cache/index3/size") as f: size = int(f.read().strip().rstrip("K"))*1024
+  except (OSError, ValueError): size = 32<<20
+  return (ctypes.c_uint8 * size)()
+
+def _flush_caches(dname:str):
+  if hasattr(dev:=Device[dname], 'invalidate_caches'): dev.invalidate_caches()
+  elif dname.split(":")[0] in {"CLANG", "LLVM"}: ctypes.memset(buf:=_cpu_flush_buf(), random.randint(0, 255), len(buf))
+  else:
+    with Context(DEBUG=0, BEAM=0, CAPTURING=0): Tensor.ones(1024,1024).contiguous().realize(do_update_stats=False)
+
 def _time_program(p:Program, lib:bytes, var_vals:Dict[Variable, int], rawbufs:List[Buffer], early_stop:Optional[float]=None,
-                  max_global_size:Optional[int]=65536, clear_l2=False, cnt=3, name="test") -> List[float]:
+                  max_global_size:Optional[int]=65536, clear_l2=False, cnt=3, name="test", best:Optional[float]=None, max_cnt=0) -> List[float]:
+  """Times `p` `cnt` times, stopping once it's slower than `early_stop`. If `best` is set, this takes between 2 and `max_cnt` samples instead,
+  stopping once the confidence interval is clear of `best` or within BEAM_TIMING_RTOL of the mean."""
   factor = 1
   if p.global_size is not None and max_global_size is not None:
     global_size, factor = _get_test_global_size(p.global_size, max_global_size, var_vals)
     p = replace(p, global_size=global_size)
   try: car = CompiledRunner(p, precompiled=lib)
   except AssertionError: return [math.inf] * cnt
-  tms = []
+  tms: List[float] = []
   input_bufs = [rawbufs[i] for i in car.p.globals]
-  for _ in range(cnt):
-    if clear_l2:
-      if hasattr(dev:=Device[p.dname], 'invalidate_caches'): dev.invalidate_caches()
-      else:
-        with Context(DEBUG=0, BEAM=0, CAPTURING=0): Tensor.ones(1024,1024).contiguous().realize(do_update_stats=False)
+  for _ in range(max(cnt, max_cnt) if best is not None else cnt):
+    if clear_l2: _flush_caches(p.dname)
     tms.append(cast(float, car(input_bufs, var_vals, wait=True))*factor)
     if early_stop is not None and early_stop < min(tms): break
+    if best is not None and len(tms) >= 2:
+      mean, hw = timing_stats(tms)
+      if mean-hw > best or mean+hw < best or hw < mean*BEAM_TIMING_RTOL: break
   return tms
 
 class TimeoutException(Exception): pass
 def timeout_handler(signum, frame): raise TimeoutException()
 
-def _try_compile_linearized_w_idx(x:Tuple[int,Kernel], compiler:Compiler) -> Tuple[int, Optional[Tuple[Program, bytes, float]]]:
-  signal.signal(signal.SIGALRM, timeout_handler)
-  # set timeout
-  signal.alarm(getenv("BEAM_TIMEOUT_SEC", 10))
+def _try_compile_linearized_w_idx(x:Tuple[int,Kernel], compiler:Compiler, timeout:int=getenv("BEAM_TIMEOUT_SEC", 10)) \
+  -> Tuple[int, Optional[Tuple[Program, bytes, float]]]:
+  # set timeout, in the CompilePool the parent times out the workers instead
+  if (use_alarm:=timeout > 0 and threading.current_thread() is threading.main_thread()):
+    signal.signal(signal.SIGALRM, timeout_handler)
+    signal.alarm(timeout)
   try:
     p = x[1].to_program(name_override="test")
     assert p.uops is not None, "uop list wasn't generated?"
@@ -77,11 +111,39 @@ def _try_compile_linearized_w_idx(x:Tuple[int,Kernel], compiler:Compiler) -> Tup
     if getenv("BEAM_STRICT_MODE"): raise e
     ret = None
   finally:
-    signal.alarm(0)
+    if use_alarm: signal.alarm(0)
   return x[0], ret
 
 # workers should ignore ctrl c
 def _init_worker(): signal.signal(signal.SIGINT, signal.SIG_IGN)
+def _compile_batch(xs:List[Tuple[int,Kernel]], compiler:Compiler) -> List[Tuple[int, Optional[Tuple[Program, bytes, float]]]]:
+  return [_try_compile_linearized_w_idx(x, compiler, timeout=0) for x in xs]
+
+class CompilePool:
+  """Compile workers that live across searches. With forkserver they fork from a process that already imported tinygrad."""
+  def __init__(self, workers:int):
+    self.workers = workers
+    self.ctx = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+    if self.ctx.get_start_method() == "forkserver": self.ctx.set_forkserver_preload(["tinygrad.engine.search"])
+    self.pool = self._new_pool()
+  def _new_pool(self): return self.ctx.Pool(self.workers, _init_worker, (), getenv("BEAM_MAX_TASKS_PER_CHILD", 16))
+
+  def compile(self, lins:List[Kernel], compiler:Compiler, timeout:int=getenv("BEAM_TIMEOUT_SEC", 10)) \
+    -> Generator[Tuple[int, Optional[Tuple[Program, bytes, float]]], None, None]:
+    """Yields (index, compiled) as batches finish. If no batch finishes within `timeout` seconds per kernel a compile hung, so the workers are
+    replaced and the rest of the kernels are dropped."""
+    bs = max(1, len(lins)//(self.workers*4))
+    batches = [list(enumerate(lins))[i:i+bs] for i in range(0, len(lins), bs)]
+    it = self.pool.imap_unordered(functools.partial(_compile_batch, compiler=compiler), batches)
+    for _ in range(len(batches)):
+      try: yield from it.next(timeout*bs if timeout > 0 else None)
+      except multiprocessing.TimeoutError:
+        if DEBUG >= 2: print(f"\ncompile timed out after {timeout*bs}s, restarting {self.workers} workers")
+        self.pool.terminate()
+        self.pool = self._new_pool()
+        return
+
+  def close(self): self.pool.terminate()
 
 def _ensure_buffer_alloc(bufs:List[Buffer]) -> List[Buffer]: return [buf.ensure_allocated() for buf in bufs]
 
@@ -118,21 +180,151 @@ def get_kernel_actions(lin:Kernel, include_0=True) -> Dict[int, Kernel]:
     except KernelOptError: pass
   return acted_lins
 
-beam_pool, BEAM_DEBUG = None, getenv("BEAM_DEBUG")
-def beam_search(lin:Kernel, rawbufs:List[Buffer], amt:int, allow_test_size=True, disable_cache=getenv("IGNORE_BEAM_CACHE")) -> Kernel:
-  global beam_pool
-  key = {"ast": lin.ast.key, "amt": amt, "allow_test_size": allow_test_size, "device": lin.opts.device, "suffix": lin.opts.suffix}
-  if not disable_cache and CACHELEVEL >= 1 and (val:=diskcache_get("beam_search", key)) is not None:
-    ret = lin.copy()
-    for o in val[len(lin.applied_opts):]: ret.apply_opt(o)
+# *** cost model ***
+
+def kernel_features(lin:Kernel, uops:List[UOp], var_vals:Dict[Variable, int]) -> List[float]:
+  flops, mem = flops_mem(uops, ignore_indexing=True)
+  sizes: DefaultDict[str, sint] = defaultdict(lambda: 1)
+  for s,c in zip(lin.full_shape, lin.colors()): sizes[c.lower()] *= s
+  cnt = Counter(u.op for u in uops)
+  feats = [flops, mem, len(uops), cnt[UOps.ALU], cnt[UOps.LOAD], cnt[UOps.STORE], cnt[UOps.RANGE], sizes["blue"],
+           sizes["cyan"]*sizes["green"]*sizes["white"], sizes["red"], sizes["magenta"]*sizes["yellow"], lin.full_shape[0] if lin.uses_threads else 1]
+  return [math.log2(1+sym_infer(x, var_vals)) for x in feats] + [1.0]
+
+class CostModel:
+  """Ridge regression of log2 runtime on `kernel_features`, lower predictions are faster kernels."""
+  def __init__(self, weights:List[float]): self.weights = weights
+  def predict(self, feats:List[float]) -> float: return sum(w*x for w,x in zip(self.weights, feats))
+
+  @staticmethod
+  def fit(samples:List[Tuple[List[float], float]], l2:float=1e-2) -> 'CostModel':
+    # solve (X^T X + l2*I) w = X^T y with gauss-jordan
+    n = len(samples[0][0])
+    a = [[sum(f[i]*f[j] for f,_ in samples) + l2*(i == j) for j in range(n)] + [sum(f[i]*math.log2(tm) for f,tm in samples)] for i in range(n)]
+    for i in range(n):
+      p = i
+      for r in range(i+1, n):
+        if abs(a[r][i]) > abs(a[p][i]): p = r
+      a[i], a[p] = a[p], a[i]
+      # with l2=0 and fewer samples than features a column can have no pivot, its weight stays 0
+      if abs(a[i][i]) < 1e-12: continue
+      for r in range(n):
+        if r != i: a[r] = [x-a[r][i]/a[i][i]*y for x,y in zip(a[r], a[i])]
+    return CostModel([a[i][n]/a[i][i] if abs(a[i][i]) >= 1e-12 else 0.0 for i in range(n)])
+
+# replace this to use your own model, otherwise one is fit to the timings in the diskcache
+cost_model: Optional[CostModel] = None
+
+# the fit models, and for (device, suffix) without one, how many samples this process had recorded when it last looked
+_cost_models: Dict[Tuple[str, str], CostModel] = {}
+_cost_model_checked: Dict[Tuple[str, str], int] = {}
+_features_recorded: DefaultDict[Tuple[str, str], int] = defaultdict(int)
+
+def _fit_cost_model(device:str, suffix:str) -> Optional[CostModel]:
+  if (ret:=_cost_models.get(key:=(device, suffix))) is not None: return ret
+  # without enough samples it looks again once BEAM_COST_REFIT more are recorded, so one long BEAM run turns the model on partway through
+  if key in _cost_model_checked and _features_recorded[key] - _cost_model_checked[key] < getenv("BEAM_COST_REFIT", 64): return None
+  _cost_model_checked[key] = _features_recorded[key]
+  samples = [x for x in diskcache_values("kernel_features", {"device": device, "suffix": suffix}) if 0 < x[1] < math.inf]
+  if DEBUG >= 2: print(f"cost model for {device}: fit on {len(samples)} timed kernels")
+  if len(samples) < getenv("BEAM_COST_MIN_SAMPLES", 100): return None
+  _cost_models[key] = ret = CostModel.fit(samples)
+  return ret
+
+def get_cost_model(device:str, suffix:str="") -> Optional[CostModel]: return cost_model if cost_model is not None else _fit_cost_model(device, suffix)
+
+# the samples the cost model is fit on, recorded for every timed kernel when the model is used (or asked for, to collect samples ahead of time)
+BEAM_RECORD_FEATURES = getenv("BEAM_RECORD_FEATURES", int(getenv("BEAM_COST_TOPK") > 0))
+
+def _put_features(lin:Kernel, uops:List[UOp], var_vals:Dict[Variable, int], tm:float):
+  if not BEAM_RECORD_FEATURES or CACHELEVEL < 2 or not 0 < tm < math.inf: return
+  key = {"ast": lin.ast.key, "opts": str(lin.applied_opts), "device": lin.opts.device, "suffix": lin.opts.suffix}
+  diskcache_put("kernel_features", key, (kernel_features(lin, uops, var_vals), tm))
+  _features_recorded[(lin.opts.device, lin.opts.suffix)] += 1
+
+def rank_with_cost_model(lins:List[Kernel], var_vals:Dict[Variable, int], model:CostModel) -> List[Kernel]:
+  scored: List[Tuple[float, int]] = []
+  for i,l in enumerate(lins):
+    try: feats = kernel_features(l, l.linearize().uops, var_vals)
+    except Exception: continue  # it would fail to compile too
+    scored.append((model.predict(feats), i))
+  return [lins[i] for _,i in sorted(scored)]
+
+# *** transfer between similar kernels ***
+
+def ast_signature(ast:UOp) -> str:
+  """Like `ast.key` but without the concrete sizes, so kernels that only differ in their shapes have the same signature."""
+  cache: Dict[int, bytes] = {}
+  def _sig(u:UOp) -> bytes:
+    if (ret:=cache.get(id(u))) is not None: return ret
+    if u.op is UOps.SHAPETRACKER:
+      arg: Any = tuple((len(v.shape), tuple(isinstance(st, int) and st == 0 for st in v.strides), v.mask is not None) for v in u.arg.views)
+    else: arg = u.arg
+    ret = cache[id(u)] = hashlib.sha256(str((u.op, u.dtype, arg)).encode() + b"".join([_sig(s) for s in u.src])).digest()
     return ret
+  return _sig(ast).hex()
+
+def _put_transfer(lin:Kernel, best:Kernel):
+  if CACHELEVEL < 1 or not all_int(lin.full_shape): return
+  key = {"sig": ast_signature(lin.ast), "ast": lin.ast.key, "device": lin.opts.device, "suffix": lin.opts.suffix}
+  diskcache_put("beam_transfer", key, (lin.ast.key, lin.full_shape, best.applied_opts[len(lin.applied_opts):]))
+
+def get_transfer_seeds(lin:Kernel, n:int) -> List[Kernel]:
+  """Applies the searched opts of the (up to) `n` cached kernels with the closest shapes and the same `ast_signature` to `lin`."""
+  if n <= 0 or not all_int(lin.full_shape): return []
+  def dist(shape:Tuple[int, ...]) -> float: return sum(abs(math.log2(max(a, 1)/max(cast(int, b), 1))) for a,b in zip(shape, lin.full_shape))
+  neighbours = [(dist(shape), opts) for ast_key,shape,opts in diskcache_values("beam_transfer", {"sig": ast_signature(lin.ast),
+                "device": lin.opts.device, "suffix": lin.opts.suffix}) if ast_key != lin.ast.key and len(shape) == len(lin.full_shape)]
+  ret: List[Kernel] = []
+  for _,opts in sorted(neighbours, key=lambda x: x[0]):
+    if len(ret) >= n: break
+    k = lin.copy()
+    try:
+      for o in opts: k.apply_opt(o)
+    except KernelOptError: continue  # the opts don't fit these sizes
+    if all(k.applied_opts != x.applied_opts for x in ret): ret.append(k)
+  return ret
+
+# *** search strategies ***
+
+# every strategy stores its result in the "<name>_search" table under the same key
+def _search_key(lin:Kernel, amt:int, allow_test_size:bool) -> Dict:
+  return {"ast": lin.ast.key, "amt": amt, "allow_test_size": allow_test_size, "device": lin.opts.device, "suffix": lin.opts.suffix}
+
+def _search_cache_get(table:str, key:Dict, lin:Kernel, disable_cache:bool) -> Optional[Kernel]:
+  if disable_cache or CACHELEVEL < 1 or (val:=diskcache_get(table, key)) is None: return None
+  ret = lin.copy()
+  for o in val[len(lin.applied_opts):]: ret.apply_opt(o)
+  return ret
+
+def _out_of_time(deadline:Optional[float]) -> bool: return deadline is not None and time.perf_counter() > deadline
+
+def _time_candidate(lin:Kernel, p:Program, lib:bytes, var_vals:Dict[Variable, int], rawbufs:List[Buffer], best:float, allow_test_size:bool) -> float:
+  clear_l2 = BEAM_CLEAR_L2 or hasattr(Device[p.dname], 'invalidate_caches')
+  try: tm = timing_estimate(_time_program(p, lib, var_vals, rawbufs, early_stop=best*3 if best < math.inf else 1.0, clear_l2=clear_l2,
+                                          max_global_size=65536 if allow_test_size else None, best=best if best < math.inf else None,
+                                          max_cnt=BEAM_TIMING_MAX))
+  except RuntimeError: return math.inf
+  _put_features(lin, cast(List[UOp], p.uops), var_vals, tm)
+  return tm
+
+beam_pool, BEAM_DEBUG, BEAM_CLEAR_L2 = None, getenv("BEAM_DEBUG"), getenv("BEAM_CLEAR_L2")
+# compilers that hold a device handle (METAL, GPU, LLVM) can't be sent to the workers
+PARALLEL_DEVICES, PARALLEL_CPU_DEVICES = {"CUDA", "AMD", "NV"}, {"CLANG"}
+def _default_parallel(device:str) -> int:
+  if device in PARALLEL_DEVICES or (device in PARALLEL_CPU_DEVICES and multiprocessing.cpu_count() > 1): return multiprocessing.cpu_count()
+  return 0
+
+def beam_search(lin:Kernel, rawbufs:List[Buffer], amt:int, allow_test_size=True, disable_cache=getenv("IGNORE_BEAM_CACHE"),
+                cost_topk=getenv("BEAM_COST_TOPK"), deadline:Optional[float]=None, transfer=getenv("BEAM_TRANSFER")) -> Kernel:
+  global beam_pool
+  key = _search_key(lin, amt, allow_test_size)
+  if (ret:=_search_cache_get("beam_search", key, lin, disable_cache)) is not None: return ret
 
   beam: List[Tuple[Kernel, float]] = [(lin, float("inf"))]
   seen_libs = set()
 
-  default_parallel = multiprocessing.cpu_count() if lin.opts.device in {"CUDA", "AMD", "NV"} else 0
-  if beam_pool is None and (workers := getenv("PARALLEL", default_parallel)):
-    beam_pool = multiprocessing.get_context("spawn").Pool(workers, _init_worker, (), getenv("BEAM_MAX_TASKS_PER_CHILD", 16))
+  if beam_pool is None and (workers := getenv("PARALLEL", _default_parallel(lin.opts.device))): beam_pool = CompilePool(workers)
 
   min_progress = getenv("BEAM_MIN_PROGRESS", 0.01)/1e6
   if BEAM_DEBUG: print(f"BEAM_SEARCH:\n{lin.ast}")
@@ -143,12 +335,29 @@ def beam_search(lin:Kernel, rawbufs:List[Buffer], amt:int, allow_test_size=True,
     var_vals: Dict[Variable, int] = {k:(k.max+k.min)//2 for k in lin.ast.variables()}
     exiting, st = False, time.perf_counter()
     dev = Device[lin.opts.device]
+    # start from what was found for similar kernels
+    for seed in get_transfer_seeds(lin, transfer):
+      if (proc:=_try_compile_linearized_w_idx((0, seed), dev.compiler)[1]) is None or proc[1] in seen_libs: continue
+      seen_libs.add(proc[1])
+      beam.append((seed, _time_candidate(seed, proc[0], proc[1], var_vals, rawbufs, math.inf, True)))
+    if len(beam) > 1:
+      beam = sorted(beam, key=lambda x: x[1])[:amt]
+      if DEBUG >= 2: print(f"{time.perf_counter() - st:7.2f}s: {beam[0][1]*1e6:12.2f} us from similar kernels", beam[0][0].colored_shape())
     while not exiting:
       acted_lins: List[Kernel] = flatten([get_kernel_actions(lin, include_0=False).values() for lin,_ in beam])
+      # only compile and time the candidates the cost model thinks are fastest
+      if cost_topk and len(acted_lins) > cost_topk and (model:=get_cost_model(lin.opts.device, lin.opts.suffix)) is not None:
+        acted_lins = rank_with_cost_model(acted_lins, var_vals, model)[:cost_topk]
       timed_lins: List[Tuple[Kernel, float]] = []
       _compile_fn = functools.partial(_try_compile_linearized_w_idx, compiler=dev.compiler)
-      least_compute_ops = math.inf
-      for i,proc in (map(_compile_fn, enumerate(acted_lins)) if beam_pool is None else beam_pool.imap_unordered(_compile_fn, enumerate(acted_lins))):
+      least_compute_ops, out_of_time = math.inf, False
+      # candidates are timed until they are clearly faster or slower than the best so far
+      best: Optional[float] = beam[0][1] if beam[0][1] < math.inf else None
+      compiled: Iterable = map(_compile_fn, enumerate(acted_lins)) if beam_pool is None else beam_pool.compile(acted_lins, dev.compiler)
+      # on cpus the workers would slow down the timing, so everything is compiled first
+      if beam_pool is not None and lin.opts.device.split(":")[0] in {"CLANG", "LLVM"}: compiled = list(compiled)
+      for i,proc in compiled:
+        if out_of_time:=_out_of_time(deadline): break
         if proc is None: continue
         p, lib, compile_et = proc
         if lib in seen_libs: continue
@@ -157,26 +366,170 @@ def beam_search(lin:Kernel, rawbufs:List[Buffer], amt:int, allow_test_size=True,
         if least_compute_ops*1000 < this_compute_ops: continue
         #print(acted_lins[i].colored_shape(), acted_lins[i].applied_opts)  # for debugging BEAMs that segfault
         seen_libs.add(lib)
-        try: tms = _time_program(p, lib, var_vals, rawbufs, early_stop=beam[0][1]*3 if len(beam) else 1.0, clear_l2=hasattr(dev, 'invalidate_caches'))
+        try: tms = _time_program(p, lib, var_vals, rawbufs, early_stop=beam[0][1]*3 if len(beam) else 1.0,
+                                 clear_l2=BEAM_CLEAR_L2 or hasattr(dev, 'invalidate_caches'), best=best, max_cnt=BEAM_TIMING_MAX)
         except RuntimeError: continue # for runtime issues
-        timed_lins.append((acted_lins[i], min(tms)))
+        timed_lins.append((acted_lins[i], timing_estimate(tms)))
+        if timed_lins[-1][1] < (best or math.inf): best = timed_lins[-1][1]
+        _put_features(acted_lins[i], cast(List[UOp], p.uops), var_vals, timed_lins[-1][1])
         if BEAM_DEBUG > 1: print(f"{time.perf_counter() - st:7.2f}s: {i:5d} {len(cast(List, p.uops)):5d} uops {compile_et*1e6:12.2f} us compile/{timed_lins[-1][1]*1e6:12.2f} us run       {len(timed_lins):4d}/{len(acted_lins):4d}         {timed_lins[-1][0].colored_shape()}")  # noqa: E501
         elif DEBUG >= 2: print(f"\r{time.perf_counter() - st:7.2f}s: {timed_lins[-1][1]*1e6:12.2f} us       {len(timed_lins):4d}/{len(acted_lins):4d}         {timed_lins[-1][0].colored_shape()}\033[K", end="")  # noqa: E501
 
       # done
       opts = sorted(timed_lins, key=lambda x: x[1])
-      exiting = len(opts) == 0 or (opts[0][1] < min_progress) or (len(beam) > 0 and ((beam[0][1]-opts[0][1]) < min_progress))
+      exiting = out_of_time or len(opts) == 0 or (opts[0][1] < min_progress) or (len(beam) > 0 and ((beam[0][1]-opts[0][1]) < min_progress))
       if not exiting: beam = opts[:amt]
       elif len(opts) > 0 and opts[0][1] < beam[0][1]: beam = opts[:1]
       if DEBUG >= 2: print(f"\r{time.perf_counter() - st:7.2f}s:", colored(f"{beam[0][1]*1e6:12.2f} us", "green" if exiting else None), f"from {len(acted_lins):3d} -> {len(opts):3d} actions\033[K", beam[0][0].colored_shape())  # noqa: E501
   except KeyboardInterrupt as e:
-    if beam_pool is not None: beam_pool.terminate()
+    if beam_pool is not None: beam_pool.close()
+    beam_pool = None
     raise e
 
   if CACHELEVEL >= 1: diskcache_put("beam_search", key, beam[0][0].applied_opts)
+  _put_transfer(lin, beam[0][0])
   if BEAM_DEBUG: print(f"BEAM_SEARCH: final tm={beam[0][1]*1e6:0.2f} us, applied_opts={beam[0][0].applied_opts}")
   return beam[0][0]
 
+# monte carlo tree search over the same actions, each rollout is compiled and timed
+class MCTSNode:
+  def __init__(self, kernel:Kernel, parent:Optional['MCTSNode']=None):
+    self.kernel, self.t, self.n, self.tm, self.i = kernel, math.inf, 0.0, math.inf, -1
+    self.parents: List[MCTSNode] = [parent] if parent is not None else []
+    self.children: Optional[List[MCTSNode]] = None
+    self.removed_children: List[MCTSNode] = []
+
+def _expand_node(node:MCTSNode):
+  assert node.children is None
+  node.children = [MCTSNode(x, node) for x in get_kernel_actions(node.kernel, include_0=False).values()]
+
+def _remove_node(node:MCTSNode):
+  for parent in node.parents:
+    assert parent.children is not None
+    parent.children.remove(node)
+    parent.removed_children.append(node)
+
+MCTS_C, MCTS_TEMP = math.sqrt(2), 0.5
+def _sample_tree(node:MCTSNode, best_tm:float) -> MCTSNode:
+  if node.children is None or len(node.children) == 0: return node
+  if len(unexplored:=[child for child in node.children if child.n == 0]): return random.choice(unexplored)
+  explored = [(child, ucb) for child in node.children if child.n != 0 and
+              not math.isinf(ucb:=-child.t/best_tm + MCTS_C*math.sqrt(math.log(node.n)/child.n))]
+  if not len(explored): return node
+  # softmax sample on the ucb
+  mx = max(ucb for _,ucb in explored)
+  return _sample_tree(random.choices([c for c,_ in explored], weights=[math.exp((ucb-mx)/MCTS_TEMP) for _,ucb in explored])[0], best_tm)
+
+# this will expand/remove sometimes
+def _sample_and_expand(root:MCTSNode, best_tm:float) -> Optional[MCTSNode]:
+  if root.children is None: _expand_node(root)
+  while root.children:
+    node = _sample_tree(root, best_tm)
+    if node.children is not None and len(node.children) == 0:
+      _remove_node(node)
+      continue
+    if node.n != 0:
+      if node.children is None: _expand_node(node)
+      assert node.children is not None
+      if len(node.children) == 0:
+        _remove_node(node)
+        continue
+      node = random.choice(node.children)
+    return node
+  return None
+
+def _backprop(bnode:MCTSNode, tm:float, strength=1.0):
+  if bnode.t > tm: bnode.t = tm
+  bnode.n += strength
+  for parent in bnode.parents: _backprop(parent, tm, strength/len(bnode.parents))
+
+graph_mcts_cnt = 0
+def mcts_search(lin:Kernel, rawbufs:List[Buffer], amt:int, allow_test_size=True, disable_cache=getenv("IGNORE_BEAM_CACHE"),
+                deadline:Optional[float]=None) -> Kernel:
+  global graph_mcts_cnt
+  key = _search_key(lin, amt, allow_test_size)
+  if (ret:=_search_cache_get("mcts_search", key, lin, disable_cache)) is not None: return ret
+
+  rawbufs = _ensure_buffer_alloc(rawbufs)
+  var_vals: Dict[Variable, int] = {k:(k.max+k.min)//2 for k in lin.ast.variables()}
+  dev, root, st = Device[lin.opts.device], MCTSNode(lin), time.perf_counter()
+  best, best_idx, best_tm = lin, 0, math.inf
+  seen_libs: Dict[bytes, MCTSNode] = {}
+  seen_asts: Dict[bytes, MCTSNode] = {}
+  for i in range(amt):
+    if _out_of_time(deadline): break
+    if (node:=_sample_and_expand(root, best_tm)) is None: break  # finished the whole tree
+    node.i = i  # when was node explored
+    if (sibling:=seen_asts.get(opt_key:=node.kernel.get_optimized_ast().key)) is not None:
+      _remove_node(node)
+      tm = sibling.t
+    else:
+      seen_asts[opt_key] = node
+      if (proc:=_try_compile_linearized_w_idx((i, node.kernel), dev.compiler)[1]) is None: tm = math.inf
+      elif (sibling:=seen_libs.get(proc[1])) is not None:
+        # NOTE: these should all be caught by the AST check, need to canonicalize
+        _remove_node(node)
+        tm = sibling.t
+      else:
+        seen_libs[proc[1]] = node
+        node.tm = tm = _time_candidate(node.kernel, proc[0], proc[1], var_vals, rawbufs, best_tm, allow_test_size)
+    if tm < best_tm: best, best_idx, best_tm = node.kernel, i, tm
+    if DEBUG >= 2: print(f"\r{time.perf_counter() - st:7.2f}s: {tm*1e6:12.2f} us     best: {best_tm*1e6:12.2f} us @ {best_idx+1:4d}      {i+1:4d}/{amt:4d}     {node.kernel.colored_shape()}\033[K", end="")  # noqa: E501
+    _backprop(node, tm)
+  if DEBUG >= 2: print()
+
+  if getenv("MCTSGRAPH"):
+    from tinygrad.engine.graph import nx, save_graph, GRAPHPATH
+    G = nx.DiGraph()
+    def add_node(node:MCTSNode):
+      if node.n == 0: return
+      for parent in node.parents: G.add_edge(parent, node)
+      gopts = node.kernel.applied_opts
+      edge_lbl = f"{str(gopts[-1].op)[7:]} {gopts[-1].axis} {gopts[-1].amt}" if len(gopts) else "ROOT"
+      G.add_node(node, label=f"{node.i+1}\n{node.tm*1e6:.2f} us\n{edge_lbl}\nt {node.t*1e6:.2f}\nn {node.n}",
+                 fillcolor="#80ff8080" if node.tm == best_tm else "#ffff8080", style='filled' if node.t == best_tm else '')
+      for child in (node.children or [])+node.removed_children: add_node(child)
+    add_node(root)
+    save_graph(G, f"{GRAPHPATH}.{graph_mcts_cnt}.mcts", '-Grankdir=LR')
+    graph_mcts_cnt += 1
+
+  if CACHELEVEL >= 1: diskcache_put("mcts_search", key, best.applied_opts)
+  return best
+
+# each of the amt samples restarts from lin and takes up to RANDOM_SEARCH_DEPTH random actions
+def random_search(lin:Kernel, rawbufs:List[Buffer], amt:int, allow_test_size=True, disable_cache=getenv("IGNORE_BEAM_CACHE"),
+                  deadline:Optional[float]=None, max_depth=getenv("RANDOM_SEARCH_DEPTH", 4)) -> Kernel:
+  key = _search_key(lin, amt, allow_test_size)
+  if (ret:=_search_cache_get("random_search", key, lin, disable_cache)) is not None: return ret
+
+  rawbufs = _ensure_buffer_alloc(rawbufs)
+  var_vals: Dict[Variable, int] = {k:(k.max+k.min)//2 for k in lin.ast.variables()}
+  dev, st = Device[lin.opts.device], time.perf_counter()
+  best, best_tm, seen_asts = lin, math.inf, set()
+  for i in range(amt):
+    if _out_of_time(deadline): break
+    k = lin
+    for _ in range(random.randint(1, max_depth)):
+      if not (acted:=get_kernel_actions(k, include_0=False)): break
+      k = random.choice(list(acted.values()))
+    if (opt_key:=k.get_optimized_ast().key) in seen_asts: continue
+    seen_asts.add(opt_key)
+    if (proc:=_try_compile_linearized_w_idx((i, k), dev.compiler)[1]) is None: continue
+    if (tm:=_time_candidate(k, proc[0], proc[1], var_vals, rawbufs, best_tm, allow_test_size)) < best_tm: best, best_tm = k, tm
+    if DEBUG >= 2: print(f"\r{time.perf_counter() - st:7.2f}s: {tm*1e6:12.2f} us     best: {best_tm*1e6:12.2f} us      {i+1:4d}/{amt:4d}     {k.colored_shape()}\033[K", end="")  # noqa: E501
+  if DEBUG >= 2: print()
+
+  if CACHELEVEL >= 1: diskcache_put("random_search", key, best.applied_opts)
+  return best
+
+# add your own here, strategies are called as fxn(lin, rawbufs, amt, allow_test_size, deadline=deadline) and return the best Kernel found
+search_strategies: Dict[str, Callable[..., Kernel]] = {"beam": beam_search, "mcts": mcts_search, "random": random_search}
+
+def search_kernel(lin:Kernel, rawbufs:List[Buffer], amt:int, strategy:str="beam", allow_test_size=True, budget:float=0.0) -> Kernel:
+  """Optimizes `lin` with the named search strategy, giving up and returning the best Kernel so far after `budget` seconds if it's set."""
+  if (fxn:=search_strategies.get(strategy)) is None: raise RuntimeError(f"unknown search strategy {strategy}, options are {list(search_strategies)}")
+  return fxn(lin, rawbufs, amt, allow_test_size, deadline=time.perf_counter()+budget if budget > 0 else None)
+
 def optimize_local_size(clprg:Callable, global_size:List[int], rawbufs:List[Buffer]) -> List[int]:
   test_rawbuffers = [Buffer(rawbufs[0].device, rawbufs[0].size, rawbufs[0].dtype).allocate(), *rawbufs[1:]] if rawbufs[0] in rawbufs[1:] else rawbufs
   MAX_WORKGROUP = 1024
@@ -204,4 +557,61 @@ def time_linearizer(lin:Kernel, rawbufs:List[Buffer], allow_test_size=True, max_
                       max_global_size=max_global_size if allow_test_size else None, clear_l2=clear_l2, cnt=cnt, name=to_function_name(lin.name))
 
   if CACHELEVEL >= 2: diskcache_put("time_linearizer", key, tms)
+  _put_features(lin, cast(List[UOp], p.uops), var_vals, min(tms))
   return min(tms)
+
+# *** fusion search: time the schedules of different scheduler fusion choices end to end ***
+
+fusion_vars = (FUSE_REDUCE_TAIL, FUSE_ARANGE, FUSE_CONV_BW)
+fusion_choices: List[Dict[str, int]] = [{v.key:x for v,x in zip(fusion_vars, xs)} for xs in itertools.product([1, 0], [0, 1], [0, 1])]
+
+def _time_schedule(lsis:List[LBScheduleItem], var_vals:Dict[Variable, int], cnt=3) -> float:
+  # the unrealized buffers are zeroed scratch, so nothing real is written and no kernel times on garbage (NaNs and denormals run slower)
+  scratch: Dict[LazyBuffer, Buffer] = {}
+  def _buf(lb:LazyBuffer) -> Buffer:
+    if lb.realized is not None: return lb.buffer
+    if (buf:=scratch.get(lb)) is None:
+      scratch[lb] = buf = Buffer(lb.device, lb.size, lb.dtype).allocate()
+      buf.copyin(memoryview(bytearray(buf.nbytes)))
+    return buf
+  # compiled outside the method_cache, the kernels of the losing schedules never run again
+  runners = []
+  for lsi in lsis:
+    bufs = [_buf(x) for x in lsi.outputs+lsi.inputs if x.size != 0]
+    p = get_kernel(Device[lsi.outputs[0].device].renderer, lsi.ast).to_program()
+    runners.append((r:=CompiledRunner(replace(p, dname=lsi.outputs[0].device)), [bufs[i] for i in r.p.globals]))
+  return min(sum(cast(float, r(bufs, var_vals, wait=True)) for r,bufs in runners) for _ in range(cnt))
+
+def fusion_search(outs:List[LazyBuffer]) -> Optional[Dict[str, int]]:
+  """Returns the `fusion_choices` entry whose schedule for `outs` runs fastest, or None if the graph can't be searched."""
+  if (key:=graph_key(outs)) is None: return None
+  if CACHELEVEL >= 1 and (val:=diskcache_get("fusion_search", key)) is not None: return val
+  # the current choice goes first, so it wins ties
+  current = {v.key:v.value for v in fusion_vars}
+  schedules: Dict[Tuple[bytes, ...], Tuple[Dict[str, int], List[LBScheduleItem], Dict[Variable, int]]] = {}
+  # a choice the scheduler (or codegen) can't do for this graph is dropped, the graph isn't searched if the current one fails
+  for choice in [current]+[x for x in fusion_choices if x != current]:
+    try:
+      with Context(FUSE_SEARCH=0, **choice): lsis, var_vals = create_lb_schedule(outs)
+    except Exception as e:
+      if DEBUG >= 2: print(f"fusion search: can't schedule with {choice}: {e}")
+      if choice is current: return None
+      continue
+    # only compute kernels on one device are searched
+    if not lsis or any(lsi.ast.op is not UOps.SINK for lsi in lsis) or not all_same([x.device for lsi in lsis for x in lsi.outputs]) or \
+      not all(all_int(x.shape) for lsi in lsis for x in lsi.outputs+lsi.inputs):
+      if choice is current: return None
+      continue
+    schedules.setdefault(tuple(lsi.ast.key for lsi in lsis), (choice, lsis, var_vals))
+  timed: List[Tuple[float, Dict[str, int]]] = []
+  for choice, lsis, var_vals in schedules.values() if len(schedules) > 1 else []:
+    try:
+      with Context(FUSE_SEARCH=0, **choice): timed.append((_time_schedule(lsis, var_vals), choice))
+    except Exception as e:
+      if DEBUG >= 2: print(f"fusion search: can't run the schedule with {choice}: {e}")
+      if choice is current: return None
+      continue
+    if DEBUG >= 2: print(f"fusion search: {len(lsis):3d} kernels {timed[-1][0]*1e6:10.2f} us with {choice}")
+  ret = min(timed, key=lambda x: x[0])[1] if timed else current
+  if CACHELEVEL >= 1: diskcache_put("fusion_search", key, ret)
+  return ret
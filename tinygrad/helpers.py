@@ -1,8 +1,8 @@
 from __future__ import annotations
 import os, functools, platform, time, re, contextlib, operator, hashlib, pickle, sqlite3, tempfile, pathlib, string, ctypes, sys, gzip
-import itertools, urllib.request, subprocess, shutil, math, json, contextvars
+import itertools, urllib.request, subprocess, shutil, math, json, contextvars, threading, collections
 from dataclasses import dataclass
-from typing import Dict, Tuple, Union, List, ClassVar, Optional, Iterable, Any, TypeVar, TYPE_CHECKING, Callable, Sequence
+from typing import Dict, Tuple, Union, List, ClassVar, Optional, Iterable, Any, TypeVar, TYPE_CHECKING, Callable, Sequence, Generic
 if TYPE_CHECKING:  # TODO: remove this and import TypeGuard from typing once minimum python supported version is 3.10
   from typing_extensions import TypeGuard
   from tinygrad.shape.shapetracker import sint
@@ -109,8 +109,11 @@ WINO, THREEFRY, CAPTURING, TRACEMETA = ContextVar("WINO", 0), ContextVar("THREEF
 GRAPH, GRAPHPATH, SAVE_SCHEDULE, RING = ContextVar("GRAPH", 0), getenv("GRAPHPATH", "/tmp/net"), ContextVar("SAVE_SCHEDULE", 0), ContextVar("RING", 1)
 MULTIOUTPUT, PROFILE, PROFILEPATH = ContextVar("MULTIOUTPUT", 1), ContextVar("PROFILE", 0), ContextVar("PROFILEPATH", temp("tinygrad_profile.json"))
 USE_TC, TC_OPT, AMX, TRANSCENDENTAL = ContextVar("TC", 1), ContextVar("TC_OPT", 0), ContextVar("AMX", 0), ContextVar("TRANSCENDENTAL", 1)
-FUSE_ARANGE, FUSE_CONV_BW = ContextVar("FUSE_ARANGE", 0), ContextVar("FUSE_CONV_BW", 0)
+FUSE_ARANGE, FUSE_CONV_BW, FUSE_REDUCE_TAIL = ContextVar("FUSE_ARANGE", 0), ContextVar("FUSE_CONV_BW", 0), ContextVar("FUSE_REDUCE_TAIL", 1)
+FUSE_SEARCH = ContextVar("FUSE_SEARCH", 0)
 SPLIT_REDUCEOP, AST_REWRITE, NO_MEMORY_PLANNER = ContextVar("SPLIT_REDUCEOP", 1), ContextVar("AST_REWRITE", 1), ContextVar("NO_MEMORY_PLANNER", 0)
+SCHEDULE_CACHE, LOWER_AHEAD, CPU_ASYNC = ContextVar("SCHEDULE_CACHE", 0), ContextVar("LOWER_AHEAD", 0), ContextVar("CPU_ASYNC", 0)
+BATCH_COMPILE, THREAD_OPT = ContextVar("BATCH_COMPILE", 0), ContextVar("THREAD_OPT", 0)
 
 @dataclass(frozen=True)
 class Metadata:
@@ -203,6 +206,48 @@ class ProfileLogger:
       with open(PROFILEPATH.value, "w") as f: f.write(json.dumps({"traceEvents": self.mjson}))
       print(f"Saved profile to {PROFILEPATH.value}. Use https://ui.perfetto.dev/ to open it.")
 
+# *** bounded memo tables ***
+
+# every memo table keeps at most CACHE_SIZE entries (0 is unbounded) and drops the least recently used one first
+CACHE_SIZE = getenv("CACHE_SIZE", 1<<16)
+_memo_tables: Dict[str, Any] = {}
+
+def memoize(name:str, maxsize:Optional[int]=None) -> Callable[[Callable[..., T]], Callable[..., T]]:
+  """functools.lru_cache that is bounded and registered by name, so it shows up in cache_stats() and clear_all_caches()"""
+  def decorator(fxn:Callable[..., T]) -> Callable[..., T]:
+    _memo_tables[name] = ret = functools.lru_cache(maxsize=(CACHE_SIZE if maxsize is None else maxsize) or None)(fxn)
+    return ret
+  return decorator
+
+class LRUCache(Generic[T, U]):
+  """the same for dicts that are filled by hand"""
+  def __init__(self, name:str, maxsize:Optional[int]=None):
+    self.cache: collections.OrderedDict[T, U] = collections.OrderedDict()
+    self.maxsize, self.hits, self.misses = CACHE_SIZE if maxsize is None else maxsize, 0, 0
+    _memo_tables[name] = self
+  def __len__(self) -> int: return len(self.cache)
+  def __contains__(self, key:T) -> bool: return key in self.cache
+  def get(self, key:T) -> Optional[U]:
+    if (ret:=self.cache.get(key)) is None: self.misses += 1
+    else:
+      self.hits += 1
+      self.cache.move_to_end(key)
+    return ret
+  def __setitem__(self, key:T, val:U):
+    self.cache[key] = val
+    self.cache.move_to_end(key)
+    if self.maxsize and len(self.cache) > self.maxsize: self.cache.popitem(last=False)
+  def clear(self): self.cache.clear()
+  def cache_info(self) -> Tuple[int, int, Optional[int], int]: return self.hits, self.misses, self.maxsize or None, len(self.cache)
+  def cache_clear(self):
+    self.cache.clear()
+    self.hits = self.misses = 0
+
+def cache_stats() -> Dict[str, Dict[str, Optional[int]]]:
+  return {name:dict(zip(("hits", "misses", "maxsize", "size"), c.cache_info())) for name,c in _memo_tables.items()}
+def clear_all_caches():
+  for c in _memo_tables.values(): c.cache_clear()
+
 # *** universal database cache ***
 
 _cache_dir: str = getenv("XDG_CACHE_HOME", os.path.expanduser("~/Library/Caches" if OSX else "~/.cache"))
@@ -210,17 +255,17 @@ CACHEDB: str = getenv("CACHEDB", os.path.abspath(os.path.join(_cache_dir, "tinyg
 CACHELEVEL = getenv("CACHELEVEL", 2)
 
 VERSION = 16
-_db_connection = None
+# sqlite connections can't be shared between threads, so every thread (eg. the lowering pool) opens its own. it's closed when the thread exits
+_db_local = threading.local()
 def db_connection():
-  global _db_connection
-  if _db_connection is None:
+  if (conn:=getattr(_db_local, "conn", None)) is None:
     os.makedirs(CACHEDB.rsplit(os.sep, 1)[0], exist_ok=True)
-    _db_connection = sqlite3.connect(CACHEDB, timeout=60, isolation_level="IMMEDIATE")
+    _db_local.conn = conn = sqlite3.connect(CACHEDB, timeout=60, isolation_level="IMMEDIATE")
     # another connection has set it already or is in the process of setting it
     # that connection will lock the database
-    with contextlib.suppress(sqlite3.OperationalError): _db_connection.execute("PRAGMA journal_mode=WAL").fetchone()
-    if DEBUG >= 7: _db_connection.set_trace_callback(print)
-  return _db_connection
+    with contextlib.suppress(sqlite3.OperationalError): conn.execute("PRAGMA journal_mode=WAL").fetchone()
+    if DEBUG >= 7: conn.set_trace_callback(print)
+  return conn
 
 def diskcache_clear():
   cur = db_connection().cursor()
@@ -239,6 +284,16 @@ def diskcache_get(table:str, key:Union[Dict, str, int]) -> Any:
   if (val:=res.fetchone()) is not None: return pickle.loads(val[0])
   return None
 
+def diskcache_values(table:str, key:Optional[Dict]=None) -> List[Any]:
+  if CACHELEVEL == 0: return []
+  cur = db_connection().cursor()
+  try:
+    res = cur.execute(f"SELECT val FROM '{table}_{VERSION}'" + (f" WHERE {' AND '.join([f'{x}=?' for x in key.keys()])}" if key else ""),
+                      tuple(key.values()) if key else ())
+  except sqlite3.OperationalError:
+    return []  # table doesn't exist
+  return [pickle.loads(x[0]) for x in res.fetchall()]
+
 _db_tables = set()
 def diskcache_put(table:str, key:Union[Dict, str, int], val:Any):
   if CACHELEVEL == 0: return val
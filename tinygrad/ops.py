@@ -1,11 +1,11 @@
 from __future__ import annotations
 from typing import Any, List, Optional, Set, Union, Tuple, Dict, Callable, cast, TYPE_CHECKING, TypeVar, DefaultDict
-import sys, time, functools, itertools, math, operator, ctypes, struct, hashlib
+import sys, time, functools, itertools, math, operator, ctypes, struct, hashlib, weakref, threading
 from enum import auto, IntEnum, Enum
 from collections import defaultdict
 from dataclasses import dataclass, field
 from tinygrad.dtype import ConstType, ImageDType, PtrDType, dtypes, DType
-from tinygrad.helpers import _CURRENT_KERNEL, ContextVar, pretty_print, prod, getenv, all_same
+from tinygrad.helpers import _CURRENT_KERNEL, ContextVar, pretty_print, prod, getenv, all_same, memoize
 from tinygrad.shape.symbolic import Variable, sint
 if TYPE_CHECKING:
   from tinygrad.shape.shapetracker import ShapeTracker
@@ -132,7 +132,37 @@ BUFFER_UOPS = {UOps.LOAD, UOps.STORE, UOps.CONST}
 COMMUTATIVE = {BinaryOps.ADD, BinaryOps.MUL, BinaryOps.MAX, BinaryOps.CMPNE, BinaryOps.XOR, BinaryOps.AND, BinaryOps.OR}
 END_FOR_UOP = {UOps.IF:(UOps.STORE, UOps.ENDIF), UOps.RANGE:(UOps.ASSIGN, UOps.ENDRANGE)}
 
-class UOp(MathTrait):
+def _arg_key(arg:Any) -> Any:
+  # 0.0 == -0.0 and 1 == 1.0 == True, they must not intern to the same UOp
+  if arg.__class__ is float: return (arg, math.copysign(1.0, arg))
+  if arg.__class__ is tuple: return tuple((x.__class__, _arg_key(x)) for x in arg)
+  return arg
+
+def _uncache(ucache:Dict[Tuple, weakref.KeyedRef], lock:threading.RLock, wr:weakref.KeyedRef):
+  with lock:
+    if ucache.get(wr.key) is wr: del ucache[wr.key]
+
+class UOpMetaClass(type):
+  # weak refs to every live UOp, by structure. the lock makes the insert after a miss atomic, it's an RLock because _uncache runs from the gc
+  ucache: Dict[Tuple, weakref.KeyedRef] = {}
+  lock = threading.RLock()
+  # the table is bound here, at interpreter exit the module globals are gone before the last UOps are freed
+  uncache = functools.partial(_uncache, ucache, lock)
+  def __call__(cls, op:UOps, dtype:DType=dtypes.void, src:Tuple[UOp,...]=tuple(), arg:Any=None):
+    # hash consing: a UOp that's structurally the same as a live one is that one, so they compare with `is`
+    if src.__class__ is not tuple: src = tuple(src)
+    key = (op, dtype, dtype.__class__, src, arg.__class__, arg if arg.__class__ is not float and arg.__class__ is not tuple else _arg_key(arg))
+    try:
+      if (wr:=UOpMetaClass.ucache.get(key)) is not None and (ret:=wr()) is not None: return ret
+    except TypeError: return super().__call__(op, dtype, src, arg)  # unhashable arg
+    ret = super().__call__(op, dtype, src, arg)
+    with UOpMetaClass.lock:
+      # another thread can have made the same UOp since the lookup, then that one is the UOp
+      if (wr:=UOpMetaClass.ucache.get(key)) is not None and (other:=wr()) is not None: return other
+      UOpMetaClass.ucache[key] = weakref.KeyedRef(ret, UOpMetaClass.uncache, key)
+    return ret
+
+class UOp(MathTrait, metaclass=UOpMetaClass):
   __slots__ = ["op", "dtype", "src", "arg"]
   def __init__(self, op: UOps, dtype:DType=dtypes.void, src: Tuple[UOp,...]=tuple(), arg:Any=None):
     # TODO: instant check rules here make debugging easier
@@ -141,6 +171,7 @@ class UOp(MathTrait):
     #if op is UOps.ALU and arg not in (BinaryOps.CMPNE, BinaryOps.CMPLT, TernaryOps.WHERE): assert all_same([dtype] + [x.dtype for x in src])
     #if op is UOps.CAST: assert dtype.count == src[0].dtype.count, f"cast can't change vectorization {src[0].dtype} --> {dtype}"
     self.op, self.dtype, self.src, self.arg = op, dtype, src, arg
+  def __reduce__(self): return UOp, (self.op, self.dtype, self.src, self.arg)
   def replace(self, op: Optional[UOps]=None, dtype:Optional[DType]=None, src: Optional[Tuple[UOp,...]]=None, arg:Any=None):
     return UOp(op or self.op, dtype or self.dtype, self.src if src is None else src, self.arg if arg is None else arg)
   @property
@@ -206,7 +237,7 @@ class UOp(MathTrait):
       out_dtype = dtypes.bool.vec(out_dtype.count) if out_dtype.count > 1 else dtypes.bool
     return UOp(UOps.ALU, out_dtype, (self,)+src, arg)
   @staticmethod
-  @functools.lru_cache(None)
+  @memoize("UOp.const")
   def const(dtype:DType, b:Tuple[ConstType, ...]|ConstType|Variable): return UOp._const(dtype, b)
   @staticmethod
   def _const(dtype:DType, b:Tuple[ConstType, ...]|ConstType|Variable):
@@ -222,7 +253,16 @@ class UOp(MathTrait):
     return UOp(UOps.RANGE, dtype=dtype, src=(UOp.const(dtype, start), UOp.const(dtype, end)), arg=(idx,))
   def reduce(self, op, *rng): return UOp(UOps.REDUCE, self.dtype, (self,) + rng, op)
   @functools.cached_property
-  def parents(self) -> Dict[UOp, None]: return {**{x:None for x in self.src}, **{k:None for x in self.src for k in x.parents.keys()}}
+  def parents(self) -> Dict[UOp, None]:
+    # the srcs, then the parents of each src in order. this walks the graph once instead of merging the parents of every src
+    ret: Dict[UOp, None] = {}
+    stack, seen = [self], set()
+    while stack:
+      if (u:=stack.pop()) in seen: continue
+      seen.add(u)
+      ret.update(dict.fromkeys(u.src))
+      stack.extend(reversed(u.src))
+    return ret
   @property  # parents with self
   def sparents(self) -> Dict[UOp, None]: return {**self.parents, self:None}
   @functools.cached_property
@@ -293,6 +333,7 @@ class KernelInfo:
   local_dims: int = 0           # number of local dimensions  (this is remapping RANGE to SPECIAL)
   upcasted: int = 0             # count that are upcasted     (this is remapping RANGE to EXPAND)
   dont_use_locals: bool = False # don't use local indexing
+  threaded: bool = False        # first global is split across cpu threads (this is remapping RANGE to SPECIAL)
 
 # ***** ops in python *****
 
@@ -335,6 +376,38 @@ def uop_alu_resolve(u:UOp) -> sint:
   if u.op is UOps.ALU: return exec_alu(u.arg, u.dtype, tuple(map(uop_alu_resolve, u.src)))
   raise RuntimeError(f"ALU resolve fail @ {u.op}")
 
+# ***** uop graph helpers *****
+# these are iterative and linear in the size of the graph, so deep graphs don't hit the recursion limit
+
+def toposort(*roots:UOp) -> Dict[UOp, None]:
+  """every UOp reachable from roots, each one after all of its srcs"""
+  ret: Dict[UOp, None] = {}
+  stack: List[Tuple[UOp, bool]] = [(x, False) for x in reversed(roots)]
+  while stack:
+    u, srcs_done = stack.pop()
+    if u in ret: continue
+    if srcs_done: ret[u] = None
+    else: stack.extend([(u, True)] + [(x, False) for x in reversed(u.src) if x not in ret])
+  return ret
+
+def children_map(*roots:UOp) -> Dict[UOp, List[UOp]]:
+  """the users of every UOp reachable from roots, keyed and listed in toposort order"""
+  children: Dict[UOp, List[UOp]] = {}
+  for u in toposort(*roots):
+    children[u] = []
+    for x in u.src: children[x].append(u)
+  return children
+
+def reachable(x:UOp, edges:Dict[UOp, List[UOp]], expand:Callable[[UOp], bool]=lambda _: True) -> Dict[UOp, None]:
+  """every UOp reachable from x along edges, not including x. edges are only followed out of UOps where expand is True"""
+  ret: Dict[UOp, None] = {}
+  stack = list(edges[x])
+  while stack:
+    if (u:=stack.pop()) in ret: continue
+    ret[u] = None
+    if expand(u): stack.extend(edges[u])
+  return ret
+
 # ***** uop helpers *****
 
 def print_uops(uops:List[UOp]):
@@ -388,6 +461,9 @@ def get_location() -> Tuple[str, int]:
 def lines(fn) -> List[str]:
   with open(fn) as f: return f.readlines()
 
+def _early_reject_set(upat_match:List[UPat]) -> Set[Tuple[UOps, Any]]:
+  return set((pp.op[0], pp.arg) for pp in upat_match if pp.op is not None and len(pp.op) == 1)
+
 class UPat(MathTrait):
   __slots__ = ["op", "dtype", "arg", "name", "src", "_any"]
   def __init__(self, op:Optional[Union[UOps, Tuple[UOps, ...]]]=None, dtype:Optional[Union[DType, Tuple[DType, ...]]]=None,
@@ -411,8 +487,7 @@ class UPat(MathTrait):
 
     if custom_early_reject is not None: self.early_reject = custom_early_reject
     else:
-      upat_match = [src] if isinstance(src, UPat) else ([] if src is None else self.src[0])
-      self.early_reject = set((pp.op[0], pp.arg) for pp in upat_match if pp.op is not None and len(pp.op) == 1)
+      self.early_reject = _early_reject_set([src] if isinstance(src, UPat) else ([] if src is None else self.src[0]))
 
   @staticmethod
   def any(*src): return UPatAny(src=src)
@@ -476,6 +551,117 @@ class UPatAny(UPat):
       if (match:=x.match(uop, store.copy())): return match
     return []
 
+# *** compiled pattern matcher ***
+
+def _ler(uop:UOp) -> Set[Tuple[UOps, Any]]: return set([v for u in uop.src for v in ((u.op, u.arg), (u.op, None))])
+
+def _match_rewrite(p:UPat, fxn:Callable, uop:UOp) -> Optional[UOp]:
+  if not p.early_reject.issubset(_ler(uop)): return None
+  return fxn(**matches[0]) if (matches:=p.match(uop, {})) else None
+
+def _indent(lines:List[str]) -> List[str]: return ["  "+x for x in lines]
+def _if(cond:str, body:List[str]) -> List[str]: return [f"if {cond}:", *_indent(body)] if cond else body
+
+class _UPatCompiler:
+  # renders a UPat as nested ifs that bind names to locals. a failed check falls through to the next permutation, so the first path to reach
+  # the continuation is the first match of UPat.match
+  def __init__(self):
+    self.consts: Dict[str, Any] = {}
+    self.const_names: Dict[int, str] = {}
+    self.cnt = 0
+  def const(self, x:Any) -> str:
+    if id(x) not in self.const_names: self.consts[self.const_names.setdefault(id(x), f"c{len(self.consts)}")] = x
+    return self.const_names[id(x)]
+  def local(self) -> str:
+    self.cnt += 1
+    return f"s{self.cnt}"
+
+  def conds(self, p:UPat, v:str) -> List[str]:
+    ret = []
+    if p.op is not None: ret.append(f"{v}.op is {self.const(next(iter(p.op)))}" if len(p.op) == 1 else f"{v}.op in {self.const(p.op)}")
+    if p.allowed_len != 0: ret.append(f"len({v}.src) == {p.allowed_len}")
+    if p.arg is not None: ret.append(f"not {self.const(p.arg)} != {v}.arg")
+    if p.dtype is not None: ret.append(f"{v}.dtype in {self.const(p.dtype)}")
+    return ret
+
+  def expr(self, p:UPat, v:str, names:Dict[str, str]) -> Optional[str]:
+    # a UPat that doesn't bind new names is just a condition, it doesn't matter which of its permutations matches
+    if type(p) is not UPat or (p.name is not None and p.name not in names): return None
+    ret = ([f"{v} is {names[p.name]}"] if p.name is not None else []) + self.conds(p, v)
+    if p.src is not None and isinstance(p.src[0], itertools.repeat):
+      if (sub:=self.expr(next(p.src[0]), x:=self.local(), names)) is None: return None
+      if sub: ret.append(f"all({sub} for {x} in {v}.src)")
+    elif p.src is not None:
+      perms: List[str] = []
+      for vp in p.src:
+        if None in (subs:=[self.expr(x, f"{v}.src[{i}]", names) for i,x in enumerate(vp)]): return None
+        # zip stops at the shorter one, without a fixed length the srcs past the end match anything
+        perms.append(" and ".join(f"({s})" if p.allowed_len else f"(len({v}.src) <= {i} or {s})" for i,s in enumerate(subs) if s))
+      if all(perms): ret.append(perms[0] if len(perms) == 1 else "(" + " or ".join(f"({x})" for x in perms) + ")")
+    return " and ".join(ret)
+
+  def match(self, p:UPat, v:str, names:Dict[str, str], cont:Callable[[Dict[str, str]], List[str]], bail:List[str]) -> List[str]:
+    if (e:=self.expr(p, v, names)) is not None: return _if(e, cont(names))
+    if type(p) is not UPat: return bail
+    conds = self.conds(p, v)
+    if p.name is not None:
+      if p.name in names: conds.insert(0, f"{v} is {names[p.name]}")
+      else: names = {**names, p.name:v}
+    return _if(" and ".join(conds), self.match_src(p, v, names, cont, bail))
+
+  def match_src(self, p:UPat, v:str, names:Dict[str, str], cont:Callable[[Dict[str, str]], List[str]], bail:List[str]) -> List[str]:
+    if p.src is None: return cont(names)
+    if isinstance(p.src[0], itertools.repeat):
+      if (e:=self.expr(rp:=next(p.src[0]), x:=self.local(), names)) is not None: return _if(f"all({e} for {x} in {v}.src)" if e else "", cont(names))
+      # the first src binds the names, the rest have to match with them. with no srcs the names aren't bound at all
+      def rest(n:Dict[str, str]) -> List[str]:
+        if (e:=self.expr(rp, y:=self.local(), n)) is None: return bail
+        return _if(f"all({e} for {y} in {v}.src[1:])" if e else "", cont(n))
+      return [f"if len({v}.src) == 0:", *_indent(bail), f"{x} = {v}.src[0]", *self.match(rp, x, names, rest, bail)]
+    if (n:=len(p.src[0])) == 0: return cont(names)
+    # without a fixed length, UPat.match matches fewer srcs than there are UPats
+    ret = [] if p.allowed_len else [f"if len({v}.src) < {n}:", *_indent(bail)]
+    # the srcs of the root get the same names in every UPat, so UPats in a row can share the unpack
+    ret.append(f"{', '.join(srcs:=[f'u{i}' if v == 'u' else self.local() for i in range(n)])}, = {v}.src" + ("" if p.allowed_len else f"[:{n}]"))
+    for vp in p.src: ret += self.match_seq(list(zip(srcs, vp)), names, cont, bail)
+    return ret
+
+  def match_seq(self, pats:List[Tuple[str, UPat]], names:Dict[str, str], cont:Callable[[Dict[str, str]], List[str]], bail:List[str]) -> List[str]:
+    if not pats: return cont(names)
+    return self.match(pats[0][1], pats[0][0], names, lambda n: self.match_seq(pats[1:], n, cont, bail), bail)
+
+def _call_fxn(f:str, bail:List[str], names:Dict[str, str]) -> List[str]:
+  if not all(k.isidentifier() for k in names): return bail
+  return [f"if (ret:={f}({', '.join(f'{k}={v}' for k,v in names.items())})) is not None: return ret", "break"]
+
+@functools.lru_cache(None)
+def compile_patterns(patterns:Tuple[Tuple[UPat, Callable], ...], rest:Optional[Callable[[UOp], Optional[UOp]]]=None) \
+  -> Callable[[UOp], Optional[UOp]]:
+  """one function that tries the patterns in order, then rest. a pattern whose fxn returns None doesn't stop the search"""
+  if not patterns and rest is not None: return rest
+  c, blocks = _UPatCompiler(), []
+  for p,fxn in patterns:
+    # a UPat that can't be compiled runs UPat.match, the compiled checks that got there had no side effects
+    bail = [f"if (ret:={c.const(functools.partial(_match_rewrite, p, fxn))}(u)) is not None: return ret", "break"]
+    call = functools.partial(_call_fxn, c.const(fxn), bail)
+    if type(p) is not UPat: cond, body = "", bail
+    else: cond, body = " and ".join(c.conds(p, "u")), c.match_src(p, "u", {} if p.name is None else {p.name:"u"}, call, bail)
+    # each permutation that binds new names copies the rest of the UPat, that can blow up
+    if len(body) > 1000 or max(len(x)-len(x.lstrip()) for x in body) > 150: body = bail
+    unpack = body.pop(0) if body[0].startswith("u0") else ""
+    # when each src is matched by a fixed UPat, a match implies the early reject
+    if not p.early_reject <= (set() if p.src is None or isinstance(p.src[0], itertools.repeat) else _early_reject_set(p.src[0])):
+      body = ["if ler is None: ler = _ler(u)", f"if not {c.const(p.early_reject)}.issubset(ler): break", *body]
+    blocks.append((cond, unpack, ["while True:", *_indent(body if body[-1] == "break" else body + ["break"])]))
+  # UPats in a row with the same checks on the root share them
+  lines = ["def rewrite(u):", "  ler = None"]
+  for (cond, unpack), grp in itertools.groupby(blocks, key=lambda x: x[:2]):
+    lines += _indent(_if(cond, ([unpack] if unpack else []) + [l for _,_,block in grp for l in block]))
+  lines.append("  return None" if rest is None else f"  return {c.const(rest)}(u)")
+  # the source is generated from the UPats, not user input
+  exec("\n".join(lines), glbls:={"_ler":_ler, **c.consts})  # pylint: disable=exec-used
+  return glbls["rewrite"]
+
 class PatternMatcher:
   def __init__(self, patterns:List[Tuple[UPat, Callable]]):
     self.patterns = patterns
@@ -484,16 +670,23 @@ class PatternMatcher:
     for p,fxn in self.patterns:
       assert p.op is not None
       for uop in p.op: self.pdict[(uop, p.arg)].append((p, fxn, p.early_reject))
+    # the patterns for each (op, arg) are compiled the first time they're used, args without patterns of their own use (op, None)
+    self.compiled: Dict[Tuple[UOps, Any], Callable[[UOp], Optional[UOp]]] = \
+      {k:functools.partial(self._compile, k) for k in [*self.pdict.keys(), *[(op, None) for op in UOps]]}
 
   @functools.lru_cache(None)  # pylint: disable=method-cache-max-size-none
   def __add__(self, more:PatternMatcher): return PatternMatcher(self.patterns+more.patterns)
 
-  def rewrite(self, uop:UOp) -> Optional[UOp]:
-    ler = set([v for u in uop.src for v in ((u.op, u.arg), (u.op, None))])
-    for p,fxn,early_reject in self.pdict[(uop.op, uop.arg)] + ([] if uop.arg is None else self.pdict[(uop.op, None)]):
-      if not early_reject.issubset(ler): continue
-      if (matches := p.match(uop, {})) and (ret:=fxn(**matches[0])) is not None: return ret # NOTE: if it returns None, we keep trying to match
-    return None
+  def _compiled(self, key:Tuple[UOps, Any]) -> Callable[[UOp], Optional[UOp]]:
+    if isinstance(fxn:=self.compiled[key], functools.partial):
+      # the patterns with an arg are tried before the ones without
+      rest = None if key[1] is None else self._compiled((key[0], None))
+      self.compiled[key] = fxn = compile_patterns(tuple((p,f) for p,f,_ in self.pdict.get(key, [])), rest)
+    return fxn
+  def _compile(self, key:Tuple[UOps, Any], uop:UOp) -> Optional[UOp]: return self._compiled(key)(uop)
+
+  # NOTE: if fxn returns None, we keep trying to match
+  def rewrite(self, uop:UOp) -> Optional[UOp]: return (self.compiled.get((uop.op, uop.arg)) or self.compiled[(uop.op, None)])(uop)
 
 # *** tracking pattern matcher ***
 
@@ -509,8 +702,11 @@ contexts: List[TrackedRewriteContext] = []
 class TrackedPatternMatcher(PatternMatcher):
   def __init__(self, patterns:List[Tuple[UPat, Callable]]):
     super().__init__(patterns)
-    for p,_ in self.patterns:
+    # each pattern is compiled on its own so it can be timed
+    self.pcompiled: Dict[Tuple[UPat, Callable], Callable[[UOp], Optional[UOp]]] = {}
+    for p,fxn in self.patterns:
       if p not in match_stats: match_stats[p] = [0,0,0.0,0.0]
+      self.pcompiled[(p,fxn)] = compile_patterns(((p,fxn),))
 
   def rewrite(self, uop:UOp) -> Optional[UOp]:
     ret = None
@@ -521,7 +717,7 @@ class TrackedPatternMatcher(PatternMatcher):
         match_stats[p][2] += time.perf_counter()-st
         continue
       match_stats[p][1] += 1
-      if (matches := p.match(uop, {})) and (ret:=fxn(**matches[0])) is not None:
+      if (ret:=self.pcompiled[(p,fxn)](uop)) is not None:
         match_stats[p][0] += 1
         match_stats[p][2] += (et:=time.perf_counter()-st)
         match_stats[p][3] += et
@@ -555,15 +751,13 @@ if TRACK_MATCH_STATS:
 class RewriteContext:
   def __init__(self, pm):
     self.pm: PatternMatcher = pm
-    self.nodes: Dict[Tuple, UOp] = {}
     self.replace: Dict[UOp, UOp] = {}
   def rewrite(self, n:UOp) -> UOp:
-    if rn := self.replace.get(n): return rn
-    replace_source = (n.op, n.dtype, new_src:=tuple(map(self.rewrite, n.src)), n.arg)
-    if found := self.nodes.get(replace_source): self.replace[n] = found
-    else:
-      x = UOp(*replace_source) if new_src != n.src else n
-      self.nodes[replace_source] = self.replace[n] = found = self.rewrite(new_x) if (new_x := self.pm.rewrite(x)) else x
+    if (rn := self.replace.get(n)) is not None: return rn
+    # UOps are interned, the rebuilt node is the same object for every n that rebuilds to it
+    x = UOp(n.op, n.dtype, new_src, n.arg) if (new_src:=tuple(map(self.rewrite, n.src))) != n.src else n
+    if (found := self.replace.get(x)) is None: self.replace[x] = found = self.rewrite(new_x) if (new_x := self.pm.rewrite(x)) else x
+    self.replace[n] = found
     return found
 def graph_rewrite(sink:UOp, pm:PatternMatcher) -> UOp:
   if TRACK_MATCH_STATS >= 2:
@@ -192,11 +192,13 @@ class ClangRenderer(CStyleLanguage):
   float4 = "(float4)"
   has_local = False
   global_max = None
+  threads = getenv("CLANG_THREADS", os.cpu_count() or 1)
   infinity = "__builtin_inff()"
   nan = '__builtin_nanf("")'
 
   # language options
   buffer_suffix = " restrict"
+  code_for_workitem = {"g": lambda x: "core_id"}
   type_map = {dtypes.bool:"_Bool", dtypes.half:"__fp16"}
   code_for_op = {**({k:v for k,v in CStyleLanguage().code_for_op.items() if k not in [UnaryOps.EXP2, UnaryOps.SIN, UnaryOps.LOG2]}),
                  UnaryOps.SQRT: lambda x,dtype: f"__builtin_sqrtl({x})" if dtype == dtypes.float64 else f"__builtin_sqrtf({x})",
@@ -210,6 +212,8 @@ class ClangRenderer(CStyleLanguage):
     return f"typedef {self.render_dtype(dt.scalar())} {self.render_dtype(dt)} __attribute__((aligned({(sz:=dt.itemsize)}),vector_size({sz})));"
 
   def render_kernel(self, function_name, kernel, bufs, uops, prefix=None) -> str:
+    # threaded kernels take the core id as the last argument
+    if any(uop.op is UOps.SPECIAL for uop in uops): bufs = bufs + [("core_id", (dtypes.int, False))]
     prefix, macros = [self.render_vector_prefix(dt) for dt in dedup(uop.dtype for uop in uops if uop.dtype.count>1)], []
     # https://github.com/corsix/amx
     for name, (N, M, _), dtype_in, _, _, _, _, _ in dedup([uop.arg for uop in uops if uop.op is UOps.WMMA]):
@@ -437,6 +441,7 @@ static inline __attribute__((device)) bool operator==(hip_bfloat16 a, hip_bfloat
 
 class DSPRenderer(ClangRenderer):
   device = "DSP"
+  threads = 0
   supports_float4 = False
   buffer_suffix = " restrict __attribute__((align_value(128)))"
   kernel_prefix = "__attribute__((noinline)) "
@@ -13,27 +13,30 @@ class ClangGraph(GraphRunner):
   def __init__(self, jit_cache: List[ExecItem], input_rawbuffers: List[Buffer], var_vals: Dict[Variable, int]):
     super().__init__(jit_cache, input_rawbuffers, var_vals)
     if not all(isinstance(ji.prg, CompiledRunner) for ji in jit_cache): raise GraphException
+    # the batched function runs on one thread, threaded kernels run on the pool instead
+    if any(cast(CompiledRunner, ji.prg).p.global_size is not None for ji in jit_cache): raise GraphException("can't graph threaded kernels")
+
+    # batched takes one packed block with the address of every buffer (inputs first) followed by the vars. a replay only rewrites the slots of
+    # inputs that changed, and the source has no addresses in it so it hits the compiler cache
+    bufs = dedup(input_rawbuffers + [b for ji in jit_cache for b in ji.bufs if b is not None])
+    self.args = (ctypes.c_uint64 * (len(bufs) + len(self.vars)))(*[ctypes.addressof(b._buf) for b in bufs])
+    self.input_bufs = [b._buf for b in input_rawbuffers]
 
     prgs = '\n'.join(dedup([cast(CompiledRunner, ji.prg).p.src for ji in jit_cache]))
-    args = [f"{render_dtype(x.dtype)}* arg{i}" for i,x in enumerate(input_rawbuffers)]
-    args += sorted([f"int {v.expr}" for v in var_vals])
-    code = ["void batched("+','.join(args)+") {"]
+    code = ["void batched(unsigned long long* restrict args) {"] + [f"  int {v.expr} = args[{len(bufs)+i}];" for i,v in enumerate(self.vars)]
     for ji in jit_cache:
-      args = []
-      for buf in ji.bufs:
-        assert buf is not None
-        if buf in input_rawbuffers:
-          args.append(f"arg{input_rawbuffers.index(buf)}")
-        else:
-          args.append(f"({render_dtype(buf.dtype)}*)0x{ctypes.addressof(buf._buf):X}")
+      args = [f"({render_dtype(buf.dtype)}*)args[{bufs.index(buf)}]" for buf in cast(List[Buffer], ji.bufs)]
       args += [x.expr for x in cast(CompiledRunner, ji.prg).p.vars]
       code.append(f"  {cast(CompiledRunner, ji.prg).p.function_name}({','.join(args)});")
     code.append("}")
     if DEBUG >= 4: print("\n".join(code))
     compiler = Device["CLANG"].compiler
     assert compiler is not None
-    self.clprg = ClangProgram("batched", compiler.compile(prgs+"\n"+"\n".join(code))) # no point in caching the pointers
+    self.clprg = ClangProgram("batched", compiler.compile_cached(prgs+"\n"+"\n".join(code)))
 
   def __call__(self, rawbufs: List[Buffer], var_vals: Dict[Variable, int], wait=False):
-    return cpu_time_execution(
-    lambda: self.clprg(*[x._buf for x in rawbufs], *[x[1] for x in sorted(var_vals.items(), key=lambda x: x[0].expr)]), enable=wait)
\ No newline at end of file
+    for i,(buf,old) in enumerate(zip(rawbufs, self.input_bufs)):
+      if buf._buf is not old: self.args[i], self.input_bufs[i] = ctypes.addressof(buf._buf), buf._buf
+    for i,v in enumerate(self.vars, len(self.args)-len(self.vars)): self.args[i] = var_vals[v]
+    if wait: return cpu_time_execution(lambda: self.clprg.fxn(self.args), enable=True)
+    self.clprg.fxn(self.args)
@@ -1,8 +1,15 @@
-from typing import Optional, List
-import ctypes, subprocess, pathlib, tempfile
-from tinygrad.device import Compiled, Compiler, MallocAllocator
-from tinygrad.helpers import cpu_time_execution, DEBUG, cpu_objdump
+from __future__ import annotations
+from typing import Optional, List, Any
+import ctypes, ctypes.util, functools, subprocess, pathlib, tempfile, platform, mmap, weakref
+from concurrent.futures import ThreadPoolExecutor
+from tinygrad.device import Compiled, Compiler, MallocAllocator, CPUQueue
+from tinygrad.helpers import cpu_time_execution, DEBUG, cpu_objdump, dedup, getenv
 from tinygrad.renderer.cstyle import ClangRenderer
+from tinygrad.runtime.support.elf import jit_loader
+import tinygrad.runtime.autogen.libc as libc
+
+# link the kernels in process instead of through the linker and dlopen, needs ELF and a relocation set elf.relocate knows
+CLANG_JIT = getenv("CLANG_JIT", int(platform.system() == "Linux" and platform.machine() in {"x86_64", "aarch64"}))
 
 class ClangCompiler(Compiler):
   def __init__(self, cachekey="compile_clang", args:Optional[List[str]]=None):
@@ -16,18 +23,87 @@ class ClangCompiler(Compiler):
                                '-', '-o', str(output_file.name)], input=src.encode('utf-8'))
       return pathlib.Path(output_file.name).read_bytes()
 
+  def compile_batch(self, srcs:List[str]) -> Optional[bytes]:
+    # ClangProgram loads each kernel from the library by name and they share one load
+    return self.compile_cached("\n".join(dedup(srcs)))
+
+class ClangJITCompiler(ClangCompiler):
+  def __init__(self, cachekey="compile_clang_jit", args:Optional[List[str]]=None): super().__init__(cachekey, args)
+
+  def compile(self, src:str) -> bytes:
+    # arm needs __clear_cache to flush the code it loads, without it the real linker and dlopen do the loading
+    if platform.machine() == "aarch64" and clear_icache() is None: return super().compile(src)
+    # the object file comes back on stdout, there's no linker run and no file
+    obj = subprocess.check_output(['clang', '-c', *self.args, '-O2', '-Wall', '-Werror', '-x', 'c', '-fPIC', '-ffreestanding', '-fno-math-errno',
+                                   '-g0', '-fno-stack-protector', '-fno-unwind-tables', '-fno-asynchronous-unwind-tables', '-', '-o', '-'],
+                                  input=src.encode('utf-8'))
+    try: jit_loader(obj)
+    # calls into libc (memcpy from a big copy) and relocations jit_loader doesn't know need the real linker
+    except (RuntimeError, NotImplementedError): return super().compile(src)
+    return obj
+
+# persistent workers for threaded kernels, the calling thread runs the first chunk of core ids. made on the first threaded launch
+@functools.lru_cache(None)
+def clang_pool() -> ThreadPoolExecutor: return ThreadPoolExecutor(max(ClangRenderer.threads-1, 1), thread_name_prefix="clang")
+
+@functools.lru_cache(None)
+def clear_icache() -> Optional[Any]:
+  """libgcc's __clear_cache, arm doesn't keep the instruction cache coherent with the stores that wrote the code. None if there's no libgcc"""
+  for name in [x for x in [ctypes.util.find_library("gcc_s"), "libgcc_s.so.1"] if x is not None]:
+    try: fxn = ctypes.CDLL(name)["__clear_cache"]
+    except (OSError, AttributeError): continue
+    fxn.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    return fxn
+  return None
+
+class JITImage:
+  def __init__(self, obj:bytes):
+    # jit_loader already relocated the image, it's written while the map is writable and only then made executable
+    image, self.fxns = jit_loader(obj)
+    self.mem = mmap.mmap(-1, len(image), flags=mmap.MAP_PRIVATE|mmap.MAP_ANONYMOUS, prot=mmap.PROT_READ|mmap.PROT_WRITE)
+    self.mem.write(image)
+    self.addr = ctypes.addressof(ctypes.c_char.from_buffer(self.mem))
+    if libc.mprotect(self.addr, len(image), mmap.PROT_READ|mmap.PROT_EXEC) != 0: raise RuntimeError("can't make the jit image executable")
+    if platform.machine() == "aarch64":
+      if (flush:=clear_icache()) is None: raise RuntimeError("loading objects on arm needs libgcc's __clear_cache")
+      flush(self.addr, self.addr+len(image))
+  def __getitem__(self, name:str): return ctypes.CFUNCTYPE(None)(self.addr + self.fxns[name])
+
+def _dlopen(lib:bytes) -> ctypes.CDLL:
+  # write to disk so we can load it. NOTE: not a memfd, dlopen returns the old library for a /proc/self/fd path it has seen before
+  with tempfile.NamedTemporaryFile(delete=True) as cached_file_path:
+    pathlib.Path(cached_file_path.name).write_bytes(lib)
+    return ctypes.CDLL(str(cached_file_path.name))
+
+# the kernels of a compile_batch library share one load for as long as any of their programs are alive
+loaded_libs: weakref.WeakValueDictionary[bytes, Any] = weakref.WeakValueDictionary()
+
 class ClangProgram:
   def __init__(self, name:str, lib:bytes):
     if DEBUG >= 6: cpu_objdump(lib)
     self.name, self.lib = name, lib
-    # write to disk so we can load it
-    with tempfile.NamedTemporaryFile(delete=True) as cached_file_path:
-      pathlib.Path(cached_file_path.name).write_bytes(lib)
-      self.fxn = ctypes.CDLL(str(cached_file_path.name))[name]
+    if (loaded:=loaded_libs.get(lib)) is None:
+      is_obj = lib[:4] == b"\x7fELF" and libc.Elf64_Ehdr.from_buffer_copy(lib).e_type == libc.ET_REL
+      loaded_libs[lib] = loaded = JITImage(lib) if is_obj else _dlopen(lib)
+    self.loaded, self.fxn = loaded, loaded[name]  # the program keeps the code mapped
+
+  def _run_cores(self, start:int, end:int, args):
+    for core_id in range(start, end): self.fxn(*args, core_id)
+
+  def _run_threaded(self, cores:int, args):
+    n = min(cores, ClangRenderer.threads)
+    chunks = [(i*cores//n, (i+1)*cores//n) for i in range(n)]
+    futs = [clang_pool().submit(self._run_cores, s, e, args) for s,e in chunks[1:]]
+    self._run_cores(*chunks[0], args)
+    for f in futs: f.result()
 
-  def __call__(self, *bufs, vals=(), wait=False): return cpu_time_execution(lambda: self.fxn(*bufs, *vals), enable=wait)
+  def __call__(self, *bufs, vals=(), global_size=None, local_size=None, wait=False):
+    if global_size is None: return cpu_time_execution(lambda: self.fxn(*bufs, *vals), enable=wait)
+    return cpu_time_execution(lambda: self._run_threaded(global_size[0], (*bufs, *vals)), enable=wait)
 
 class ClangDevice(Compiled):
   def __init__(self, device:str):
     from tinygrad.runtime.graph.clang import ClangGraph
-    super().__init__(device, MallocAllocator, ClangRenderer(), ClangCompiler(), ClangProgram, ClangGraph)
+    super().__init__(device, MallocAllocator, ClangRenderer(), ClangJITCompiler() if CLANG_JIT else ClangCompiler(), ClangProgram, ClangGraph)
+    self.queue = CPUQueue(device)
+  def synchronize(self): self.queue.synchronize()
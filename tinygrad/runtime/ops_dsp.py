@@ -1,5 +1,5 @@
 from __future__ import annotations
-from typing import Tuple, Any
+from typing import Tuple, List, Optional, Any
 import ctypes, os, mmap, tempfile, pathlib, array, functools, threading, contextlib
 from tinygrad.device import BufferOptions, Compiled, Allocator
 from tinygrad.helpers import from_mv, getenv, DEBUG, round_up, mv_address, to_mv, cpu_objdump
@@ -59,6 +59,9 @@ class DSPAllocator(Allocator):
   def copyout(self, dest:memoryview, src:DSPBuffer): ctypes.memmove(from_mv(dest), src.va_addr, dest.nbytes)
   def offset(self, buf, size:int, offset:int): return DSPBuffer(buf.va_addr+offset, size, buf.share_info, buf.offset+offset)
 
+class DSPCompiler(ClangCompiler):
+  def compile_batch(self, srcs:List[str]) -> Optional[bytes]: return None  # DSPProgram runs the whole library, it can't pick a function
+
 class DSPDevice(Compiled):
   def __init__(self, device:str=""):
     self.ion_fd = os.open('/dev/ion', os.O_RDONLY)
@@ -71,7 +74,7 @@ class DSPDevice(Compiled):
       self.link_ld.flush()
 
     compiler_args = ["--target=hexagon", "-mcpu=hexagonv65", "-fuse-ld=lld", "-nostdlib", "-mhvx=v65", "-mhvx-length=128b", f"-T{self.link_ld.name}"]
-    super().__init__(device, DSPAllocator(self), DSPRenderer(), ClangCompiler("compile_dsp", args=compiler_args), functools.partial(DSPProgram, self))
+    super().__init__(device, DSPAllocator(self), DSPRenderer(), DSPCompiler("compile_dsp", args=compiler_args), functools.partial(DSPProgram, self))
 
     fastrpc_shell = memoryview(bytearray(pathlib.Path('/dsp/cdsp/fastrpc_shell_3').read_bytes()))
     self.shell_buf = self.allocator.alloc(round_up(fastrpc_shell.nbytes, 0x1000), BufferOptions(nolru=True))
@@ -1,7 +1,7 @@
 from __future__ import annotations
 import ctypes, functools
 from typing import Tuple
-from tinygrad.device import Compiled, Compiler, MallocAllocator
+from tinygrad.device import Compiled, Compiler, MallocAllocator, CPUQueue
 from tinygrad.helpers import DEBUG, cpu_time_execution, cpu_objdump
 from tinygrad.renderer.llvmir import LLVMRenderer
 import llvmlite.binding as llvm
@@ -44,3 +44,5 @@ class LLVMDevice(Compiled):
     backing_mod.triple = llvm.get_process_triple()
     self.engine: llvm.executionengine.ExecutionEngine = llvm.create_mcjit_compiler(backing_mod, self.target_machine)
     super().__init__(device, MallocAllocator, LLVMRenderer(), LLVMCompiler(self), functools.partial(LLVMProgram, self))
+    self.queue = CPUQueue(device)
+  def synchronize(self): self.queue.synchronize()
@@ -1,5 +1,6 @@
 from __future__ import annotations
-from typing import Tuple, List, Any
+from typing import Tuple, List, Dict, Any
+import struct
 from dataclasses import dataclass
 import tinygrad.runtime.autogen.libc as libc
 
@@ -36,3 +37,32 @@ def elf_loader(blob:bytes, force_section_align:int=1) -> Tuple[memoryview, List[
     relocs += [(target_image_off + roff, sections[sym.st_shndx].header.sh_addr + sym.st_value, rtype, raddend) for roff, sym, rtype, raddend in rels]
 
   return memoryview(image), sections, relocs
+
+def relocate(instr:int, ploc:int, tgt:int, r_type:int) -> int:
+  # https://github.com/ARM-software/abi-aa/blob/main/aaelf64/aaelf64.rst, the page relative ones need the image mapped page aligned
+  if r_type in {libc.R_X86_64_PC32, libc.R_X86_64_PLT32}: return (tgt - ploc) & 0xFFFFFFFF
+  if r_type in {libc.R_AARCH64_CALL26, libc.R_AARCH64_JUMP26}: return instr | (((tgt - ploc) >> 2) & 0x3FFFFFF)
+  if r_type == libc.R_AARCH64_ADR_PREL_PG_HI21:
+    rel_pg = ((tgt & ~0xFFF) - (ploc & ~0xFFF)) >> 12
+    return instr | ((rel_pg & 0x3) << 29) | (((rel_pg >> 2) & 0x7FFFF) << 5)
+  if r_type == libc.R_AARCH64_ADD_ABS_LO12_NC: return instr | ((tgt & 0xFFF) << 10)
+  ldst_shift = {libc.R_AARCH64_LDST8_ABS_LO12_NC: 0, libc.R_AARCH64_LDST16_ABS_LO12_NC: 1, libc.R_AARCH64_LDST32_ABS_LO12_NC: 2,
+                libc.R_AARCH64_LDST64_ABS_LO12_NC: 3, libc.R_AARCH64_LDST128_ABS_LO12_NC: 4}
+  if r_type in ldst_shift: return instr | (((tgt & 0xFFF) >> ldst_shift[r_type]) << 10)
+  raise NotImplementedError(f"unsupported relocation type {r_type}")
+
+def jit_loader(obj:bytes) -> Tuple[bytes, Dict[str, int]]:
+  """Links a relocatable object into a flat image that runs from any page aligned address, returns it with the offsets of its functions."""
+  image, sections, relocs = elf_loader(obj)
+  symtab = next(sh for sh in sections if sh.header.sh_type == libc.SHT_SYMTAB)
+  strtab = sections[symtab.header.sh_link].content
+  syms = [(strtab[sym.st_name:strtab.find(b'\x00', sym.st_name)].decode('utf-8'), sym) for sym in
+          (libc.Elf64_Sym * (symtab.header.sh_size // symtab.header.sh_entsize)).from_buffer_copy(symtab.content)[1:]]
+  if (undef:=[name for name,sym in syms if sym.st_shndx == libc.SHN_UNDEF and name]): raise RuntimeError(f"unresolved symbols {undef}")
+  for sh in sections:
+    if sh.header.sh_type in {libc.SHT_REL, libc.SHT_RELA} and sections[sh.header.sh_info].header.sh_type != libc.SHT_PROGBITS:
+      raise RuntimeError(f"relocations for unloaded section {sections[sh.header.sh_info].name}")
+  for ploc,tgt,r_type,r_addend in relocs:
+    image[ploc:ploc+4] = struct.pack("<I", relocate(struct.unpack("<I", image[ploc:ploc+4])[0], ploc, tgt+r_addend, r_type))
+  fxns = {name:sections[sym.st_shndx].header.sh_addr+sym.st_value for name,sym in syms if libc.ELF64_ST_TYPE(sym.st_info) == libc.STT_FUNC}
+  return bytes(image), fxns
@@ -1,7 +1,7 @@
 from __future__ import annotations
 import functools
 from math import gcd
-from tinygrad.helpers import partition
+from tinygrad.helpers import partition, memoize
 from typing import List, Dict, Callable, Tuple, Type, Union, Optional, Any, Set, Mapping
 
 # NOTE: Python has different behavior for negative mod and floor div than c
@@ -236,9 +236,9 @@ class RedNode(Node):
 
 class SumNode(RedNode):
   def get_bounds(self) -> Tuple[int, sint]: return sum([x.min for x in self.nodes]), sum([x.max for x in self.nodes])
-  @functools.lru_cache(maxsize=None)  # pylint: disable=method-cache-max-size-none
+  @memoize("SumNode.__mul__")
   def __mul__(self, b: Union[Node, int]): return Node.sum([x*b for x in self.nodes]) # distribute mul into sum
-  @functools.lru_cache(maxsize=None)  # pylint: disable=method-cache-max-size-none
+  @memoize("SumNode.__floordiv__")
   def __floordiv__(self, b: Union[Node, sint], factoring_allowed=True):
     if self == b: return NumNode(1)
     fully_divided: List[Node] = []
@@ -273,7 +273,7 @@ class SumNode(RedNode):
     if divisor > 1: return Node.sum(fully_divided) + Node.sum(rest).__floordiv__(divisor) // (b//divisor)
     return Node.sum(fully_divided) + Node.__floordiv__(Node.sum(rest), b)
 
-  @functools.lru_cache(maxsize=None)  # pylint: disable=method-cache-max-size-none
+  @memoize("SumNode.__mod__")
   def __mod__(self, b: Union[Node, int]):
     if self == b: return NumNode(0)
     if isinstance(b, Node) and (b - self).min > 0: return self # b - self simplifies the node
@@ -0,0 +1,103 @@
+# offline kernel tuning, the results are shipped to machines that never run BEAM themselves
+# python -m tinygrad.tune tune schedule.pkl -o tuned.db   # schedule.pkl from SAVE_SCHEDULE=1, or a pickled list of ASTs/ScheduleItems
+# python -m tinygrad.tune merge tuned.db [more.db ...]    # into CACHEDB, get_kernel uses the tuned opts when BEAM isn't set
+from typing import List, Tuple, Optional
+import argparse, pickle, sqlite3, multiprocessing, time, os
+from tinygrad.ops import UOp, UOps
+from tinygrad.helpers import CACHEDB, VERSION, DEBUG, getenv
+from tinygrad.device import Device
+from tinygrad.codegen.kernel import Kernel, Opt
+from tinygrad.engine.realize import has_tuned_opts
+
+TABLE = f"tuned_opts_{VERSION}"
+
+# *** tuned opts database, the same table the diskcache reads ***
+
+def _connect(fn:str) -> sqlite3.Connection:
+  if os.path.dirname(fn): os.makedirs(os.path.dirname(fn), exist_ok=True)
+  conn = sqlite3.connect(fn, timeout=60)
+  conn.execute(f"CREATE TABLE IF NOT EXISTS '{TABLE}' (ast blob, device text, suffix text, val blob, PRIMARY KEY (ast, device, suffix))")
+  return conn
+
+def merge_tuned(src:str, dst:str=CACHEDB) -> int:
+  """Merges the tuned opts in `src` into `dst`, keeping the faster kernel when both have one. Returns the number of entries written."""
+  cnt, sconn, dconn = 0, _connect(src), _connect(dst)
+  for ast, device, suffix, val in sconn.execute(f"SELECT ast, device, suffix, val FROM '{TABLE}'").fetchall():
+    old = dconn.execute(f"SELECT val FROM '{TABLE}' WHERE ast=? AND device=? AND suffix=?", (ast, device, suffix)).fetchone()
+    if old is not None and pickle.loads(old[0])[1] <= pickle.loads(val)[1]: continue
+    dconn.execute(f"REPLACE INTO '{TABLE}' (ast, device, suffix, val) VALUES (?, ?, ?, ?)", (ast, device, suffix, val))
+    cnt += 1
+  dconn.commit()
+  has_tuned_opts.cache_clear()
+  return cnt
+
+# *** tuning ***
+
+def load_asts(fn:str) -> List[UOp]:
+  with open(fn, "rb") as f: obj = pickle.load(f)
+  asts: List[UOp] = []
+  for x in obj if isinstance(obj, list) else [obj]:
+    if isinstance(x, UOp): asts.append(x)
+    elif isinstance(x, tuple): asts.extend(lsi.ast for lsi in x[0])  # (graph, in_degree) from SAVE_SCHEDULE
+    else: asts.append(x.ast)
+  return list({x.key:x for x in asts if x.op is UOps.SINK}.values())
+
+def tune_kernel(ast:UOp, device:str, amt:int, strategy:str="beam", budget:float=0.0) -> Tuple[bytes, str, List[Opt], float]:
+  """Searches `ast` and returns (ast key, renderer suffix, opts, time), the opts are the hand coded ones if they time faster."""
+  from tinygrad.engine.search import search_kernel, bufs_from_lin, time_linearizer
+  renderer = Device[device].renderer
+  kb = Kernel(ast, opts=renderer).required_optimizations()
+  rawbufs = bufs_from_lin(kb)
+  hc = Kernel(ast, opts=renderer).required_optimizations()
+  if not hc.apply_tensor_cores(getenv("TC", 1)): hc.hand_coded_optimizations()
+  timed = sorted([(time_linearizer(k, rawbufs, allow_test_size=False, clear_l2=True), k) for k in
+                  [search_kernel(kb, rawbufs, amt, strategy, budget=budget), hc]], key=lambda x: x[0])
+  return ast.key, renderer.suffix, timed[0][1].applied_opts[len(kb.applied_opts):], timed[0][0]
+
+def _tune_worker(x:Tuple[UOp, str, int, str, float]) -> Optional[Tuple[bytes, str, List[Opt], float]]:
+  try: return tune_kernel(*x)
+  except Exception as e:
+    if DEBUG >= 1: print(f"failed to tune: {e}")
+    return None
+
+def tune(asts:List[UOp], out:str, device:str, amt:int, strategy:str="beam", budget:float=0.0, workers:int=1) -> int:
+  """Tunes all `asts` on `device` with `workers` processes and merges the results into the database at `out`. Returns the number tuned."""
+  conn, st, cnt = _connect(out), time.perf_counter(), 0
+  args = [(ast, device, amt, strategy, budget) for ast in asts]
+  pool = multiprocessing.get_context("spawn").Pool(workers) if workers > 1 else None
+  try:
+    for i,ret in enumerate(map(_tune_worker, args) if pool is None else pool.imap_unordered(_tune_worker, args)):
+      if ret is None or ret[3] == float("inf"): continue
+      key, suffix, opts, tm = ret
+      old = conn.execute(f"SELECT val FROM '{TABLE}' WHERE ast=? AND device=? AND suffix=?", (key, device, suffix)).fetchone()
+      if old is None or tm < pickle.loads(old[0])[1]:
+        conn.execute(f"REPLACE INTO '{TABLE}' (ast, device, suffix, val) VALUES (?, ?, ?, ?)", (key, device, suffix, pickle.dumps((opts, tm))))
+        conn.commit()
+      cnt += 1
+      if DEBUG >= 1: print(f"{time.perf_counter()-st:8.2f}s: {i+1:4d}/{len(asts):4d} {tm*1e6:10.2f} us  {opts}")
+  finally:
+    if pool is not None: pool.terminate()
+  return cnt
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="tune kernels offline and merge the tuned opts databases")
+  subparsers = parser.add_subparsers(dest="cmd", required=True)
+  tp = subparsers.add_parser("tune", help="tune the kernels from a pickle")
+  tp.add_argument("kernels", help="SAVE_SCHEDULE pickle, or a pickled list of ASTs or ScheduleItems")
+  tp.add_argument("-o", "--out", default="tuned.db", help="database to write the tuned opts to")
+  tp.add_argument("--device", default=Device.DEFAULT)
+  tp.add_argument("--amt", type=int, default=getenv("BEAM", 4), help="beam width or number of samples")
+  tp.add_argument("--strategy", default=getenv("SEARCH_STRATEGY", "beam"))
+  tp.add_argument("--budget", type=float, default=getenv("SEARCH_BUDGET", 0.0), help="seconds per kernel")
+  tp.add_argument("-j", "--workers", type=int, help="tuning processes, defaults to one per cpu on GPUs and 1 on CPUs")
+  mp = subparsers.add_parser("merge", help="merge tuned opts databases")
+  mp.add_argument("dbs", nargs="+")
+  mp.add_argument("-o", "--out", default=CACHEDB, help="database to merge into, defaults to the local cache")
+  args = parser.parse_args()
+  if args.cmd == "tune":
+    asts: List[UOp] = load_asts(args.kernels)
+    workers = args.workers or (multiprocessing.cpu_count() if args.device in {"CUDA", "AMD", "NV"} else 1)
+    print(f"tuning {len(asts)} kernels on {args.device} with {workers} workers")
+    print(f"tuned {tune(asts, args.out, args.device, args.amt, args.strategy, args.budget, workers)} kernels into {args.out}")
+  else:
+    for db in args.dbs: print(f"merged {merge_tuned(db, args.out)} tuned kernels from {db} into {args.out}")
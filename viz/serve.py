@@ -6,7 +6,7 @@ from urllib.parse import parse_qs, urlparse
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from tinygrad import Device
 from tinygrad.helpers import Context, getenv, to_function_name
-from tinygrad.ops import TrackedRewriteContext, UOp
+from tinygrad.ops import TrackedRewriteContext, UOp, toposort
 from tinygrad.engine.graph import uops_colors, word_wrap
 from tinygrad.engine.realize import get_runner
 from tinygrad.engine.schedule import full_ast_rewrite
@@ -14,7 +14,7 @@ from tinygrad.engine.schedule import full_ast_rewrite
 def uop_to_json(x:UOp) -> Dict[int, Tuple[str, str, List[int], str, str]]:
   assert isinstance(x, UOp)
   graph: Dict[int, Tuple[str, str, List[int], str, str]] = {}
-  for u in x.sparents:
+  for u in toposort(x):
     label = f"{str(u.op)[5:]}{(' '+word_wrap(str(u.arg).replace(':', ''))) if u.arg is not None else ''}\n{str(u.dtype)}"
     if getenv("WITH_SHAPE"):
       with contextlib.suppress(Exception): # if the UOp is indexed already it's fine
@@ -30,10 +30,11 @@ class UOpRet:
   extra: List[List[str]]                                   # these become code blocks in the UI
 
 def replace_uop(base:UOp, replaces:Dict[bytes, UOp]) -> UOp:
-  if (found:=replaces.get(base.key)): return found
-  new_srcs = tuple(replace_uop(x, replaces) for x in base.src)
-  replaces[base.key] = ret = UOp(base.op, base.dtype, new_srcs, base.arg) if new_srcs != base.src else base
-  return ret
+  new: Dict[UOp, UOp] = {}
+  for u in toposort(base):
+    if (found:=replaces.get(u.key)) is not None: new[u] = found
+    else: new[u] = UOp(u.op, u.dtype, new_srcs, u.arg) if (new_srcs:=tuple(new[x] for x in u.src)) != u.src else u
+  return new[base]
 
 def create_graph(ctx:TrackedRewriteContext) -> UOpRet:
   uops: List[UOp] = [ctx.sink]